@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+# simulated proxmox api server for offline benchmarks
+# serves the endpoints devbox uses over https from an in-memory cluster - cluster
+# resources and status, pools, qemu create / clone / config / resize / status /
+# migrate / template / delete, task status and log, guest agent ping / exec /
+# exec-status, storage and its content, node network and sdn vnets. tasks stop
+# task_time seconds after they start and guest agents answer agent_delay seconds
+# after a vm starts. every response waits latency seconds, fail_rate of the tasks
+# stop with an error and error_rate of the requests answer 500. requests are
+# counted per endpoint, GET /_fake/stats returns the counts and /_fake/reset clears them
+# usage: python3 bench/fake_proxmox.py [--port 8006] [--vms 10] [--nodes pve,pve2]
+#        [--latency 0.005] [--task-time 0.2] [--agent-delay 0.5] [--fail-rate 0]
+#        [--error-rate 0] [--shared] [--snippets DIR]
+
+import os, re, sys, ssl, json, time, random, tempfile, threading, subprocess, urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# answered as an http error with the message as the reason
+class FakeError(Exception):
+
+  def __init__(self, status, message):
+    self.status = status
+    super().__init__(message)
+
+# in-memory cluster - the template at dev_id and vms running devboxes after it
+class FakeCluster:
+
+  def __init__(self, nodes=('pve',), dev_id=600, vms=10, storage='local-lvm', shared=False, latency=0.0,
+               task_time=0.2, agent_delay=0.5, fail_rate=0.0, error_rate=0.0, snippets='', seed=1):
+    self.lock = threading.RLock()
+    self.nodes = list(nodes)
+    self.dev_id = dev_id
+    self.storage = storage
+    self.shared = shared
+    self.latency = latency
+    self.task_time = task_time
+    self.agent_delay = agent_delay
+    self.fail_rate = fail_rate
+    self.error_rate = error_rate
+    self.snippets = snippets
+    self.random = random.Random(seed)
+    self.tasks = {}
+    self.pools = {}
+    self.execs = {}
+    self.calls = {}
+    self.upid_count = 0
+
+    # devboxes are spread over the nodes round robin
+    self.vms = {}
+    self.add_vm(dev_id, 'devboximg', self.nodes[0], template=1, scsi0=f'{storage}:base-{dev_id}-disk-0,size=2G')
+    for i in range(1, vms + 1):
+      self.add_vm(dev_id + i, f'dev{i}', self.nodes[i % len(self.nodes)], status='running', started=time.monotonic() - agent_delay,
+                  scsi0=f'{storage}:base-{dev_id}-disk-0/vm-{dev_id + i}-disk-0,size=20G')
+
+  def add_vm(self, vmid, name, node, template=0, status='stopped', started=0, **config):
+    self.vms[vmid] = {
+      'vmid': vmid,
+      'name': name,
+      'node': node,
+      'template': template,
+      'status': status,
+      'started': started,
+      'config': {'name': name, 'description': f'devbox fake {vmid}', 'digest': f'{vmid:040x}', **config},
+    }
+
+  # start a task - action runs when it stops ok, an injected failure skips it
+  def task(self, node, kind, vmid, action=None, duration=None):
+    self.upid_count += 1
+    starttime = int(time.time())
+    upid = f'UPID:{node}:{self.upid_count:08X}:00000000:{starttime:08X}:{kind}:{vmid}:root@pam:'
+    failed = self.random.random() < self.fail_rate
+    self.tasks[upid] = {
+      'upid': upid,
+      'node': node,
+      'starttime': starttime,
+      'ends': time.monotonic() + (self.task_time if duration is None else duration),
+      'exitstatus': 'fake failure injected' if failed else 'OK',
+      'action': None if failed else action,
+      'done': False,
+    }
+    return upid
+
+  # stop a task once its time is up and run its action
+  def settle(self, task):
+    if not task['done'] and time.monotonic() >= task['ends']:
+      task['done'] = True
+      if task['action']:
+        task['action']()
+    return task['done']
+
+  def find_task(self, upid):
+    task = self.tasks.get(upid)
+    if not task:
+      raise FakeError(404, f'no such task {upid}')
+    return task
+
+  def find_vm(self, node, vmid):
+    vm = self.vms.get(int(vmid))
+    if not vm:
+      raise FakeError(500, f'Configuration file \'nodes/{node}/qemu-server/{vmid}.conf\' does not exist')
+    return vm
+
+  # count and answer one request - returns the data member of the response
+  def request(self, method, path, params):
+    with self.lock:
+      route = re.sub(r'UPID:[^/]+', '{upid}', path)
+      route = re.sub(r'/\d+(?=/|$)', '/{id}', route)
+      route = re.sub(r'^pools/.+', 'pools/{poolid}', route)
+      self.calls[f'{method} {route}'] = self.calls.get(f'{method} {route}', 0) + 1
+      if self.random.random() < self.error_rate:
+        raise FakeError(500, 'fake error injected')
+      for task in list(self.tasks.values()):
+        self.settle(task)
+      return self.route(method, path.strip('/').split('/'), params)
+
+  def route(self, method, p, params):
+    n = len(p)
+
+    # cluster
+    if p == ['cluster', 'status']:
+      return [{'type': 'cluster', 'name': 'fake'}] + [{'type': 'node', 'name': node, 'online': 1} for node in self.nodes]
+    if p == ['cluster', 'resources']:
+      return self.resources(params.get('type'))
+    if p == ['cluster', 'nextid']:
+      if 'vmid' in params:
+        if int(params['vmid']) in self.vms:
+          raise FakeError(400, f'VM {params["vmid"]} already exists')
+        return str(params['vmid'])
+      vmid = 100
+      while vmid in self.vms:
+        vmid += 1
+      return str(vmid)
+    if p == ['cluster', 'tasks']:
+      return [self.task_entry(task) for task in self.tasks.values()]
+    if p == ['nodes']:
+      return [{'node': node, 'status': 'online'} for node in self.nodes]
+
+    # pools - devbox reserves slots with them
+    if p == ['pools'] and method == 'GET':
+      return [{'poolid': poolid, 'comment': comment} for poolid, comment in self.pools.items()]
+    if p == ['pools'] and method == 'POST':
+      if params['poolid'] in self.pools:
+        raise FakeError(500, f'pool \'{params["poolid"]}\' already exists')
+      self.pools[params['poolid']] = params.get('comment', '')
+      return None
+    if n == 2 and p[0] == 'pools' and method == 'DELETE':
+      self.pools.pop(p[1], None)
+      return None
+    if n == 2 and p[0] == 'pools' and method == 'GET':
+      return {'poolid': p[1], 'comment': self.pools.get(p[1], ''), 'members': []}
+
+    # storage config - the snippets storage of phone home
+    if n == 2 and p[0] == 'storage':
+      return {'storage': p[1], 'path': self.snippets or '/var/lib/vz', 'content': 'iso,snippets', 'shared': 0, 'type': 'dir'}
+
+    if n < 3 or p[0] != 'nodes':
+      raise FakeError(501, f'not implemented: {method} {"/".join(p)}')
+    node = p[1]
+
+    # node storage, network and sdn
+    if p[2:] == ['storage']:
+      return [{'storage': self.storage, 'shared': int(self.shared), 'content': 'images'}, {'storage': 'local', 'shared': 0, 'content': 'iso,snippets'}]
+    if n == 5 and p[2] == 'storage' and p[4] == 'content':
+      return [{'volid': f'{p[3]}:base-{vmid}-disk-0', 'size': 2 * 1073741824} for vmid, vm in self.vms.items() if vm['template'] and vm['node'] == node]
+    if n == 6 and p[2] == 'storage' and p[4] == 'content':
+      return {'volid': p[5], 'size': 2 * 1073741824}
+    if p[2:] == ['network']:
+      return [{'iface': 'vmbr0', 'type': 'bridge'}]
+    if n == 6 and p[2:4] == ['sdn', 'zones'] and p[5] == 'content':
+      return [{'vnet': 'vnet0'}]
+
+    # tasks
+    if p[2:] == ['tasks']:
+      return [self.task_entry(task) for task in self.tasks.values() if task['node'] == node]
+    if n == 5 and p[2] == 'tasks' and p[4] == 'status':
+      task = self.find_task(p[3])
+      status = {'upid': task['upid'], 'status': 'stopped' if task['done'] else 'running'}
+      if task['done']:
+        status['exitstatus'] = task['exitstatus']
+      return status
+    if n == 5 and p[2] == 'tasks' and p[4] == 'log':
+      task = self.find_task(p[3])
+      return [{'n': 1, 't': task['exitstatus']}]
+
+    # create a vm
+    if p[2:] == ['qemu'] and method == 'POST':
+      vmid = int(params['vmid'])
+      if vmid in self.vms:
+        raise FakeError(500, f'unable to create VM {vmid} - VM {vmid} already exists on node')
+      self.add_vm(vmid, params.get('name', f'vm{vmid}'), node, **{k: v for k, v in params.items() if k not in ['vmid', 'name']})
+      return self.task(node, 'qmcreate', vmid)
+
+    if n < 4 or p[2] != 'qemu':
+      raise FakeError(501, f'not implemented: {method} {"/".join(p)}')
+    vm = self.find_vm(node, p[3])
+    vmid = vm['vmid']
+    rest = p[4:]
+
+    if rest == [] and method == 'DELETE':
+      if vm['status'] == 'running':
+        raise FakeError(500, f'VM {vmid} is running - destroy failed')
+      return self.task(node, 'qmdestroy', vmid, lambda: self.vms.pop(vmid, None))
+    if rest == ['config'] and method == 'GET':
+      return dict(vm['config'])
+    if rest == ['config'] and method in ['POST', 'PUT']:
+      if params.get('digest') and params['digest'] != vm['config']['digest']:
+        raise FakeError(500, 'detected modified configuration - file changed by other user? Try again.')
+      vm['config'].update({k: v for k, v in params.items() if k not in ['digest', 'delete']})
+      for key in params.get('delete', '').split(','):
+        vm['config'].pop(key, None)
+      vm['config']['digest'] = f'{self.random.getrandbits(160):040x}'
+      vm['name'] = vm['config'].get('name', vm['name'])
+      if str(params.get('template', '0')) == '1':
+        vm['template'] = 1
+      return self.task(node, 'qmconfig', vmid, duration=self.task_time / 4)
+
+    # the clone exists as soon as the task starts - like proxmox it is locked until then
+    if rest == ['clone']:
+      newid = int(params['newid'])
+      if newid in self.vms:
+        raise FakeError(500, f'unable to create VM {newid}: config file already exists')
+      target = params.get('target', node)
+      if target != node and not self.shared:
+        raise FakeError(500, "can't clone to non-shared storage")
+      self.add_vm(newid, params.get('name', f'Copy-of-VM-{vm["name"]}'), target)
+      if vm['config'].get('tags'):
+        self.vms[newid]['config']['tags'] = vm['config']['tags']
+      disk = f'vm-{newid}-disk-0' if str(params.get('full', '0')) == '1' else f'base-{vmid}-disk-0/vm-{newid}-disk-0'
+      self.vms[newid]['config']['scsi0'] = f'{self.storage}:{disk},size=2G'
+      return self.task(node, 'qmclone', vmid)
+    if rest == ['resize']:
+      return self.task(node, 'qmresize', vmid, duration=self.task_time / 4)
+    if rest == ['template']:
+      def template():
+        vm['template'] = 1
+        vm['config'].setdefault('scsi0', f'{self.storage}:vm-{vmid}-disk-0,size=2G')
+        vm['config']['scsi0'] = vm['config']['scsi0'].replace(f'vm-{vmid}-', f'base-{vmid}-')
+      return self.task(node, 'qmtemplate', vmid, template)
+    if rest == ['migrate']:
+      def migrate():
+        vm['node'] = params['target']
+      return self.task(node, 'qmigrate', vmid, migrate, duration=self.task_time * 5)
+    if rest == ['status', 'current']:
+      return {'vmid': vmid, 'status': vm['status'], 'name': vm['name']}
+    if n == 6 and rest[0] == 'status':
+      action = rest[1]
+      def power():
+        vm['status'] = 'running' if action in ['start', 'reboot', 'resume'] else 'stopped'
+        vm['started'] = time.monotonic() if vm['status'] == 'running' else 0
+        if action == 'start' and 'vendor=' in vm['config'].get('cicustom', ''):
+          threading.Thread(target=self.phone_home, args=(vm['config']['cicustom'],), daemon=True).start()
+      return self.task(node, f'qm{action}', vmid, power)
+
+    # guest agent - answers agent_delay seconds after the vm started, an exec runs 50 ms
+    if rest and rest[0] == 'agent':
+      if vm['status'] != 'running' or time.monotonic() - vm['started'] < self.agent_delay:
+        raise FakeError(500, 'QEMU guest agent is not running')
+      if rest[1:] == ['ping']:
+        return {}
+      if rest[1:] == ['exec']:
+        pid = len(self.execs) + 1
+        self.execs[pid] = {'cmd': params.get('command', ''), 'ends': time.monotonic() + 0.05}
+        return {'pid': pid}
+      if rest[1:] == ['exec-status']:
+        proc = self.execs[int(params['pid'])]
+        if time.monotonic() < proc['ends']:
+          return {'exited': 0}
+        return {'exited': 1, 'exitcode': 0, 'out-data': self.exec_output(proc['cmd'])}
+
+    raise FakeError(501, f'not implemented: {method} {"/".join(p)}')
+
+  # first boot of a vm with a vendor-data snippet - runs its curl against the listener
+  def phone_home(self, cicustom):
+    import urllib.request
+    time.sleep(self.agent_delay)
+    name = cicustom.split('snippets/')[-1]
+    with open(os.path.join(self.snippets or '/var/lib/vz', 'snippets', name)) as f:
+      vendor = json.loads(f.read().split('\n', 1)[1])
+    script = vendor['write_files'][0]['content']
+    cmd = vendor['runcmd'][0][2]
+    token = re.search(r'X-Devbox-Token: ([0-9a-f]+)', cmd).group(1)
+    url = cmd.split()[-1]
+    request = urllib.request.Request(url, data=self.exec_output(script).encode(), headers={'X-Devbox-Token': token}, method='POST')
+    try:
+      urllib.request.urlopen(request, timeout=5)
+    except OSError as e:
+      print(f'phone home {url}: {e}', file=sys.stderr)
+
+  # guest output - probe scripts pass every probe, batched execs print ok per marker
+  def exec_output(self, cmd):
+    probes = re.findall(r'@@([0-9a-f]+):\$1', cmd)
+    if probes:
+      return ''.join(f'@@{probes[0]}:{i}:0:{self.random.randint(5, 400)}\n' for i in range(len(re.findall(r'^p \d+ ', cmd, re.M))))
+    markers = list(dict.fromkeys(re.findall(r"(@@[0-9a-f]+:\d+)\\n", cmd)))
+    if markers:
+      return ''.join(f'{marker}\nok\n\n{marker}:rc:0\n' for marker in markers)
+    return 'ok\n'
+
+  def task_entry(self, task):
+    entry = {'upid': task['upid'], 'node': task['node'], 'starttime': task['starttime']}
+    if task['done']:
+      entry.update({'status': task['exitstatus'], 'endtime': task['starttime'] + 1})
+    return entry
+
+  # cluster/resources listing - vms, nodes and storage, or one type of them
+  def resources(self, kind):
+    result = []
+    if kind in [None, 'vm']:
+      for vm in self.vms.values():
+        result.append({
+          'id': f'qemu/{vm["vmid"]}', 'type': 'qemu', 'vmid': vm['vmid'], 'name': vm['name'],
+          'node': vm['node'], 'status': vm['status'], 'template': vm['template'],
+          'maxmem': 2147483648, 'mem': 1073741824 if vm['status'] == 'running' else 0,
+          'maxcpu': 1, 'cpu': 0.05 if vm['status'] == 'running' else 0,
+          'tags': vm['config'].get('tags', ''),
+        })
+    if kind in [None, 'node']:
+      for node in self.nodes:
+        running = sum(1 for vm in self.vms.values() if vm['node'] == node and vm['status'] == 'running')
+        result.append({
+          'id': f'node/{node}', 'type': 'node', 'node': node, 'status': 'online',
+          'maxmem': 68719476736, 'mem': 4294967296 + running * 1073741824,
+          'maxcpu': 16, 'cpu': min(1.0, 0.02 + running * 0.01),
+        })
+    if kind in [None, 'storage']:
+      for node in self.nodes:
+        result.append({'id': f'storage/{node}/{self.storage}', 'type': 'storage', 'node': node,
+                       'storage': self.storage, 'shared': int(self.shared), 'status': 'available'})
+    return result
+
+# http/1.1 keep-alive handler answering from server.cluster
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  # headers and body are written separately - without nodelay a keep-alive client
+  # waits out the delayed ack on every response
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    pass
+
+  def respond(self, status, body, reason=None):
+    data = json.dumps(body).encode()
+    self.send_response(status, reason)
+    self.send_header('Content-Type', 'application/json;charset=UTF-8')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def dispatch(self):
+    cluster = self.server.cluster
+    url = urllib.parse.urlsplit(self.path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    length = int(self.headers.get('Content-Length') or 0)
+    if length:
+      body = self.rfile.read(length).decode()
+      if 'json' in (self.headers.get('Content-Type') or ''):
+        params.update(json.loads(body))
+      else:
+        params.update(urllib.parse.parse_qsl(body))
+
+    # control endpoints for benchmarks
+    if url.path == '/_fake/stats':
+      with cluster.lock:
+        return self.respond(200, {'calls': dict(cluster.calls), 'total': sum(cluster.calls.values())})
+    if url.path == '/_fake/reset':
+      with cluster.lock:
+        cluster.calls.clear()
+      return self.respond(200, {})
+
+    if not url.path.startswith('/api2/json/'):
+      return self.respond(404, {'data': None})
+    time.sleep(cluster.latency)
+    try:
+      self.respond(200, {'data': cluster.request(self.command, urllib.parse.unquote(url.path[len('/api2/json/'):]), params)})
+    except FakeError as e:
+      self.respond(e.status, {'data': None, 'message': str(e)}, str(e))
+
+  do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+# self signed certificate - proxmoxer only speaks https
+def make_cert(directory):
+  cert = os.path.join(directory, 'fake.pem')
+  subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                  '-subj', '/CN=localhost', '-keyout', cert, '-out', cert],
+                 check=True, capture_output=True)
+  return cert
+
+# serve a cluster from a thread - returns the server, server.cluster can be replaced
+# between runs. port 0 takes a free port, see server.server_port
+def start(cluster, port=0):
+  server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+  server.daemon_threads = True
+  server.cluster = cluster
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  with tempfile.TemporaryDirectory() as tmp:
+    context.load_cert_chain(make_cert(tmp))
+  server.socket = context.wrap_socket(server.socket, server_side=True)
+  threading.Thread(target=server.serve_forever, name='fake-proxmox', daemon=True).start()
+  return server
+
+def main():
+  args = sys.argv[1:]
+  def option(name, default):
+    return type(default)(args[args.index(name) + 1]) if name in args else default
+
+  cluster = FakeCluster(
+    nodes=option('--nodes', 'pve').split(','),
+    dev_id=option('--dev-id', 600),
+    vms=option('--vms', 10),
+    shared='--shared' in args,
+    latency=option('--latency', 0.0),
+    task_time=option('--task-time', 0.2),
+    agent_delay=option('--agent-delay', 0.5),
+    fail_rate=option('--fail-rate', 0.0),
+    error_rate=option('--error-rate', 0.0),
+    snippets=option('--snippets', ''),
+  )
+  server = start(cluster, option('--port', 8006))
+  print(f'fake proxmox on https://127.0.0.1:{server.server_port} - {len(cluster.vms)} vms', flush=True)
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# wall time, api calls and peak memory of devbox commands at several fleet sizes
+# each fleet size gets a fresh fake_proxmox cluster with that many running devboxes,
+# served over https from this process. every scenario runs devbox in a fresh
+# interpreter with an empty state cache - api calls are counted by the fake, peak
+# memory is the child's max rss. the tui scenario starts the app headless and
+# waits until its node table is filled.
+# usage: python3 bench/fleet.py [--root path/to/prox-devbox] [--sizes 10,100,1000]
+#        [--batch 10] [--latency 0.002] [--task-time 0.05] [--agent-delay 0.2]
+#        [--fail-rate 0] [--error-rate 0] [--save results.json] [-v]
+
+import os, sys, json, time, asyncio, tempfile, subprocess
+
+from fake_proxmox import FakeCluster, start
+from startup_calls import bench_ini, default_root
+
+# scenarios - argv of devbox.py, or tui for a headless refresh of the node table
+# {batch} is the number of devboxes created at once
+scenarios = [
+  ('nodes info', ['nodes', 'info', '--refresh']),
+  ('nodes create', ['nodes', 'create', 'bench1']),
+  ('batch create', ['nodes', 'create', '--count={batch}']),
+  ('batch create --aio', ['nodes', 'create', '--count={batch}', '--aio']),
+  ('tui refresh', 'tui'),
+]
+
+# devbox.ini for a fleet - the range and the network are sized to hold it
+def fleet_ini(port, size, batch):
+  ini = bench_ini.replace('port = 8006', f'port = {port}')
+  for key, value in [('network_ip', '10.20.0.10'), ('network_mask', '16'), ('network_gw', '10.20.0.1'), ('network_dns', '10.20.0.1')]:
+    ini = '\n'.join(f'{key} = {value}' if line.startswith(f'{key} =') else line for line in ini.splitlines()) + '\n'
+  return ini.replace('[devbox]\n', f'[devbox]\nmax_nodes = {size + 2 * batch + 10}\n')
+
+# run a command in a fresh interpreter - returns (rc, seconds, peak rss in MB, stderr)
+def measure(cmd, cwd, env):
+  with tempfile.TemporaryFile('w+') as err:
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=err)
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    err.seek(0)
+
+    # max rss is in kB on linux and in bytes on macos
+    rss = usage.ru_maxrss / (1048576 if sys.platform == 'darwin' else 1024)
+    return proc.returncode, seconds, rss, err.read()
+
+# child - start the tui headless and wait until its node table has rows rows
+def tui_child(rows):
+  sys.path.insert(0, os.getcwd())
+  import devbox_tui
+
+  async def refresh():
+    app = devbox_tui.DevboxTUI()
+    async with app.run_test() as pilot:
+      table = app.query_one('#nodes-table')
+      while table.row_count < rows:
+        await pilot.pause(0.01)
+
+  asyncio.run(asyncio.wait_for(refresh(), 120))
+
+def main():
+  args = sys.argv[1:]
+  def option(name, default):
+    return type(default)(args[args.index(name) + 1]) if name in args else default
+
+  root = os.path.abspath(option('--root', default_root))
+  sizes = [int(size) for size in option('--sizes', '10,100,1000').split(',')]
+  batch = option('--batch', 10)
+  verbose = '-v' in args
+  cluster_args = {
+    'latency': option('--latency', 0.002),
+    'task_time': option('--task-time', 0.05),
+    'agent_delay': option('--agent-delay', 0.2),
+    'fail_rate': option('--fail-rate', 0.0),
+    'error_rate': option('--error-rate', 0.0),
+  }
+
+  server = start(FakeCluster(vms=0))
+  print(f'{"fleet":>6}  {"scenario":<20} {"wall ms":>8} {"api calls":>10} {"peak MB":>8}  rc')
+  results = []
+  for size in sizes:
+    for name, argv in scenarios:
+
+      # a fresh cluster and cache for every run - creates leave the fleet as it was
+      server.cluster = FakeCluster(vms=size, **cluster_args)
+      with tempfile.TemporaryDirectory() as tmp:
+        for path in ['lib', 'devbox.py', 'devbox_tui.py']:
+          os.symlink(os.path.join(root, path), os.path.join(tmp, path))
+        with open(os.path.join(tmp, 'devbox.ini'), 'w') as ini:
+          ini.write(fleet_ini(server.server_port, size, batch))
+        env = {**os.environ, 'XDG_CACHE_HOME': os.path.join(tmp, 'cache')}
+        if argv == 'tui':
+          cmd = [sys.executable, os.path.abspath(__file__), '--tui-child', str(size)]
+        else:
+          cmd = [sys.executable, 'devbox.py'] + [arg.format(batch=batch) for arg in argv]
+        rc, seconds, rss, err = measure(cmd, tmp, env)
+
+      with server.cluster.lock:
+        calls = dict(server.cluster.calls)
+      results.append({'fleet': size, 'scenario': name, 'rc': rc, 'seconds': seconds, 'calls': sum(calls.values()), 'peak_mb': rss, 'endpoints': calls})
+      print(f'{size:>6}  {name:<20} {seconds * 1000:>8.0f} {sum(calls.values()):>10} {rss:>8.1f}  {rc}', flush=True)
+      if rc and err.strip():
+        print('\n'.join(f'        {line}' for line in err.strip().splitlines()[-5:]))
+      if verbose:
+        for call, count in sorted(calls.items(), key=lambda item: -item[1]):
+          print(f'        {count:>6}  {call}')
+  server.shutdown()
+
+  if '--save' in args:
+    with open(args[args.index('--save') + 1], 'w') as f:
+      json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+  if len(sys.argv) > 2 and sys.argv[1] == '--tui-child':
+    tui_child(int(sys.argv[2]))
+  else:
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# counts the proxmox api round-trips each verb makes
+# every verb runs in a fresh process against an in-process fake ProxmoxAPI,
+# once with an empty state cache (cold) and once with the cache it left (warm).
+# --check exits 1 when a verb makes more calls than its budget
+# usage: python3 bench/startup_calls.py [--root path/to/prox-devbox] [--check] [-v]
+
+import os, re, sys, json, types, runpy, tempfile, subprocess
+
+# devbox checkout to measure - defaults to the one this script lives in
+default_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# verbs measured - nodes are named dev1/dev2 in the fake cluster
+verbs = [
+  ['nodes', 'info'],
+  ['nodes', 'ssh', 'dev1'],
+  ['nodes', 'terminal', 'dev1'],
+  ['nodes', 'reboot', 'dev1'],
+  ['nodes', 'destroy', 'dev2'],
+  ['nodes', 'create', 'dev3'],
+  ['nodes', 'create', 'dev3', 'dev4', 'dev5'],
+  ['image', 'info'],
+  ['image', 'destroy'],
+]
+
+# most api calls each verb may make - cold, warm
+# lower a budget when a change saves calls, raise it only with a reason
+budgets = {
+  'nodes info': (1, 0),
+  'nodes ssh dev1': (1, 0),
+  'nodes terminal dev1': (1, 0),
+  'nodes reboot dev1': (1, 1),
+  'nodes destroy dev2': (5, 5),
+  'nodes create dev3': (20, 16),
+
+  # the clones share one task waiter - how many polls a batch needs varies a little
+  'nodes create dev3 dev4 dev5': (41, 37),
+  'image info': (3, 0),
+  'image destroy': (4, 4),
+}
+
+# minimal devbox.ini for the fake cluster
+bench_ini = '''[proxmox]
+prox_endpoint = 127.0.0.1
+port = 8006
+user = root@pam
+token_name = devbox
+api_key = bench
+node = pve
+storage = local-lvm
+
+[devbox]
+dev_id = 600
+cloud_image_url = https://cloud-images.ubuntu.com/minimal/daily/oracular/current/oracular-minimal-cloudimg-amd64.img
+vm_disk = 20
+vm_cpu = 1
+vm_ram = 2
+cloudinituser = user
+cloudinitpass = admin
+cloudinitsshkey = ssh-rsa bench
+network_bridge = vmbr0
+network_ip = 192.168.0.160
+network_mask = 24
+network_gw = 192.168.0.1
+network_dns = 192.168.0.1
+network_mtu = 1500
+'''
+
+# commands sent to the guest agent - readiness probes pass at once, anything else prints ok
+execs = []
+def exec_output(cmd):
+  probes = re.findall(r'@@([0-9a-f]+):\$1', cmd)
+  if probes:
+    return ''.join(f'@@{probes[0]}:{i}:0:0\n' for i in range(len(re.findall(r'^p \d+ ', cmd, re.M))))
+  return 'ok'
+
+# canned answers keyed by method and path - every other request starts a task
+# tasks finish as soon as they start
+upids = []
+def fake_response(method, path, params):
+  if path == 'cluster/resources':
+    return [
+      {'vmid': 600, 'name': 'devboximg', 'node': 'pve', 'template': 1},
+      {'vmid': 601, 'name': 'dev1', 'node': 'pve'},
+      {'vmid': 602, 'name': 'dev2', 'node': 'pve'},
+    ]
+  if path == 'pools' and method == 'GET':
+    return []
+  if path.startswith('pools'):
+    return None
+  if path == 'cluster/status':
+    return [{'type': 'cluster', 'name': 'bench'}]
+  if path == 'nodes':
+    return [{'node': 'pve'}]
+  if path == 'nodes/pve/storage':
+    return [{'storage': 'local-lvm', 'shared': 0}]
+  if path == 'nodes/pve/network':
+    return [{'iface': 'vmbr0'}]
+  if path == 'nodes/pve/storage/local-lvm/content':
+    return [{'volid': 'local-lvm:base-600-disk-0'}]
+  if path.startswith('nodes/pve/storage/local-lvm/content/'):
+    return {'size': 2 * 1073741824}
+  if path.endswith('/config') and method == 'GET':
+    return {'description': 'devbox bench', 'scsi0': 'local-lvm:base-600-disk-0,size=2G'}
+  if path == 'nodes/pve/tasks':
+    return [{'upid': upid, 'status': 'OK', 'endtime': 1} for upid in upids]
+  if path.endswith('/status') and '/tasks/' in path:
+    return {'status': 'stopped', 'exitstatus': 'OK'}
+  if path.endswith('/agent/exec'):
+    execs.append(params.get('command', ''))
+    return {'pid': len(execs)}
+  if path.endswith('/agent/exec-status'):
+    return {'exited': 1, 'exitcode': 0, 'out-data': exec_output(execs[int(params['pid']) - 1])}
+  if path.endswith('/agent/ping'):
+    return {}
+  upids.append(f'UPID:pve:{len(upids) + 1:08X}:00005678:65000000:qmtask:{path.split("/")[3]}:root@pam:')
+  return upids[-1]
+
+# proxmoxer-like resource that records each request
+class FakeResource:
+  def __init__(self, calls, path):
+    self._calls = calls
+    self._path = path
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return FakeResource(self._calls, self._path + [name])
+
+  def __call__(self, *parts):
+    return FakeResource(self._calls, self._path + [str(p) for p in parts])
+
+  def _request(self, method, params):
+    path = '/'.join(self._path)
+    self._calls.append(f'{method} {path}')
+    return fake_response(method, path, params)
+
+  def get(self, *args, **params): return self._request('GET', params)
+  def post(self, *args, **params): return self._request('POST', params)
+  def put(self, *args, **params): return self._request('PUT', params)
+  def delete(self, *args, **params): return self._request('DELETE', params)
+
+# stands in for the proxmoxer module - the real one is still imported when devbox
+# first asks for ProxmoxAPI so start-up timings include its import cost
+class FakeProxmoxer(types.ModuleType):
+  def __init__(self, name, calls):
+    super().__init__(name)
+    self._calls = calls
+
+  def __getattr__(self, name):
+    if name != 'ProxmoxAPI':
+      raise AttributeError(name)
+    del sys.modules['proxmoxer']
+    try:
+      import proxmoxer
+    except ImportError:
+      pass
+    sys.modules['proxmoxer'] = self
+    return lambda *args, **kwargs: FakeResource(self._calls, [])
+
+# child - run a single verb and print the requests it made as json
+def run_child(root, argv):
+  calls = []
+  sys.modules['proxmoxer'] = FakeProxmoxer('proxmoxer', calls)
+
+  # ssh / qm terminal / qm reboot are not run
+  subprocess.run = lambda *args, **kwargs: subprocess.CompletedProcess(args, 0, '', '')
+  subprocess.Popen = lambda *args, **kwargs: None
+
+  # devbox expects its lib/ and devbox.ini in the working directory
+  with tempfile.TemporaryDirectory() as tmp:
+    os.symlink(os.path.join(root, 'lib'), os.path.join(tmp, 'lib'))
+    os.symlink(os.path.join(root, 'devbox.py'), os.path.join(tmp, 'devbox.py'))
+    with open(os.path.join(tmp, 'devbox.ini'), 'w') as ini:
+      ini.write(bench_ini)
+    os.chdir(tmp)
+
+    # keep verb output out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    sys.argv = ['devbox.py'] + argv
+    rc = 0
+    try:
+      runpy.run_path('devbox.py', run_name='__main__')
+    except SystemExit as e:
+      rc = e.code or 0
+    finally:
+      sys.stdout = stdout
+  print(json.dumps({'rc': rc, 'calls': calls}))
+
+# parent - run every verb in a fresh interpreter and print a table
+def main():
+  args = sys.argv[1:]
+  root = default_root
+  verbose = '-v' in args
+  check = '--check' in args
+  if '--root' in args:
+    root = os.path.abspath(args[args.index('--root') + 1])
+
+  print(f'{"verb":<24} {"cold":>5} {"warm":>5} {"budget":>7}  rc')
+  over = []
+  for argv in verbs:
+    results = []
+    with tempfile.TemporaryDirectory() as cache_home:
+      for run in ['cold', 'warm']:
+        out = subprocess.run(
+          [sys.executable, __file__, '--child', root] + argv,
+          text=True, capture_output=True,
+          env={**os.environ, 'XDG_CACHE_HOME': cache_home})
+        try:
+          results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+          print(f'{" ".join(argv):<24} error\n{out.stderr.strip()}')
+          break
+    if len(results) != 2:
+      continue
+    cold, warm = results
+    name = ' '.join(argv)
+    budget = budgets.get(name)
+    line = f'{name:<24} {len(cold["calls"]):>5} {len(warm["calls"]):>5} {f"{budget[0]}/{budget[1]}" if budget else "-":>7}  {warm["rc"]}'
+    if budget and (len(cold['calls']) > budget[0] or len(warm['calls']) > budget[1]):
+      line += '  OVER BUDGET'
+      over.append(name)
+    print(line)
+    if verbose:
+      for call in warm['calls']:
+        print(f'  {call}')
+  if check and over:
+    print(f'{len(over)} verbs over their api call budget')
+    exit(1)
+
+if __name__ == '__main__':
+  if len(sys.argv) > 2 and sys.argv[1] == '--child':
+    run_child(sys.argv[2], sys.argv[3:])
+  else:
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# cold-start wall time of each verb
+# every run is a fresh interpreter driven by the startup_calls.py child against its
+# fake ProxmoxAPI, so the time is python start-up, imports and devbox's own work.
+# cold runs start with an empty state cache, warm runs with the cache a run left.
+# usage: python3 bench/startup_time.py [--root path/to/prox-devbox] [--runs 5]
+#        [--save baseline.json] [--compare baseline.json [--tolerance 0.25]]
+
+import os, sys, json, time, tempfile, subprocess
+
+# shares the verbs, fake cluster and child runner with startup_calls.py
+from startup_calls import verbs, default_root
+
+child = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_calls.py')
+
+# slower than the baseline by this fraction plus this many seconds counts as a regression
+default_tolerance = 0.25
+noise_floor = 0.02
+
+# seconds one run of argv takes
+def timed_run(cmd, env):
+  started = time.perf_counter()
+  subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return time.perf_counter() - started
+
+# best cold and warm seconds for a verb - the least disturbed of the runs
+def measure(root, argv, runs):
+  cmd = [sys.executable, child, '--child', root] + argv
+  cold, warm = [], []
+  for _ in range(runs):
+    with tempfile.TemporaryDirectory() as cache_home:
+      env = {**os.environ, 'XDG_CACHE_HOME': cache_home}
+      cold.append(timed_run(cmd, env))
+      warm.append(timed_run(cmd, env))
+  return min(cold), min(warm)
+
+def main():
+  args = sys.argv[1:]
+  root = default_root
+  if '--root' in args:
+    root = os.path.abspath(args[args.index('--root') + 1])
+  runs = int(args[args.index('--runs') + 1]) if '--runs' in args else 5
+  tolerance = float(args[args.index('--tolerance') + 1]) if '--tolerance' in args else default_tolerance
+  baseline = {}
+  if '--compare' in args:
+    with open(args[args.index('--compare') + 1]) as f:
+      baseline = json.load(f)
+
+  # interpreter start-up alone - the floor every verb pays
+  python = min(timed_run([sys.executable, '-c', 'pass'], os.environ) for _ in range(runs))
+  print(f'python start-up {python * 1000:.0f} ms - best of {runs} runs')
+  print(f'{"verb":<28} {"cold ms":>8} {"warm ms":>8}' + (f' {"baseline":>9}' if baseline else ''))
+
+  results = {}
+  regressions = []
+  for argv in verbs:
+    name = ' '.join(argv)
+    cold, warm = measure(root, argv, runs)
+    results[name] = {'cold': cold, 'warm': warm}
+    line = f'{name:<28} {cold * 1000:>8.0f} {warm * 1000:>8.0f}'
+
+    # compare warm runs - they have the least noise from the fake cluster
+    if name in baseline:
+      limit = baseline[name]['warm'] * (1 + tolerance) + noise_floor
+      line += f' {baseline[name]["warm"] * 1000:>9.0f}'
+      if warm > limit:
+        line += '  REGRESSION'
+        regressions.append(name)
+    print(line)
+
+  if '--save' in args:
+    with open(args[args.index('--save') + 1], 'w') as f:
+      json.dump(results, f, indent=2)
+  if regressions:
+    print(f'{len(regressions)} verbs slower than the baseline by more than {tolerance:.0%}')
+    exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -2,11 +2,18 @@
 
 import os, sys, importlib
 sys.path[0:0] = ['lib/']
-from devbox_ini import init_devbox_ini
+
+# DEVBOX_PROFILE_STARTUP=1 reports import and first api call timings - imported first to time the rest
+from devbox_profile import mark
 from devbox_kmsg import kmsg
+from devbox_opts import opts, parse_opts
+
+# split --options eg --refresh out of the positional args
+sys.argv = parse_opts(sys.argv)
 
 # check file exists
 if not os.path.isfile('devbox.ini'):
+  from devbox_ini import init_devbox_ini
   init_devbox_ini()
   exit(0)
 
@@ -16,15 +23,22 @@ cmds = {
     "info" : '',
     "create" : '',
     "update": '',
+    "replicate": '',
     "destroy": '',
   },
   "nodes": {
     "info": '',
-    "create" : 'hostname',
+    "create" : 'hostname ...',
+    "rebalance": '',
     "destroy" : 'hostname',
     "terminal" : 'hostname',
     "ssh" : 'hostname',
     "reboot" : 'hostname',
+  },
+  "pool": {
+    "info": '',
+    "fill": '',
+    "drain": '',
   }
 }
 
@@ -88,12 +102,28 @@ except IndexError:
   exit(0)
 
 # handle commands with required args eg 'node ssh hostname'
+# nodes create --count generates its hostnames
 try:
-  if cmds[verb][cmd] and sys.argv[3]:
+  if cmds[verb][cmd] and not opts.get('count') and sys.argv[3]:
     pass
 except IndexError:
   kmsg(f'devbox_{verb}', f'{cmd} [{cmds[verb][cmd]}]')
   exit(0)
 
-# run passed verb module (modules execute at import time)
-importlib.import_module('verb_' + verb)
+mark('arguments parsed')
+
+# nodes info / ssh / terminal / reboot are answered by devboxd when it is running
+if verb == 'nodes' and cmd in ['info', 'ssh', 'terminal', 'reboot'] and not opts.get('refresh'):
+  from devbox_client import fast_path
+  if fast_path(cmd, sys.argv[3:]):
+    mark('answered by devboxd')
+    exit(0)
+
+# import the verb module and run the command
+# the command is the root span of the run - --timings and [trace] export it at exit
+from devbox_trace import span
+verb_module = importlib.import_module('verb_' + verb)
+mark(f'verb_{verb} imported')
+with span(f'{verb}.{cmd}'):
+  verb_module.run(cmd, sys.argv[3:])
+mark(f'{verb} {cmd} done')
@@ -8,6 +8,7 @@ import os
 import signal
 import sys
 import subprocess
+import threading
 
 # ── path setup ────────────────────────────────────────────────────────────────
 _root = os.path.dirname(os.path.abspath(__file__))
@@ -24,10 +25,7 @@ from textual import on, work
 from rich.text import Text
 
 # ── safe config import ────────────────────────────────────────────────────────
-# Fake argv so devbox_config skips the "image must exist" check on import.
-_saved_argv = sys.argv[:]
-sys.argv = ['devbox.py', 'image', 'create']
-
+# devbox_config only validates devbox.ini on import; cluster lookups are lazy.
 _cfg = None
 _cfg_error: str = ''
 
@@ -37,8 +35,6 @@ except SystemExit as _e:
     _cfg_error = f'Configuration failed (exit {_e.code}) — edit devbox.ini and restart'
 except Exception as _e:
     _cfg_error = str(_e)
-finally:
-    sys.argv = _saved_argv
 
 
 # ── data helpers ──────────────────────────────────────────────────────────────
@@ -47,39 +43,80 @@ def _has_cfg() -> bool:
     return _cfg is not None
 
 
-def _node_rows() -> list[tuple[str, str, str, str]]:
-    """Fresh (vmid, hostname, ip/mask, node) rows from the Proxmox API."""
-    if not _has_cfg():
-        return []
-    try:
-        rows = []
-        for vm in _cfg.prox.cluster.resources.get(type='vm'):
-            vid = int(vm.get('vmid'))
-            if _cfg.dev_id <= vid < (_cfg.dev_id + 10) and vid != _cfg.dev_id:
-                rows.append((
-                    str(vid),
-                    vm.get('name', ''),
-                    f"{_cfg.vmip(vid)}/{_cfg.network_mask}",
-                    vm.get('node', ''),
-                ))
-        return sorted(rows, key=lambda r: int(r[0]))
-    except Exception:
-        return []
-
-
-def _node_list() -> list[tuple[int, str, str]]:
-    """Fresh (vmid, hostname, ip/mask) list for the node picker modal."""
-    if not _has_cfg():
-        return []
-    try:
-        result = []
-        for vm in _cfg.prox.cluster.resources.get(type='vm'):
-            vid = int(vm.get('vmid'))
-            if _cfg.dev_id <= vid < (_cfg.dev_id + 10) and vid != _cfg.dev_id:
-                result.append((vid, vm.get('name', ''), f"{_cfg.vmip(vid)}/{_cfg.network_mask}"))
-        return sorted(result)
-    except Exception:
-        return []
+def _daemon_rows() -> list | None:
+    """[vmid, node, hostname, ip/mask] rows from devboxd, or None when it is not running."""
+    from devbox_client import daemon_request
+    from devbox_cache import cluster_key
+    response = daemon_request(cluster_key(_cfg.prox_endpoint, _cfg.dev_id), {'op': 'info'})
+    return response['rows'] if response else None
+
+
+class FleetStore:
+    """In-memory fleet state shared by every widget.
+
+    One background poller calls refresh(); the node table and the picker
+    modals only read from the store, so opening a picker makes no API call.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._rows: dict[str, tuple[str, str, str, str]] = {}
+        self.loaded = False
+        self.error = ''
+
+    def _fetch(self) -> dict[str, tuple[str, str, str, str]]:
+        """(vmid, hostname, ip/mask, node) by vmid from devboxd or one cluster.resources call.
+
+        Both paths list the same devboxes - devbox_rows() leaves out the
+        template, pool and validation VMs.
+        """
+        rows = _daemon_rows()
+        if rows is None:
+            _cfg.state.refresh('resources')
+            rows = _cfg.devbox_rows()
+        return {str(vid): (str(vid), name, ip, node) for vid, node, name, ip in rows}
+
+    def refresh(self) -> bool:
+        """Fetch the fleet - True when it differs from what the widgets show.
+
+        A failed fetch keeps the last rows and sets error. API lookups report
+        their failure and exit, so SystemExit is caught as well.
+        """
+        if not _has_cfg():
+            return False
+        try:
+            rows = self._fetch()
+        except SystemExit:
+            with self._lock:
+                self.error = f'API request to {_cfg.prox_endpoint} failed - check [proxmox] settings'
+            return False
+        except Exception as e:
+            with self._lock:
+                self.error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            return False
+        with self._lock:
+            changed = not self.loaded or rows != self._rows
+            self._rows = rows
+            self.loaded = True
+            self.error = ''
+        return changed
+
+    def rows(self) -> list[tuple[str, str, str, str]]:
+        """(vmid, hostname, ip/mask, node) rows sorted by vmid."""
+        with self._lock:
+            return sorted(self._rows.values(), key=lambda r: int(r[0]))
+
+    def node_list(self) -> list[tuple[int, str, str]]:
+        """(vmid, hostname, ip/mask) list for the node picker modal."""
+        return [(int(vid), name, ip) for vid, name, ip, _ in self.rows()]
+
+
+_fleet = FleetStore()
+
+
+def _refresh_interval() -> float:
+    """Seconds between fleet polls - [tui] refresh_interval in devbox.ini."""
+    return _cfg.conf_opt('tui', 'refresh_interval', 10) if _has_cfg() else 0
 
 
 def _image_info() -> tuple[str, str]:
@@ -90,10 +127,9 @@ def _image_info() -> tuple[str, str]:
         name = _cfg.devbox_img()
         if not name:
             return ('no image — run  Image › Create', '')
-        tpl  = _cfg.prox.nodes(_cfg.node).qemu(_cfg.dev_id).config.get()
-        desc = tpl.get('description', '')
-        return (desc, f"{name}  ({_cfg.storage_type})")
-    except Exception:
+        gen  = _cfg.state.template['generation']
+        return (_cfg.state.cloud_image_desc, f"gen-{gen}  {name}  ({_cfg.state.storage_type})")
+    except (Exception, SystemExit):
         return ('', '')
 
 
@@ -277,6 +313,14 @@ class DevboxTUI(App):
     }
     """
 
+    # node table columns - cells are updated in place by column key
+    COLUMNS = (
+        ("VMID",      "vmid"),
+        ("Hostname",  "hostname"),
+        ("IP / Mask", "ip"),
+        ("Node",      "node"),
+    )
+
     BINDINGS = [
         Binding("r",      "refresh",   "Refresh"),
         Binding("ctrl+l", "clear_log", "Clear log"),
@@ -294,6 +338,7 @@ class DevboxTUI(App):
             with Vertical(id="sidebar"):
                 yield Label("── Image ──", classes="sec")
                 yield Button("Create",  id="img-create",  variant="success")
+                yield Button("Update",  id="img-update")
                 yield Button("Info",    id="img-info")
                 yield Button("Destroy", id="img-destroy", variant="error")
 
@@ -336,13 +381,17 @@ class DevboxTUI(App):
 
     def on_mount(self) -> None:
         t = self.query_one("#nodes-table", DataTable)
-        t.add_columns("VMID", "Hostname", "IP / Mask", "Node")
+        for label, key in self.COLUMNS:
+            t.add_column(label, key=key)
 
         if not _has_cfg():
             self._log(f"[bold red]Config error:[/] {_cfg_error}")
             self._status("Config error — fix devbox.ini and restart", err=True)
         else:
             self._refresh_all()
+            interval = _refresh_interval()
+            if interval > 0:
+                self.set_interval(interval, self._refresh_table)
 
     # ── UI helpers ────────────────────────────────────────────────────────────
 
@@ -368,20 +417,48 @@ class DevboxTUI(App):
         self._refresh_table()
         self._refresh_image()
 
-    @work(thread=True)
+    @work(thread=True, exclusive=True, group="fleet")
     def _refresh_table(self) -> None:
-        self.call_from_thread(self._status, "Refreshing…")
-        rows = _node_rows()
+        """Poll the fleet store - the table is only touched when the fleet changed."""
+        if _fleet.refresh():
+            self.call_from_thread(self._apply_fleet)
+        elif _fleet.error:
+            self.call_from_thread(self._status, f"Refresh failed — {_fleet.error}", True)
 
-        def _apply():
-            t = self.query_one("#nodes-table", DataTable)
-            t.clear()
-            for row in rows:
-                t.add_row(*row)
-            n = len(rows)
-            self._status(f"Ready — {n} node{'s' if n != 1 else ''}")
+    def _apply_fleet(self) -> None:
+        """Diff the store into the node table.
 
-        self.call_from_thread(_apply)
+        Changed cells are updated in place and rows are added or removed by
+        vmid, so the table is not redrawn and the cursor stays on its node.
+        """
+        t = self.query_one("#nodes-table", DataTable)
+        rows = {row[0]: row for row in _fleet.rows()}
+        keys = [key for _, key in self.COLUMNS]
+        selected = None
+        if t.row_count:
+            selected = t.coordinate_to_cell_key(t.cursor_coordinate).row_key
+
+        gone = [key for key in t.rows if key.value not in rows]
+        for key in gone:
+            t.remove_row(key)
+        added = False
+        for vid, row in rows.items():
+            if vid not in t.rows:
+                t.add_row(*row, key=vid)
+                added = True
+                continue
+            for column, old, new in zip(keys, t.get_row(vid), row):
+                if old != new:
+                    t.update_cell(vid, column, new)
+
+        # new rows go last - sort them in and put the cursor back on its node
+        if added:
+            t.sort("vmid", key=int)
+        if (added or gone) and selected is not None and selected in t.rows:
+            t.move_cursor(row=t.get_row_index(selected))
+
+        n = len(rows)
+        self._status(f"Ready — {n} node{'s' if n != 1 else ''}")
 
     @work(thread=True)
     def _refresh_image(self) -> None:
@@ -467,6 +544,13 @@ class DevboxTUI(App):
             )
             self.call_from_thread(self._status, "Session error — terminal restored", True)
 
+    def _picker_nodes(self) -> list[tuple[int, str, str]]:
+        """Nodes for a picker modal from the fleet store - logs why there are none."""
+        nodes = _fleet.node_list()
+        if not nodes:
+            self._log("[yellow]No nodes available[/]" if _fleet.loaded else "[yellow]Node list is still loading[/]")
+        return nodes
+
     # ── button handlers ───────────────────────────────────────────────────────
     # Simple commands: sync handler calls _run directly.
     # Modal commands: sync handler starts a @work async flow so that
@@ -476,6 +560,10 @@ class DevboxTUI(App):
     def h_img_create(self) -> None:
         self._run(['image', 'create'])
 
+    @on(Button.Pressed, "#img-update")
+    def h_img_update(self) -> None:
+        self._run(['image', 'update'])
+
     @on(Button.Pressed, "#img-info")
     def h_img_info(self) -> None:
         self._run(['image', 'info'])
@@ -506,9 +594,8 @@ class DevboxTUI(App):
 
     @work
     async def _flow_ssh(self) -> None:
-        nodes = _node_list()
+        nodes = self._picker_nodes()
         if not nodes:
-            self._log("[yellow]No nodes available[/]")
             return
         hostname = await self.push_screen_wait(NodePickerModal("SSH to node", nodes))
         if hostname:
@@ -520,9 +607,8 @@ class DevboxTUI(App):
 
     @work
     async def _flow_terminal(self) -> None:
-        nodes = _node_list()
+        nodes = self._picker_nodes()
         if not nodes:
-            self._log("[yellow]No nodes available[/]")
             return
         hostname = await self.push_screen_wait(NodePickerModal("Open terminal on node", nodes))
         if hostname:
@@ -534,9 +620,8 @@ class DevboxTUI(App):
 
     @work
     async def _flow_reboot(self) -> None:
-        nodes = _node_list()
+        nodes = self._picker_nodes()
         if not nodes:
-            self._log("[yellow]No nodes available[/]")
             return
         hostname = await self.push_screen_wait(NodePickerModal("Reboot node", nodes))
         if hostname:
@@ -548,9 +633,8 @@ class DevboxTUI(App):
 
     @work
     async def _flow_destroy(self) -> None:
-        nodes = _node_list()
+        nodes = self._picker_nodes()
         if not nodes:
-            self._log("[yellow]No nodes available[/]")
             return
         hostname = await self.push_screen_wait(NodePickerModal("Destroy node", nodes))
         if hostname:
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+# devboxd - keeps an authenticated connection and a fresh vm list for devbox.py and devbox_tui.py
+# run from the project root: python3 devboxd.py
+
+import os, sys
+sys.path[0:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')]
+from devbox_daemon import serve
+
+serve()
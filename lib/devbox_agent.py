@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# qemu guest agent session for one vm
+# readiness is polled with backoff up to a deadline, exec-status is polled at an
+# interval that grows with how long the command has been running, and several
+# commands can be run in one exec with an exit code each
+
+import time, shlex, secrets
+
+# raised when the agent cannot run a command
+class AgentError(Exception):
+  pass
+
+# raised when the agent or a command does not finish before its deadline
+class AgentTimeout(AgentError):
+  pass
+
+# output of one command
+class ExecResult:
+
+  def __init__(self, exitcode, out='', err=''):
+    self.exitcode = exitcode
+    self.out = out
+    self.err = err
+
+  def __repr__(self):
+    return f'ExecResult(exitcode={self.exitcode}, out={self.out!r}, err={self.err!r})'
+
+class AgentSession:
+
+  # agent ping backoff
+  ping_interval = 0.25
+  ping_max_interval = 2.0
+  ping_backoff = 1.5
+
+  # exec-status interval is a fraction of the command's run time, within these bounds
+  status_min_interval = 0.02
+  status_max_interval = 1.0
+  status_age_factor = 0.25
+
+  def __init__(self, prox, node, vmid, ready_deadline=30):
+    self.prox = prox
+    self.node = node
+    self.vmid = vmid
+    self.ready_deadline = ready_deadline
+    self.ready = False
+
+  # api resource for this vm's agent
+  @property
+  def agent(self):
+    return self.prox.nodes(self.node).qemu(self.vmid).agent
+
+  # wait until the agent answers a ping - only the first call pings
+  def wait_ready(self, deadline=None):
+    if self.ready:
+      return
+    deadline = self.ready_deadline if deadline is None else deadline
+    started = time.monotonic()
+    interval = self.ping_interval
+    while True:
+      try:
+        self.agent.ping.post()
+        self.ready = True
+        return
+      except Exception as e:
+        error = e
+
+      # give up once the next attempt would pass the deadline
+      if time.monotonic() - started + interval > deadline:
+        raise AgentTimeout(f'{self.vmid}: agent not responding on [{self.node}] after {deadline}s: {error}')
+      time.sleep(interval)
+      interval = min(self.ping_max_interval, interval * self.ping_backoff)
+
+  # run a shell command and wait for it - raises AgentError / AgentTimeout
+  def exec(self, cmd, timeout=None):
+    self.wait_ready()
+
+    # send command via qemu-agent exec (use sh -c for shell features)
+    try:
+      pid = self.agent.exec.post(command=f'sh -c {shlex.quote(cmd)}')['pid']
+    except Exception as e:
+      raise AgentError(f'{self.vmid}: problem running cmd: {cmd} - {e}')
+
+    # poll until the process has exited
+    started = time.monotonic()
+    while True:
+      try:
+        status = self.agent('exec-status').get(pid=pid)
+      except Exception as e:
+        raise AgentError(f'{self.vmid}: problem checking pid {pid}: {e}')
+      if status.get('exited'):
+        return ExecResult(int(status.get('exitcode', 0)), status.get('out-data', ''), status.get('err-data', ''))
+
+      running = time.monotonic() - started
+      if timeout is not None and running > timeout:
+        raise AgentTimeout(f'{self.vmid}: cmd did not finish after {timeout}s: {cmd}')
+      time.sleep(min(self.status_max_interval, max(self.status_min_interval, running * self.status_age_factor)))
+
+  # run several commands in one exec - returns an ExecResult per command
+  # commands run one after another in their own subshell, output is split on markers
+  def exec_many(self, cmds, timeout=None):
+    token = secrets.token_hex(4)
+    script = []
+    for i, cmd in enumerate(cmds):
+      script.append(f"printf '@@{token}:{i}\\n'; printf '@@{token}:{i}\\n' >&2")
+      script.append(f'( {cmd}\n)')
+      script.append(f"printf '\\n@@{token}:{i}:rc:%s\\n' \"$?\"")
+    result = self.exec('\n'.join(script), timeout)
+
+    # split stdout and stderr per command
+    outs = self._split(result.out, token, len(cmds))
+    errs = self._split(result.err, token, len(cmds))
+    return [ExecResult(rc, out, errs[i][1]) for i, (rc, out) in enumerate(outs)]
+
+  # (exit code, output) per command from marked output
+  def _split(self, data, token, count):
+    sections = [[None, []] for _ in range(count)]
+    current = None
+    for line in data.splitlines():
+      if line.startswith(f'@@{token}:'):
+        parts = line.split(':')
+        current = int(parts[1])
+        if len(parts) == 4:
+          sections[current][0] = int(parts[3])
+          current = None
+        continue
+      if current is not None:
+        sections[current][1].append(line)
+
+    # a command without an rc marker did not run - the script died before it
+    return [(-1 if rc is None else rc, '\n'.join(lines).strip()) for rc, lines in sections]
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# asyncio proxmox engine - runs alongside the proxmoxer based code
+# a small http/1.1 client with a keep-alive connection pool, the endpoints devbox
+# uses, and the clone / destroy / info flows as coroutines so one process can
+# drive many vm lifecycles at once
+
+import ssl, json, time, shlex, asyncio, secrets, urllib.parse
+
+# devbox
+from devbox_opts import opts
+from devbox_trace import span
+from devbox_calls import endpoint, record, replay
+
+# raised for non 2xx responses and broken connections
+class AioProxmoxError(Exception):
+
+  def __init__(self, status, reason, body=''):
+    self.status = status
+    self.reason = reason
+    self.body = body
+    super().__init__(f'{status} {reason}: {body}'.strip(': '))
+
+# http/1.1 connection pool for one host
+class ConnectionPool:
+
+  def __init__(self, host, port, scheme='https', verify_ssl=False, max_connections=16, timeout=5):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.idle = []
+    self.limit = asyncio.Semaphore(max_connections)
+    self.ssl = None
+    if scheme == 'https':
+      self.ssl = ssl.create_default_context()
+      if not verify_ssl:
+        self.ssl.check_hostname = False
+        self.ssl.verify_mode = ssl.CERT_NONE
+
+  # send a request and return (status, reason, headers, body)
+  # a pooled connection the server already closed is retried once on a new one
+  async def request(self, method, target, headers, body=b''):
+    async with self.limit:
+      for attempt in ['pooled', 'new']:
+        conn = self.idle.pop() if self.idle and attempt == 'pooled' else None
+        reused = conn is not None
+        if not conn:
+          conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+        reader, writer = conn
+        try:
+          head = [f'{method} {target} HTTP/1.1', f'Host: {self.host}:{self.port}', f'Content-Length: {len(body)}']
+          head += [f'{key}: {value}' for key, value in headers.items()]
+          writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+          await writer.drain()
+          response = await asyncio.wait_for(self._read(reader), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+          writer.close()
+          if reused:
+            continue
+          raise AioProxmoxError(0, 'connection failed', str(e))
+        except BaseException:
+          writer.close()
+          raise
+
+        # keep the connection unless the server asked to close it
+        if response[2].get('connection', '').lower() == 'close':
+          writer.close()
+        else:
+          self.idle.append(conn)
+        return response
+
+  # read one response - content-length or chunked body
+  async def _read(self, reader):
+    status_line = await reader.readline()
+    if not status_line:
+      raise asyncio.IncompleteReadError(b'', None)
+    parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    status, reason = int(parts[1]), parts[2] if len(parts) > 2 else ''
+    headers = {}
+    while True:
+      line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+      if not line:
+        break
+      key, _, value = line.partition(':')
+      headers[key.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      body = b''
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        chunk = await reader.readexactly(size + 2)
+        if not size:
+          break
+        body += chunk[:-2]
+    else:
+      body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, reason, headers, body
+
+  # close idle connections
+  async def close(self):
+    for reader, writer in self.idle:
+      writer.close()
+    self.idle = []
+
+# proxmox api client - paths are relative to /api2/json
+class AsyncProxmox:
+
+  def __init__(self, host, port=8006, user='root@pam', token_name='', token_value='', scheme='https', verify_ssl=False, max_connections=16, timeout=5):
+    self.pool = ConnectionPool(host, port, scheme, verify_ssl, max_connections, timeout)
+    self.auth = f'PVEAPIToken={user}!{token_name}={token_value}'
+
+  # run a request and return the data member of the response
+  async def request(self, method, path, **params):
+    relative = path.strip('/')
+    path = '/api2/json/' + '/'.join(urllib.parse.quote(str(part), safe='') for part in path.strip('/').split('/'))
+    headers = {'Authorization': self.auth, 'Accept': 'application/json'}
+    body = b''
+    if method in ['POST', 'PUT']:
+      body = urllib.parse.urlencode(params).encode()
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    elif params:
+      path += '?' + urllib.parse.urlencode(params)
+    with span('api', method=method, endpoint=endpoint(relative)) as current:
+      begin = time.perf_counter()
+      if opts.get('replay'):
+        status, reason, data = replay(method, relative, params)
+      else:
+        status, reason, _, data = await self.pool.request(method, path, headers, body)
+      record(method, relative, params, status, reason, data, time.perf_counter() - begin)
+      current['attrs'].update({'status': status, 'bytes': len(data)})
+    if not 200 <= status < 300:
+      raise AioProxmoxError(status, reason, data.decode(errors='replace'))
+    return json.loads(data or b'{}').get('data')
+
+  async def get(self, path, **params):
+    return await self.request('GET', path, **params)
+
+  async def post(self, path, **params):
+    return await self.request('POST', path, **params)
+
+  async def put(self, path, **params):
+    return await self.request('PUT', path, **params)
+
+  async def delete(self, path, **params):
+    return await self.request('DELETE', path, **params)
+
+  async def close(self):
+    await self.pool.close()
+
+  # cluster
+  async def cluster_resources(self, type='vm'):
+    return await self.get('cluster/resources', type=type)
+
+  # storage
+  async def storage_content(self, node, storage):
+    return await self.get(f'nodes/{node}/storage/{storage}/content')
+
+  # qemu
+  async def qemu_clone(self, node, vmid, newid, **params):
+    return await self.post(f'nodes/{node}/qemu/{vmid}/clone', newid=newid, **params)
+
+  async def qemu_config(self, node, vmid, **params):
+    if params:
+      return await self.post(f'nodes/{node}/qemu/{vmid}/config', **params)
+    return await self.get(f'nodes/{node}/qemu/{vmid}/config')
+
+  async def qemu_resize(self, node, vmid, disk, size):
+    return await self.put(f'nodes/{node}/qemu/{vmid}/resize', disk=disk, size=size)
+
+  async def qemu_status(self, node, vmid, action='current'):
+    if action == 'current':
+      return await self.get(f'nodes/{node}/qemu/{vmid}/status/current')
+    return await self.post(f'nodes/{node}/qemu/{vmid}/status/{action}')
+
+  async def qemu_delete(self, node, vmid):
+    return await self.delete(f'nodes/{node}/qemu/{vmid}')
+
+  # tasks - the node is read from the upid
+  async def task_status(self, upid):
+    return await self.get(f'nodes/{upid.split(":")[1]}/tasks/{upid}/status')
+
+  async def task_log(self, upid):
+    return '\n'.join(line['t'] for line in await self.get(f'nodes/{upid.split(":")[1]}/tasks/{upid}/log'))
+
+  # wait for a task - polled at a fraction of its age like devbox_tasks.TaskWaiter
+  # apis that run synchronously return None instead of a upid
+  async def wait_task(self, upid, min_interval=0.1, max_interval=2.0, age_factor=0.2):
+    if not upid:
+      return None
+    started = time.monotonic()
+    while True:
+      await asyncio.sleep(min(max_interval, max(min_interval, (time.monotonic() - started) * age_factor)))
+      status = await self.task_status(upid)
+      if status.get('status') == 'stopped':
+        break
+    if status.get('exitstatus') != 'OK':
+      raise AioProxmoxError(500, f'task exited with non-OK status ({status.get("exitstatus")})', await self.task_log(upid))
+    return status['exitstatus']
+
+  # guest agent
+  async def agent_ping(self, node, vmid):
+    return await self.post(f'nodes/{node}/qemu/{vmid}/agent/ping')
+
+  # wait for the agent with backoff like devbox_agent.AgentSession
+  async def agent_wait(self, node, vmid, deadline=30, interval=0.25, max_interval=2.0, backoff=1.5):
+    started = time.monotonic()
+    while True:
+      try:
+        return await self.agent_ping(node, vmid)
+      except AioProxmoxError as e:
+        if time.monotonic() - started + interval > deadline:
+          raise AioProxmoxError(e.status, f'{vmid}: agent not responding on [{node}] after {deadline}s', e.body)
+      await asyncio.sleep(interval)
+      interval = min(max_interval, interval * backoff)
+
+  # run a shell command through the agent - returns the exec-status data
+  async def agent_exec(self, node, vmid, cmd, min_interval=0.02, max_interval=1.0, age_factor=0.25):
+    pid = (await self.post(f'nodes/{node}/qemu/{vmid}/agent/exec', command=f'sh -c {shlex.quote(cmd)}'))['pid']
+    started = time.monotonic()
+    while True:
+      status = await self.get(f'nodes/{node}/qemu/{vmid}/agent/exec-status', pid=pid)
+      if status.get('exited'):
+        return status
+      await asyncio.sleep(min(max_interval, max(min_interval, (time.monotonic() - started) * age_factor)))
+
+# flows - devbox settings come from devbox_config, imported when a flow first runs
+
+# client for the configured cluster
+def connect(max_connections=16):
+  import devbox_config as cfg
+  return AsyncProxmox(
+    cfg.prox_endpoint,
+    port=cfg.port,
+    user=cfg.user,
+    token_name=cfg.token_name,
+    token_value=cfg.api_key,
+    max_connections=max_connections,
+    timeout=10)
+
+# clone the template to vmid - mirrors devbox_proxmox.clone
+async def clone(api, vmid, hostname, target=None):
+  import devbox_config as cfg
+  from devbox_probes import readiness_probes, probe_script, probe_results, check_results, probe_timeout, ProbeError
+  from devbox_phonehome import expect, phonehome_timeout
+  ip = f'{cfg.vmip(vmid)}/{cfg.network_mask}'
+  node = target or cfg.state.template['node']
+  source = cfg.template_copy(cfg.state.template, node)
+  placed = {'target': node} if node != source['node'] else {}
+  with span('clone.task', source=source['vmid']):
+    await api.wait_task(await api.qemu_clone(source['node'], source['vmid'], vmid, **placed))
+  callback = expect(vmid, node)
+  with span('clone.config'):
+    await api.wait_task(await api.qemu_config(node, vmid,
+      **({'cicustom': callback.cicustom} if callback else {}),
+      name=hostname,
+      onboot=1,
+      cores=cfg.vm_cpu,
+      memory=cfg.vm_ram * 1024,
+      balloon='0',
+      boot='order=scsi0',
+      net0=f'model=virtio,bridge={cfg.state.bridge},mtu={cfg.network_mtu}',
+      ipconfig0=f'gw={cfg.network_gw},ip={ip}',
+      nameserver=cfg.network_dns,
+      description=f'{vmid}:{hostname}:{ip}',
+      tags=cfg.source_tag(source['vmid']),
+    ))
+  with span('clone.resize'):
+    await api.wait_task(await api.qemu_resize(node, vmid, 'scsi0', f'{cfg.vm_disk}G'))
+  with span('clone.start'):
+    await api.wait_task(await api.qemu_status(node, vmid, 'start'))
+
+  # wait for the vm to report - the listener thread sets the event, so the wait runs in the executor
+  with span('clone.ready') as ready:
+    try:
+      ready['attrs']['via'] = 'phonehome'
+      if callback and await asyncio.get_running_loop().run_in_executor(None, callback.wait, hostname, phonehome_timeout) is not None:
+        return
+
+      # or for qemu-agent and run the readiness probes in one exec
+      ready['attrs']['via'] = 'agent'
+      await api.agent_wait(node, vmid, cfg.agent_timeout)
+      token = secrets.token_hex(4)
+      result = await asyncio.wait_for(api.agent_exec(node, vmid, probe_script(readiness_probes, probe_timeout, token)), probe_timeout + 10)
+      check_results(probe_results(result.get('out-data', ''), token, readiness_probes, probe_timeout), hostname)
+    except ProbeError as e:
+      raise AioProxmoxError(0, str(e))
+
+# power off and delete a vm
+async def destroy(api, vmid, node):
+  await api.wait_task(await api.qemu_status(node, vmid, 'stop'))
+  await api.wait_task(await api.qemu_delete(node, vmid))
+
+# (vmid, hostname, ip/mask, node) for every devbox in the range
+async def info(api):
+  import devbox_config as cfg
+  rows = []
+  for vm in await api.cluster_resources('vm'):
+    vmid = int(vm.get('vmid'))
+    if cfg.in_range(vmid) and vmid != cfg.dev_id:
+      rows.append((vmid, vm.get('name', ''), f'{cfg.vmip(vmid)}/{cfg.network_mask}', vm.get('node', '')))
+  return sorted(rows)
+
+# clone several nodes on one event loop - same results as devbox_proxmox.clone_many
+def clone_many(nodes: dict, parallel: int = 4, targets: dict = None):
+  import devbox_config as cfg
+  from devbox_phonehome import phonehome_address, snippet_storage
+  cfg.state.check_clone()
+
+  # the snippets storage is looked up once before the event loop starts
+  if phonehome_address:
+    snippet_storage()
+
+  async def run():
+    api = connect(max_connections=max(1, parallel))
+    limit = asyncio.Semaphore(max(1, parallel))
+
+    async def clone_one(vmid, hostname):
+      started = time.monotonic()
+      async with limit:
+        try:
+          with span('clone', vmid=vmid, hostname=hostname, aio=True):
+            await clone(api, vmid, hostname, (targets or {}).get(vmid))
+          error = ''
+        except Exception as e:
+          error = str(e).splitlines()[0] if str(e) else type(e).__name__
+
+        # a lookup that fails reports itself and exits - caught in the coroutine, so
+        # it ends this node and not the event loop and the batch with it
+        except SystemExit:
+          error = 'failed - see the error above'
+      return {
+        'vmid': vmid,
+        'hostname': hostname,
+        'ip': f'{cfg.vmip(vmid)}/{cfg.network_mask}',
+        'error': error,
+        'seconds': time.monotonic() - started,
+      }
+
+    try:
+      return await asyncio.gather(*[clone_one(vmid, hostname) for vmid, hostname in nodes.items()])
+    finally:
+      await api.close()
+
+  # the vms hold their slots now - give the reservations back
+  from devbox_reserve import release
+  try:
+    return asyncio.run(run())
+  finally:
+    for vmid in nodes:
+      release(vmid)
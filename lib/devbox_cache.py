@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# on-disk cache of cluster state between devbox runs
+# each section is stored with the time it was fetched and expires after its ttl
+
+import os, json, time, tempfile
+
+# kmsg
+from devbox_kmsg import kmsg
+
+# cache directory
+cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'devbox')
+
+# name of the files kept for one cluster and devbox range
+def cluster_key(prox_endpoint, dev_id):
+  return ''.join(c if c.isalnum() else '_' for c in prox_endpoint) + f'-{dev_id}'
+
+class StateCache:
+
+  def __init__(self, name, ttls, refresh=False):
+    self.path = os.path.join(cache_dir, f'{name}.json')
+    self.ttls = ttls
+    self.refresh = refresh
+    self._data = None
+
+  # load cache file once - a missing or corrupt file is an empty cache
+  @property
+  def data(self):
+    if self._data is None:
+      try:
+        with open(self.path) as cache_file:
+          self._data = json.load(cache_file)
+      except (OSError, ValueError):
+        self._data = {}
+    return self._data
+
+  # return a cached section or None if missing, expired or --refresh passed
+  def get(self, section):
+    if self.refresh:
+      return None
+    entry = self.data.get(section)
+    if not entry:
+      return None
+    if time.time() - entry['ts'] > self.ttls.get(section, 0):
+      return None
+    return entry['value']
+
+  # store a section and write the cache file
+  def put(self, section, value):
+    if not self.ttls.get(section, 0):
+      return
+    self.data[section] = {'ts': time.time(), 'value': value}
+    self.save()
+
+  # drop sections - all of them if none passed
+  def invalidate(self, *sections):
+    for section in sections or list(self.data):
+      self.data.pop(section, None)
+    self.save()
+
+  # write atomically so concurrent runs never read a partial file
+  def save(self):
+    try:
+      os.makedirs(cache_dir, exist_ok=True)
+      fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.state-')
+      with os.fdopen(fd, 'w') as cache_file:
+        json.dump(self.data, cache_file)
+      os.replace(tmp_path, self.path)
+    except OSError as e:
+      kmsg('devbox_cache', f'unable to write {self.path}: {e}', 'err')
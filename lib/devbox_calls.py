@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# proxmox api call accounting
+# every request made through state.prox or the asyncio client is recorded with its
+# method, endpoint, status, latency and response size, and timed as an api span of
+# devbox_trace. --calls prints a summary per endpoint when the command exits.
+#
+#   --record=path   save every request and its response to a json fixture
+#   --replay=path   answer requests from a fixture instead of the cluster - the
+#                   responses of an endpoint are replayed in order, the last one repeats
+
+import re, sys, json, time, atexit, threading
+
+# devbox
+from devbox_opts import opts
+from devbox_trace import span, percentile
+
+# {method, endpoint, status, ms, bytes} per request in the order they finished
+calls = []
+lock = threading.Lock()
+
+# requests and responses saved by --record
+recorded = []
+
+# (method, path): responses left to replay in the order they were recorded
+replays = {}
+loaded = False
+
+# recorded guest script marker: marker sent in this run
+markers = {}
+
+# fixture file of --record / --replay - devbox-fixture.json if no path is passed
+def fixture_path(value):
+  return value if isinstance(value, str) else 'devbox-fixture.json'
+
+# path relative to /api2/json with ids replaced eg nodes/pve/qemu/{id}/status/start
+def endpoint(path):
+  path = re.sub(r'UPID:[^/]+', '{upid}', path)
+  path = re.sub(r'/\d+(?=/|$)', '/{id}', path)
+  return re.sub(r'^pools/.+', 'pools/{poolid}', path)
+
+# params and response fields never written to a fixture eg cipassword, sshkeys,
+# the auth ticket and its csrf token
+secret = re.compile(r'password|sshkeys|token|ticket|secret', re.I)
+
+# a json value with every secret field masked
+def redact(value):
+  if isinstance(value, dict):
+    return {key: '***' if secret.search(key) else redact(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [redact(item) for item in value]
+  return value
+
+# params as a stable string - the key a request is replayed by. secrets are masked
+# here, so a replayed request matches its recording without them
+def params_key(params):
+  return json.dumps(redact({key: str(value) for key, value in (params or {}).items()}), sort_keys=True)
+
+# response body as saved to a fixture - a json body with its secrets masked
+def redact_body(body):
+  text = body.decode(errors='replace')
+  try:
+    return json.dumps(redact(json.loads(text)))
+  except ValueError:
+    return text
+
+# count one finished request, and save it with --record
+def record(method, path, params, status, reason, body, seconds):
+  with lock:
+    calls.append({'method': method, 'endpoint': endpoint(path), 'status': status, 'ms': seconds * 1000, 'bytes': len(body)})
+    if opts.get('record'):
+      recorded.append({'method': method, 'path': path, 'params': json.loads(params_key(params)), 'status': status, 'reason': reason, 'body': redact_body(body)})
+
+# load the --replay fixture into the replay queues - once per process
+def load_fixture(path):
+  global loaded
+  if loaded:
+    return
+  loaded = True
+  try:
+    with open(path) as f:
+      fixture = json.load(f)
+  except (OSError, ValueError) as e:
+    from devbox_kmsg import kmsg
+    kmsg('calls_replay', f'unable to read {path}: {e}', 'err')
+    exit(1)
+  for item in fixture['requests']:
+    replays.setdefault((item['method'], item['path']), []).append({**item, 'key': params_key(item['params'])})
+
+# (status, reason, body) for a request from the --replay fixture - the first response
+# recorded with the same params, else the next one of the path eg an exec with a new token.
+# guest scripts mark their output with a random @@<token> - the tokens of a recorded
+# request are swapped for the ones sent now in every response replayed after it
+def replay(method, path, params):
+  key = params_key(params)
+  with lock:
+    load_fixture(fixture_path(opts['replay']))
+    queue = replays.get((method, path))
+    if not queue:
+      return 501, f'{method} {path} is not in {fixture_path(opts["replay"])}', b'{"data": null}'
+    item = next((item for item in queue if item['key'] == key), queue[0])
+    if len(queue) > 1:
+      queue.remove(item)
+    if item['key'] != key:
+      markers.update(zip(re.findall(r'@@([0-9a-f]+)', item['key']), re.findall(r'@@([0-9a-f]+)', key)))
+    body = item['body']
+    for recorded_marker, marker in markers.items():
+      body = body.replace(f'@@{recorded_marker}', f'@@{marker}')
+    return item['status'], item['reason'], body.encode()
+
+# response for proxmoxer - the members its _request and serializer read
+class Replayed:
+
+  def __init__(self, status, reason, body):
+    self.status_code = status
+    self.reason = reason
+    self.content = body
+    self.text = body.decode(errors='replace')
+
+# account the requests of a proxmoxer api object - with --replay none reach the cluster
+def watch_calls(prox):
+  store = getattr(prox, '_store', None)
+  if not isinstance(store, dict) or 'session' not in store:
+    return
+  session = store['session']
+  request = session.request
+  if opts.get('replay'):
+    load_fixture(fixture_path(opts['replay']))
+
+  def counted_request(method, url, params=None, data=None, **kwargs):
+    path = url.split('/api2/json/', 1)[-1]
+    sent = {**(params or {}), **(data or {})}
+    with span('api', method=method, endpoint=endpoint(path)) as current:
+      begin = time.perf_counter()
+      if opts.get('replay'):
+        response = Replayed(*replay(method, path, sent))
+      else:
+        response = request(method, url, params=params, data=data, **kwargs)
+      record(method, path, sent, response.status_code, response.reason, response.content, time.perf_counter() - begin)
+      current['attrs'].update({'status': response.status_code, 'bytes': len(response.content)})
+    return response
+  session.request = counted_request
+
+# --calls table - one row per endpoint, most called first
+def summary(out=sys.stderr):
+  by_endpoint = {}
+  for call in calls:
+    by_endpoint.setdefault(f'{call["method"]} {call["endpoint"]}', []).append(call)
+  print(f'\n{"calls":>5} {"total ms":>9} {"p95 ms":>8} {"kB":>8}  endpoint', file=out)
+  for name, group in sorted(by_endpoint.items(), key=lambda item: (-len(item[1]), item[0])):
+    ms = sorted(call['ms'] for call in group)
+    print(f'{len(group):>5} {sum(ms):>9.1f} {percentile(ms, 95):>8.1f} {sum(call["bytes"] for call in group) / 1024:>8.1f}  {name}', file=out)
+  failed = sum(1 for call in calls if call['status'] >= 400)
+  print(f'{len(calls):>5} {sum(call["ms"] for call in calls):>9.1f} {"":>8} {sum(call["bytes"] for call in calls) / 1024:>8.1f}  total{f" - {failed} failed" if failed else ""}', file=out)
+
+# print the summary and save the fixture of this run
+@atexit.register
+def export():
+  if opts.get('calls'):
+    summary()
+  if opts.get('record') and recorded:
+    path = fixture_path(opts['record'])
+    try:
+      with open(path, 'w') as f:
+        json.dump({'command': sys.argv[1:], 'requests': recorded}, f, indent=1)
+    except OSError as e:
+      from devbox_kmsg import kmsg
+      kmsg('calls_record', f'unable to write {path}: {e}', 'err')
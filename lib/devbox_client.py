@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# devboxd client - talks to a running devboxd over its unix socket
+# only light imports here so the cli fast path starts quickly
+
+import os, json, socket
+from configparser import ConfigParser, Error as ConfigError
+
+# devbox
+from devbox_kmsg import kmsg
+from devbox_cache import cache_dir, cluster_key
+from devbox_shell import node_terminal, node_ssh, node_reboot
+
+# unix socket of the devboxd serving a cluster and devbox range
+def socket_path(key):
+  return os.path.join(cache_dir, f'devboxd-{key}.sock')
+
+# send one request - returns the response or None if devboxd is not running or fails
+def daemon_request(key, request, timeout=2):
+  path = socket_path(key)
+  if not os.path.exists(path):
+    return None
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(timeout)
+      sock.connect(path)
+      sock.sendall(json.dumps(request).encode() + b'\n')
+      data = b''
+      while not data.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+          break
+        data += chunk
+    response = json.loads(data)
+  except (OSError, ValueError):
+    return None
+  if 'error' in response:
+    kmsg('devboxd_error', response['error'], 'err')
+    return None
+  return response
+
+# answer nodes info / ssh / terminal / reboot through devboxd
+# returns False when devboxd cannot answer so the caller falls back to direct mode
+def fast_path(cmd, args, ini='devbox.ini'):
+
+  # socket is keyed by endpoint and dev_id - read straight from devbox.ini
+  config = ConfigParser()
+  config.read(ini)
+  try:
+    key = cluster_key(config.get('proxmox', 'prox_endpoint'), config.getint('devbox', 'dev_id'))
+  except (ConfigError, ValueError):
+    return False
+
+  # list nodes
+  if cmd == 'info':
+    response = daemon_request(key, {'op': 'info'})
+    if response is None:
+      return False
+    for vmid, vmnode, hostname, vmstatus in response['rows']:
+      kmsg(f'{vmid}_[{vmnode}]-{hostname}', f'{vmstatus}')
+    return True
+
+  # commands on one node - a hostname devboxd does not know is left to direct mode
+  hostname = args[0]
+  response = daemon_request(key, {'op': 'resolve', 'hostname': hostname, 'fresh': cmd == 'reboot'})
+  if not response or not response.get('vmid'):
+    return False
+  kmsg(f'nodes_{cmd}', hostname)
+  if cmd == 'terminal':
+    node_terminal(response['vmid'], response['user'], response['password'])
+  if cmd == 'ssh':
+    node_ssh(response['user'], response['ip'])
+  if cmd == 'reboot':
+    node_reboot(response['vmid'])
+  return True
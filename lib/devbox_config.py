@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 
-# external imports
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# external imports - proxmoxer / urllib3 are imported on first api use and
+# datetime by image create, so commands that never reach the api do not load them
 import urllib.parse
-import wget
-from datetime import datetime
-from proxmoxer import ProxmoxAPI
+from functools import cached_property
 
 # checks cmd line args file ops and processes
-import os, sys, subprocess, time
+import os, sys, subprocess, time, ipaddress
 
 # kmsg
 from devbox_kmsg import kmsg
 
+# command line --options and on-disk state cache
+from devbox_opts import opts
+from devbox_cache import StateCache, cluster_key
+from devbox_client import daemon_request
+from devbox_tasks import TaskWaiter
+from devbox_profile import watch_api
+from devbox_slots import SlotIndex
+
 # read ini file into config - look relative to this file's parent directory
 _config_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 from configparser import ConfigParser
@@ -48,6 +53,21 @@ def conf_check(section, value):
 
   return config_item
 
+# optional config item - default used if the option is missing
+def conf_opt(section, value, default):
+  if not devbox_config.has_option(section, value):
+    return default
+
+  # numeric if the default is
+  config_item = devbox_config.get(section, value)
+  if isinstance(default, (int, float)):
+    try:
+      return type(default)(config_item)
+    except ValueError:
+      kmsg(kname, f'[{section}]/{value} should be numeric: {config_item}', 'err')
+      exit(1)
+  return config_item
+
 # check config vars
 dev_id = conf_check('devbox', 'dev_id')
 if dev_id < 100:
@@ -70,6 +90,70 @@ vm_disk = conf_check('devbox', 'vm_disk')
 vm_cpu = conf_check('devbox', 'vm_cpu')
 vm_ram = conf_check('devbox', 'vm_ram')
 
+# number of clone pipelines run at once by a batch create - --parallel overrides
+create_parallel = conf_opt('devbox', 'create_parallel', 4)
+
+# seconds to wait for the guest agent of a booting vm
+agent_timeout = conf_opt('devbox', 'agent_timeout', 30)
+
+# devbox range - the template slot at dev_id and max_nodes devbox slots after it
+max_nodes = conf_opt('devbox', 'max_nodes', 9)
+range_end = dev_id + max_nodes + 1
+
+# vmid is in the devbox range
+def in_range(vmid):
+  return dev_id <= vmid < range_end
+
+# node placement of new devboxes - spread, pack or pinned to [proxmox] node
+# placement_nodes limits the nodes considered, blank for every online node
+placement = conf_opt('devbox', 'placement', 'pinned')
+placement_nodes = conf_opt('devbox', 'placement_nodes', '').split()
+
+# nodes rebalance - spread of node scores tolerated before devboxes are moved and
+# the number of live migrations run at once ( --parallel overrides )
+rebalance_threshold = conf_opt('devbox', 'rebalance_threshold', 0.1)
+rebalance_parallel = conf_opt('devbox', 'rebalance_parallel', 2)
+
+# seconds a slot reservation outlives a nodes create that died holding it
+reservation_ttl = conf_opt('devbox', 'reservation_ttl', 900)
+
+# number of pre-cloned vms kept booted for nodes create to claim - 0 disables the pool
+warm_pool = conf_opt('devbox', 'warm_pool', 0)
+
+# cloud image download - parallel range requests and the checksum file published
+# next to the image ( blank skips verification )
+download_parallel = conf_opt('image', 'download_parallel', 1)
+checksum_file = conf_opt('image', 'checksum_file', 'SHA256SUMS')
+
+# gib of customized images kept in the image cache - least recently used are evicted
+image_cache_size = conf_opt('image', 'cache_size', 20)
+
+# reserved names of pool vms - ready to claim and still being cloned
+pool_name = 'devbox-pool'
+pool_warming_name = 'devbox-pool-warming'
+
+# reserved name of the throwaway clone a new template is test booted in
+validate_name = 'devbox-validate'
+reserved_names = [pool_name, pool_warming_name, validate_name]
+
+# template generations are tagged with template_tag and gen-<n> - the highest
+# generation that also carries ready_tag is the one nodes are cloned from
+template_tag = f'devbox-tpl-{dev_id}'
+ready_tag = 'devbox-ready'
+
+# tag of a devbox cloned from the template at vmid - old generations are kept while in use
+def source_tag(vmid):
+  return f'devbox-src-{vmid}'
+
+# with local storage a template is copied to other nodes as a replica - a template
+# tagged replica_tag as well, with the generation of the template it was copied from
+replica_tag = 'devbox-replica'
+
+# {vmid, node} of the copy of template to clone on vm_node - the replica there, or the template itself
+def template_copy(template, vm_node):
+  replica = template.get('replicas', {}).get(vm_node)
+  return {'vmid': replica, 'node': vm_node} if replica else template
+
 # cloudinit
 cloudinituser = conf_check('devbox', 'cloudinituser')
 cloudinitpass = conf_check('devbox', 'cloudinitpass')
@@ -89,165 +173,397 @@ network_dns = conf_check('devbox', 'network_dns')
 network_bridge = conf_check('devbox', 'network_bridge')
 network_mtu = conf_check('devbox', 'network_mtu')
 
-# variables for network and its IP for vmip function
-network_octs = network_ip.split('.')
-network_base = f'{network_octs[0]}.{network_octs[1]}.{network_octs[2]}.'
-network_ip_prefix = int(network_octs[-1])
-
-# dict of all config items - legacy support
-config = ({s: dict(devbox_config.items(s)) for s in devbox_config.sections()})
-
-# proxmox api connection
+# devbox addresses - network_ip for the template slot and one per devbox slot after it
+# all of them have to be usable addresses of the network and leave the gateway out
 try:
-  prox = ProxmoxAPI(
-    prox_endpoint,
-    port=port,
-    user=user,
-    token_name=token_name,
-    token_value=api_key,
-    verify_ssl=False,
-    timeout=5)
-
-  # check connection to cluster
-  prox.cluster.status.get()
-
-except Exception as e:
-  kmsg(kname, f'API connection to {prox_endpoint}:{port} failed - check [proxmox] settings: {e}', 'err')
+  network = ipaddress.ip_network(f'{network_ip}/{network_mask}', strict=False)
+  network_first = ipaddress.ip_address(network_ip)
+  network_last = network_first + max_nodes
+except ValueError as e:
+  kmsg(kname, f'[devbox]/network_ip, network_mask or max_nodes invalid: {e}', 'err')
   exit(1)
-
-# look up devbox_img name
-def devbox_img():
-
-  # list contents
-  for image in prox.nodes(node).storage(storage).content.get():
-
-    # map image_name
-    image_name = image.get("volid", "")
-
-    # if dev_id-disk-0 found in volid
-    if f'{dev_id}-disk-0' in image_name:
-      return image_name
-
-  # unable to find image name
-  return False
-
-# init dict
-vmids = {}
-vmnames = {}
-
-# get all vms running on proxmox
-for vm in prox.cluster.resources.get(type='vm'):
-
-  # map id
-  vmid = int(vm.get('vmid'))
-
-  # if vmid is in devbox config range ie between dev_id and dev_id + 10
-  # add vmid and node to dict
-  if (vmid >= dev_id) and (vmid < (dev_id + 10)):
-    vmids[vmid] = vm.get('node')
-    vmnames[vmid] = vm.get('name')
-
-# return sorted dict
-vms = dict(sorted(vmids.items()))
-
-# returns vmstatus
-def vm_info(vmid, node=node):
-  return prox.nodes(node).qemu(vmid).status.current.get()
-
-# get list of nodes
-discovered_nodes = [n.get('node', None) for n in prox.nodes.get()]
-
-# if node not in list of nodes
-if node not in discovered_nodes:
-  kmsg(kname, f'"{node}" not found - discovered nodes: {discovered_nodes}', 'err')
+if network_last not in network or network_last == network.broadcast_address:
+  kmsg(kname, f'{max_nodes} devboxes from {network_ip} do not fit in {network} - lower [devbox]/max_nodes or widen network_mask', 'err')
   exit(1)
-
-# get list of storage in the cluster
-storage_list = prox.nodes(node).storage.get()
-
-# detect storage type
-storage_type = None
-for local_storage in storage_list:
-  if storage == local_storage.get("storage"):
-    storage_type = 'shared' if local_storage.get("shared") else 'local'
-    break
-
-# if no storage_type, no matched storage was found
-if storage_type is None:
-  kmsg(kname, f'"{storage}" not found. discovered storage:', 'err')
-  for discovered_storage in storage_list:
-    print(' - ' + discovered_storage.get("storage"))
+try:
+  if network_first < ipaddress.ip_address(network_gw) <= network_last:
+    kmsg(kname, f'[devbox]/network_gw {network_gw} is inside the devbox addresses {network_first}-{network_last}', 'err')
+    exit(1)
+except ValueError as e:
+  kmsg(kname, f'[devbox]/network_gw invalid: {e}', 'err')
   exit(1)
 
-# check configured bridge exists or is a sdn vnet
-# configured bridge does not contain the string 'sdn/'
-if 'sdn/' not in network_bridge:
+# dict of all config items - legacy support
+config = ({s: dict(devbox_config.items(s)) for s in devbox_config.sections()})
 
-  # discover available traditional bridges
-  discovered_bridges = [bridge.get('iface', None) for bridge in prox.nodes(node).network.get(type='bridge')]
+# cache ttl in seconds for each group of cached lookups - 0 disables caching
+resources_ttl = conf_opt('cache', 'resources_ttl', 300)
+discovery_ttl = conf_opt('cache', 'discovery_ttl', 86400)
+image_ttl = conf_opt('cache', 'image_ttl', 3600)
+
+# state cache file per cluster and devbox range
+cache = StateCache(
+  f'state-{cluster_key(prox_endpoint, dev_id)}',
+  {
+    'resources': resources_ttl,
+    'nodes': discovery_ttl,
+    'storage': discovery_ttl,
+    'bridges': discovery_ttl,
+    'image': image_ttl,
+  },
+  refresh=bool(opts.get('refresh')))
+
+# lazily evaluated cluster state
+# each property makes its api calls on first access and is memoized after that,
+# so a verb only pays for the lookups it actually uses
+class DevboxState:
+
+  # cache section: memoized properties derived from it
+  derived = {
+    'resources': ['resources', 'vms', 'vmnames', 'vmids', 'slots', 'templates', 'template'],
+    'nodes': ['discovered_nodes', 'node'],
+    'storage': ['storage_list', 'storage_type'],
+    'bridges': ['discovered_bridges', 'bridge'],
+    'image': ['template_config', 'image_volid', 'devbox_image_name', 'cloud_image_size', 'cloud_image_desc'],
+  }
+
+  def __init__(self):
+
+    # sections answered from the state cache rather than the api
+    self.from_cache = set()
+
+    # tell a running devboxd when the vm list changes - off inside devboxd itself
+    self.notify_daemon = True
+
+  # run an api request - report a connection problem the same way for every lookup
+  def api(self, request):
+    try:
+      return request()
+    except Exception as e:
+      kmsg(kname, f'API request to {prox_endpoint}:{port} failed - check [proxmox] settings: {e}', 'err')
+      exit(1)
 
-# sdn bridges / zones
-else:
-  # check we can map zone and get vnets
-  try:
-    sdn_params = network_bridge.split('/')
-    if not sdn_params[1] or not sdn_params[2]:
-      kmsg(kname, f'invalid sdn config - expected sdn/zone/vnet: "{network_bridge}"', 'err')
+  # answer from the state cache or run the api request and cache the result
+  def cached(self, section, request):
+    value = cache.get(section)
+    if value is None:
+      value = self.api(request)
+      cache.put(section, value)
+    else:
+      self.from_cache.add(section)
+    return value
+
+  # drop cached sections so they are fetched again - all of them if none passed
+  def refresh(self, *sections):
+    cache.invalidate(*sections)
+    for section in sections or self.derived:
+      self.from_cache.discard(section)
+      for attr in self.derived[section]:
+        self.__dict__.pop(attr, None)
+    if self.notify_daemon and (not sections or 'resources' in sections):
+      daemon_request(cluster_key(prox_endpoint, dev_id), {'op': 'refresh'})
+
+  # proxmox api connection - token auth so no request is made until first use
+  @cached_property
+  def prox(self):
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    from proxmoxer import ProxmoxAPI
+    try:
+      prox = ProxmoxAPI(
+        prox_endpoint,
+        port=port,
+        user=user,
+        token_name=token_name,
+        token_value=api_key,
+        verify_ssl=False,
+        timeout=5)
+    except Exception as e:
+      kmsg(kname, f'API connection to {prox_endpoint}:{port} failed - check [proxmox] settings: {e}', 'err')
       exit(1)
-    zone = sdn_params[1]
-    network_bridge = sdn_params[2]
-  except IndexError:
-    kmsg(kname, f'unable to parse sdn config: "{network_bridge}"', 'err')
-    exit(1)
 
-  # discover available sdn bridges
-  discovered_bridges = [bridge.get('vnet', None) for bridge in prox.nodes(node).sdn.zones(zone).content.get()]
+    # requests are counted, and recorded or replayed with --record / --replay
+    # DEVBOX_PROFILE_STARTUP=1 times the first request
+    from devbox_calls import watch_calls
+    watch_calls(prox)
+    watch_api(prox)
+    return prox
+
+  # shared task waiter - every proxmox task in the process is polled by one thread
+  @cached_property
+  def tasks(self):
+    return TaskWaiter(self.prox)
+
+  # all vms in the cluster
+  @cached_property
+  def resources(self):
+    return self.cached('resources', lambda: self.prox.cluster.resources.get(type='vm'))
+
+  # vmid: node for vms in the devbox range ie between dev_id and dev_id + max_nodes
+  @cached_property
+  def vms(self):
+    vmids = {}
+    for vm in self.resources:
+      vmid = int(vm.get('vmid'))
+      if in_range(vmid):
+        vmids[vmid] = vm.get('node')
+
+    # return sorted dict
+    return dict(sorted(vmids.items()))
+
+  # vmid: name for vms in the devbox range
+  @cached_property
+  def vmnames(self):
+    return {int(vm.get('vmid')): vm.get('name') for vm in self.resources if int(vm.get('vmid')) in self.vms}
+
+  # name: vmid for vms in the devbox range - the lowest vmid for a repeated name
+  @cached_property
+  def vmids(self):
+    return {name: vmid for vmid, name in sorted(self.vmnames.items(), reverse=True)}
+
+  # used and free devbox slots - each is a vmid and the ip derived from it
+  @cached_property
+  def slots(self):
+    return SlotIndex(dev_id + 1, max_nodes, self.vms)
+
+  # get list of nodes
+  @cached_property
+  def discovered_nodes(self):
+    return self.cached('nodes', lambda: [n.get('node', None) for n in self.prox.nodes.get()])
+
+  # configured node - checked against the list of nodes, refetched once if cached
+  @cached_property
+  def node(self):
+    if node not in self.discovered_nodes and 'nodes' in self.from_cache:
+      self.refresh('nodes')
+    if node not in self.discovered_nodes:
+      kmsg(kname, f'"{node}" not found - discovered nodes: {self.discovered_nodes}', 'err')
+      exit(1)
+    return node
+
+  # get list of storage on the node
+  @cached_property
+  def storage_list(self):
+    return self.cached('storage', lambda: self.prox.nodes(node).storage.get())
+
+  # detect storage type - refetch the storage list once if not found
+  @cached_property
+  def storage_type(self):
+    if storage not in [s.get('storage') for s in self.storage_list] and 'storage' in self.from_cache:
+      self.refresh('storage')
+    for local_storage in self.storage_list:
+      if storage == local_storage.get("storage"):
+        return 'shared' if local_storage.get("shared") else 'local'
+
+    # no matched storage was found
+    kmsg(kname, f'"{storage}" not found. discovered storage:', 'err')
+    for discovered_storage in self.storage_list:
+      print(' - ' + discovered_storage.get("storage"))
+    exit(1)
 
-# check configured bridge is in list
-if network_bridge not in discovered_bridges:
-  kmsg(kname, f'"{network_bridge}" not found. valid bridges: {discovered_bridges}', 'err')
-  exit(1)
+  # sdn zone or None for a traditional bridge
+  @cached_property
+  def zone(self):
 
-# dummy cloud_image_vars overwritten below
-cloud_image_size = 0
-cloud_image_desc = ''
+    # configured bridge does not contain the string 'sdn/'
+    if 'sdn/' not in network_bridge:
+      return None
 
-# skip image check if image create is passed
-if not (len(sys.argv) > 2 and sys.argv[1] == 'image' and sys.argv[2] == 'create'):
+    # check we can map zone and vnet
+    try:
+      sdn_params = network_bridge.split('/')
+      if not sdn_params[1] or not sdn_params[2]:
+        kmsg(kname, f'invalid sdn config - expected sdn/zone/vnet: "{network_bridge}"', 'err')
+        exit(1)
+      return sdn_params[1]
+    except IndexError:
+      kmsg(kname, f'unable to parse sdn config: "{network_bridge}"', 'err')
+      exit(1)
 
-  # check image exists
-  devbox_image_name = devbox_img()
-  if not devbox_image_name:
-    kmsg(kname, 'image not found - please run "devbox image create"', 'err')
-    exit(1)
+  # discover available traditional bridges or sdn vnets
+  @cached_property
+  def discovered_bridges(self):
+    if not self.zone:
+      return self.cached('bridges', lambda: [bridge.get('iface', None) for bridge in self.prox.nodes(node).network.get(type='bridge')])
+    return self.cached('bridges', lambda: [bridge.get('vnet', None) for bridge in self.prox.nodes(node).sdn.zones(self.zone).content.get()])
+
+  # configured bridge or sdn vnet - checked against the discovered bridges, refetched once if cached
+  @cached_property
+  def bridge(self):
+    bridge = network_bridge.split('/')[2] if self.zone else network_bridge
+    if bridge not in self.discovered_bridges and 'bridges' in self.from_cache:
+      self.refresh('bridges')
+    if bridge not in self.discovered_bridges:
+      kmsg(kname, f'"{bridge}" not found. valid bridges: {self.discovered_bridges}', 'err')
+      exit(1)
+    return bridge
+
+  # generation: {vmid, node, ready, replicas} for every devbox template in the cluster
+  # templates are built outside the devbox range - clones there inherit the tags
+  # for a moment. a template at dev_id without tags is generation 0 from before tagging.
+  # replicas is node: vmid of the finished copies of a generation on other nodes - a
+  # copy still being made carries the ready tag of its source but is no template yet
+  @cached_property
+  def templates(self):
+    templates = {}
+    replicas = {}
+    for vm in self.resources:
+      tags = (vm.get('tags') or '').split(';')
+      vmid = int(vm.get('vmid'))
+      devbox = in_range(vmid) and vmid != dev_id
+      if template_tag in tags and not devbox:
+        gens = [int(tag[4:]) for tag in tags if tag.startswith('gen-') and tag[4:].isdigit()]
+        generation = gens[0] if gens else 0
+        ready = ready_tag in tags and bool(vm.get('template'))
+        if replica_tag in tags:
+          if ready:
+            replicas.setdefault(generation, {})[vm.get('node')] = vmid
+        elif ready or ready_tag not in tags:
+          templates[generation] = {'vmid': vmid, 'node': vm.get('node'), 'ready': ready}
+      elif vmid == dev_id and vm.get('template'):
+        templates.setdefault(0, {'vmid': dev_id, 'node': vm.get('node'), 'ready': True})
+    for generation, template in templates.items():
+      template['replicas'] = dict(sorted(replicas.get(generation, {}).items()))
+    return dict(sorted(templates.items()))
+
+  # template nodes are cloned from - the highest ready generation or None
+  @cached_property
+  def template(self):
+    ready = [gen for gen, template in self.templates.items() if template['ready']]
+    if not ready:
+      return None
+    return {'generation': max(ready), **self.templates[max(ready)]}
+
+  # config of the current template - cached with its vmid so a new generation is fetched
+  @cached_property
+  def template_config(self):
+    template = self.template
+    if not template:
+      return None
+    cached = cache.get('image')
+    if cached and cached.get('vmid') == template['vmid']:
+      self.from_cache.add('image')
+      return cached['config']
+    config = self.api(lambda: self.prox.nodes(template['node']).qemu(template['vmid']).config.get())
+    cache.put('image', {'vmid': template['vmid'], 'config': config})
+    return config
+
+  # look up devbox image volid from the template's boot disk - False if not found
+  @cached_property
+  def image_volid(self):
+    if not self.template_config or 'scsi0' not in self.template_config:
+      return False
+    return self.template_config['scsi0'].split(',')[0]
+
+  # checked devbox image name
+  @cached_property
+  def devbox_image_name(self):
+    if not self.image_volid:
+      kmsg(kname, 'image not found - please run "devbox image create"', 'err')
+      exit(1)
+    return self.image_volid
 
-  # get image info
-  try:
-    cloud_image_data = prox.nodes(node).storage(storage).content(devbox_image_name).get()
+  # image size in G - checked against configured disk
+  @cached_property
+  def cloud_image_size(self):
+    self.devbox_image_name
+    try:
+      cloud_image_size = disk_size_gib(self.template_config['scsi0'])
+    except ValueError as e:
+      kmsg(kname, f'failed to get image info: {e}', 'err')
+      exit(1)
 
     # check image not too large for configured disk
-    cloud_image_size = int(cloud_image_data['size'] / 1073741824)
     if cloud_image_size > vm_disk:
       kmsg(kname, f'image size ({cloud_image_size}G) is greater than configured vm_disk ({vm_disk}G)', 'err')
       exit(1)
+    return cloud_image_size
+
+  # get image created and desc from template
+  @cached_property
+  def cloud_image_desc(self):
+    self.devbox_image_name
+    return self.template_config.get('description', '')
+
+  # checks needed before cloning a node - image is False when cloning a template being built
+  def check_clone(self, image=True):
+    self.node
+    self.storage_type
+    self.bridge
+    if image:
+      self.cloud_image_size
+
+# whole gib of a disk from its config string eg local-lvm:base-600-disk-0,size=2252M
+def disk_size_gib(disk):
+  units = {'K': 1 / 1048576, 'M': 1 / 1024, 'G': 1, 'T': 1024}
+  for option in disk.split(','):
+    if option.startswith('size='):
+      size = option[5:]
+      if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+      return int(int(size) / 1073741824)
+  raise ValueError(f'no size in {disk}')
+
+# shared state - nothing is looked up until a verb asks for it
+state = DevboxState()
+
+# legacy module attributes eg devbox_config.vms resolve through state
+def __getattr__(name):
+  if name in DevboxState.__dict__:
+    return getattr(state, name)
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+# vmid for a hostname - the vm list is refetched once if the name is not in cached state
+def hostname_vmid(hostname):
+  if hostname in reserved_names:
+    return None
+  if hostname in state.vmids:
+    return state.vmids[hostname]
+
+  # not found in cached state - refetch
+  if 'resources' in state.from_cache:
+    state.refresh('resources')
+    return hostname_vmid(hostname)
+  return None
+
+# reserve the lowest free ids in the devbox range for count nodes - ids freed by
+# destroyed nodes are reused. the reservation holds across processes and hosts
+# until the clone has created the vm
+def next_ids(count):
+  from devbox_reserve import reserve_slots, release
+  ids = reserve_slots(count)
+  if len(ids) < count:
+    for vmid in ids:
+      release(vmid)
+    kmsg(kname, f'not enough free ids for {count} nodes - {len(ids)} of {max_nodes} free in the devbox range {dev_id + 1}-{range_end - 1}', 'err')
+    exit(1)
+  return ids
+
+# reserve the highest free id in the devbox range for a vm an image build boots -
+# nodes are given ids from the bottom so the two only meet when the range is full
+def spare_id(ttl=reservation_ttl):
+  from devbox_reserve import reserve_slots
+  ids = reserve_slots(1, ttl, spare=True)
+  if not ids:
+    kmsg(kname, f'no free id in the devbox range {dev_id + 1}-{range_end - 1} to test boot the image', 'err')
+    exit(1)
+  return ids[0]
 
-    # get image created and desc from template
-    template_data = prox.nodes(node).qemu(dev_id).config.get()
-    cloud_image_desc = template_data['description']
+# look up devbox_img name
+def devbox_img():
+  return state.image_volid
 
-  except Exception as e:
-    kmsg(kname, f'failed to get image info: {e}', 'err')
-    exit(1)
+# returns vmstatus
+def vm_info(vmid, node=node):
+  return state.prox.nodes(node).qemu(vmid).status.current.get()
 
-# end of checks
 # functions used in other code
 
 # return ip for vmid
 def vmip(vmid: int):
-  # last number of network + ( vmid - dev_id )
-  # eg 160 + ( 601 - 600 ) = 161
-  ip = f'{network_base}{(network_ip_prefix + (vmid - dev_id))}'
-  return ip
+  # network_ip + ( vmid - dev_id )
+  # eg 192.168.0.160 + ( 601 - 600 ) = 192.168.0.161
+  return str(network_first + (vmid - dev_id))
 
 # run local os process
 def local_os_process(cmd):
@@ -266,13 +582,37 @@ def local_os_process(cmd):
 # print image info
 def image_info():
   kname = 'image_'
-  kmsg(f'{kname}desc', cloud_image_desc)
-  kmsg(f'{kname}storage', f'{devbox_image_name} ({storage_type})')
+  image_name = state.devbox_image_name
+  kmsg(f'{kname}desc', state.cloud_image_desc)
+  kmsg(f'{kname}storage', f'{image_name} ({state.storage_type})')
+
+  # every generation - older ones are kept while linked clones still use them
+  for generation, template in state.templates.items():
+    current = ' current' if generation == state.template['generation'] else ''
+    status = 'ready' if template['ready'] else 'building'
+    kmsg(f'{kname}gen-{generation}', f'{template["vmid"]} [{template["node"]}] {status}{current}')
+    for replica_node, replica in template['replicas'].items():
+      kmsg(f'{kname}gen-{generation}', f'{replica} [{replica_node}] replica')
+
+# vmid: node of every template generation and its replicas
+def template_nodes():
+  nodes = {}
+  for template in state.templates.values():
+    nodes[template['vmid']] = template['node']
+    nodes.update({vmid: replica_node for replica_node, vmid in template['replicas'].items()})
+  return nodes
+
+# [vmid, node, hostname, ip/mask] for each devbox - template, pool and validation vms are left out
+def devbox_rows():
+  rows = []
+  template_ids = list(template_nodes()) + [dev_id]
+  for vmid, vmnode in state.vms.items():
+    hostname = state.vmnames[vmid]
+    if vmid not in template_ids and hostname not in reserved_names:
+      rows.append([vmid, vmnode, hostname, f'{vmip(vmid)}/{network_mask}'])
+  return rows
 
 # devbox info
 def devbox_info():
-  for vmid in vms:
-    if not dev_id == vmid:
-      hostname = vmnames[vmid]
-      vmstatus = f'{vmip(vmid)}/{network_mask}'
-      kmsg(f'{vmid}_[{vms[vmid]}]-{hostname}', f'{vmstatus}')
+  for vmid, vmnode, hostname, vmstatus in devbox_rows():
+    kmsg(f'{vmid}_[{vmnode}]-{hostname}', f'{vmstatus}')
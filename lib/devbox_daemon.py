@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# devboxd - long lived process holding one authenticated api connection and a
+# continuously refreshed vm list, answering the cli and tui over a unix socket
+
+import json, signal, threading, socketserver
+
+# devbox
+from devbox_config import *
+from devbox_cache import cache_dir, cluster_key
+from devbox_client import socket_path, daemon_request
+
+# seconds between vm list refreshes
+refresh_interval = conf_opt('daemon', 'refresh_interval', 10)
+
+# state is shared by the refresher and every connection
+lock = threading.Lock()
+last_refresh = 0
+
+# refetch the vm list - called with lock held
+def refresh():
+  global last_refresh
+  state.refresh('resources')
+  state.resources
+  last_refresh = time.monotonic()
+
+# answer one request
+def handle(request):
+  op = request.get('op')
+  with lock:
+
+    # is devboxd running
+    if op == 'ping':
+      return {'pid': os.getpid(), 'age': time.monotonic() - last_refresh}
+
+    # the vm list changed - sent by direct mode after create / destroy
+    if op == 'refresh':
+      refresh()
+      return {'vms': len(state.vms)}
+
+    # nodes info rows
+    if op == 'info':
+      return {'rows': devbox_rows()}
+
+    # hostname to vmid / ip - an unknown name refetches the vm list at most once a second
+    # fresh refetches it first - reboot acts on the vm, and a vmid may have been reused
+    if op == 'resolve':
+      if request.get('fresh'):
+        refresh()
+      vmid = hostname_vmid(request.get('hostname'))
+      if not vmid and time.monotonic() - last_refresh > 1:
+        refresh()
+        vmid = hostname_vmid(request.get('hostname'))
+      if not vmid:
+        return {'vmid': None}
+      return {
+        'vmid': vmid,
+        'node': state.vms[vmid],
+        'ip': vmip(vmid),
+        'user': cloudinituser,
+        'password': cloudinitpass,
+      }
+
+  return {'error': f'unknown op: {op}'}
+
+# one json request line in, one json response line out
+class Handler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    try:
+      response = handle(json.loads(self.rfile.readline()))
+
+    # api failures exit inside devbox_config - keep serving
+    except (Exception, SystemExit) as e:
+      response = {'error': f'{type(e).__name__}: {e}'}
+    self.wfile.write(json.dumps(response).encode() + b'\n')
+
+# refresh the vm list in the background
+def refresher():
+  while True:
+    time.sleep(refresh_interval)
+    try:
+      with lock:
+        refresh()
+    except (Exception, SystemExit) as e:
+      kmsg('devboxd_refresh', f'vm list refresh failed: {e}', 'err')
+
+# run devboxd in the foreground until interrupted
+def serve():
+  kname = 'devboxd_serve'
+  key = cluster_key(prox_endpoint, dev_id)
+  path = socket_path(key)
+
+  # only one devboxd per cluster and devbox range
+  if daemon_request(key, {'op': 'ping'}):
+    kmsg(kname, f'devboxd already running on {path}', 'err')
+    exit(1)
+
+  # devboxd answers from its own state, never from a notify to itself
+  state.notify_daemon = False
+  with lock:
+    refresh()
+
+  # socket readable by this user only - resolve answers include the cloudinit password
+  os.makedirs(cache_dir, exist_ok=True)
+  if os.path.exists(path):
+    os.remove(path)
+  os.umask(0o077)
+  server = socketserver.ThreadingUnixStreamServer(path, Handler)
+  server.daemon_threads = True
+  threading.Thread(target=refresher, name='devboxd-refresh', daemon=True).start()
+
+  # remove the socket on exit
+  signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+  kmsg(kname, f'{path} - {len(state.vms)} vms, refreshing every {refresh_interval}s', 'sys')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if os.path.exists(path):
+      os.remove(path)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# cloud image download
+# requests are conditional on the etag / last-modified of the copy already on disk,
+# an interrupted download is resumed from its .part file, large files can be fetched
+# with parallel range requests and the sha256 is computed while the data arrives
+# and checked against the checksum file published next to the image
+
+import os, json, time, hashlib, threading
+import requests
+
+# read / write size and the minimum size worth splitting into ranges
+chunk_size = 1024 * 1024
+min_range_size = 8 * chunk_size
+
+# raised when the image cannot be downloaded or fails verification
+class DownloadError(Exception):
+  pass
+
+# sha256 of name in a SHA256SUMS style file next to url - None if there is none
+def upstream_sha256(url, checksum_file='SHA256SUMS', timeout=30):
+  if not checksum_file:
+    return None
+  name = url.rsplit('/', 1)[-1]
+  try:
+    response = requests.get(f'{url.rsplit("/", 1)[0]}/{checksum_file}', timeout=timeout)
+  except requests.RequestException:
+    return None
+  if response.status_code != 200:
+    return None
+
+  # lines are "<sha256> *<name>" or "<sha256>  <name>"
+  for line in response.text.splitlines():
+    parts = line.split()
+    if len(parts) == 2 and parts[1].lstrip('*') == name:
+      return parts[0].lower()
+  return None
+
+# metadata kept next to a download - url, validators and verified sha256
+def read_meta(path):
+  try:
+    with open(f'{path}.json') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def write_meta(path, meta):
+  with open(f'{path}.json.tmp', 'w') as f:
+    json.dump(meta, f)
+  os.replace(f'{path}.json.tmp', f'{path}.json')
+
+# validators of a response used for conditional and resumed requests
+def validators(response):
+  return {key: response.headers[header] for key, header in [('etag', 'ETag'), ('last_modified', 'Last-Modified')] if header in response.headers}
+
+# progress line - printed at most once a second
+class Progress:
+
+  def __init__(self, total, done=0, quiet=False):
+    self.total = total
+    self.done = done
+    self.started = time.monotonic()
+    self.start_done = done
+    self.printed = 0
+    self.quiet = quiet
+    self.lock = threading.Lock()
+
+  def add(self, size):
+    with self.lock:
+      self.done += size
+      now = time.monotonic()
+      if not self.quiet and now - self.printed >= 1:
+        self.printed = now
+        self.show(now)
+
+  def show(self, now):
+    rate = (self.done - self.start_done) / max(now - self.started, 0.001) / 1048576
+    total = f'/{self.total // 1048576}' if self.total else ''
+    percent = f' {self.done * 100 // self.total}%' if self.total else ''
+    print(f'\r{self.done // 1048576}{total} MiB{percent} {rate:.1f} MiB/s   ', end='', flush=True)
+
+  def finish(self):
+    if not self.quiet:
+      self.show(time.monotonic())
+      print()
+
+# download url to path - returns (changed, sha256)
+# changed is False when the copy on disk is still current upstream
+def download(url, path, parallel=1, checksum_file='SHA256SUMS', quiet=False, timeout=30):
+  meta = read_meta(path)
+  expected = upstream_sha256(url, checksum_file, timeout)
+
+  # the copy on disk is current if the published sha256 matches the one verified for it
+  if os.path.isfile(path) and meta.get('url') == url and meta.get('sha256'):
+    if expected and expected == meta['sha256']:
+      return False, meta['sha256']
+
+    # no checksum published - ask the server whether the image changed
+    if not expected:
+      headers = {}
+      if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+      if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+      if headers:
+        try:
+          with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304:
+              return False, meta['sha256']
+        except requests.RequestException as e:
+          raise DownloadError(f'unable to check {url}: {e}')
+
+  # fetch into .part - resumed when the partial copy is of the same upstream version
+  part = f'{path}.part'
+  part_meta = read_meta(part)
+  if os.path.isfile(part) and part_meta.get('url') == url and (part_meta.get('etag') or part_meta.get('last_modified')):
+    sha256, upstream = resume(url, part, part_meta, quiet, timeout)
+  else:
+    sha256, upstream = fetch(url, part, parallel, quiet, timeout)
+
+  # verify before the new copy replaces the old one
+  if expected and sha256 != expected:
+    for leftover in [part, f'{part}.json']:
+      if os.path.exists(leftover):
+        os.remove(leftover)
+    raise DownloadError(f'sha256 mismatch for {url}: got {sha256}, {checksum_file} has {expected}')
+  os.replace(part, path)
+  write_meta(path, {'url': url, **upstream, 'sha256': sha256, 'verified': bool(expected)})
+  if os.path.exists(f'{part}.json'):
+    os.remove(f'{part}.json')
+  return True, sha256
+
+# fresh download - returns (sha256, validators)
+# parallel range requests are used when the server supports them
+def fetch(url, part, parallel, quiet, timeout):
+  try:
+    response = requests.get(url, stream=True, timeout=timeout)
+    response.raise_for_status()
+  except requests.RequestException as e:
+    raise DownloadError(f'unable to download {url}: {e}')
+  size = int(response.headers.get('Content-Length') or 0)
+  upstream = validators(response)
+
+  # a .part written by parallel ranges has holes - it is never resumed
+  # ranges that fail fall back to a single stream
+  if parallel > 1 and size >= min_range_size and response.headers.get('Accept-Ranges') == 'bytes':
+    response.close()
+    if os.path.exists(f'{part}.json'):
+      os.remove(f'{part}.json')
+    try:
+      return fetch_ranges(url, part, size, parallel, upstream, quiet, timeout), upstream
+    except DownloadError:
+      return fetch(url, part, 1, quiet, timeout)
+
+  # single stream - hashed as it is written
+  write_meta(part, {'url': url, **upstream})
+  digest = hashlib.sha256()
+  progress = Progress(size, quiet=quiet)
+  with response, open(part, 'wb') as f:
+    stream(response, f, digest, progress, url)
+  progress.finish()
+  return digest.hexdigest(), upstream
+
+# continue an interrupted download - the existing bytes are hashed first
+def resume(url, part, part_meta, quiet, timeout):
+  offset = os.path.getsize(part)
+  digest = hashlib.sha256()
+  with open(part, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+
+  # if-range - the server sends the whole file if upstream changed since the .part
+  headers = {'Range': f'bytes={offset}-', 'If-Range': part_meta.get('etag') or part_meta['last_modified']}
+  try:
+    response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code != 416:
+      response.raise_for_status()
+  except requests.RequestException as e:
+    raise DownloadError(f'unable to resume {url}: {e}')
+
+  # nothing left to fetch - the .part was complete when the last run stopped
+  if response.status_code == 416:
+    response.close()
+    return digest.hexdigest(), {key: part_meta[key] for key in ['etag', 'last_modified'] if key in part_meta}
+
+  # range ignored or upstream changed - start over
+  if response.status_code != 206:
+    response.close()
+    os.remove(part)
+    return fetch(url, part, 1, quiet, timeout)
+
+  size = offset + int(response.headers.get('Content-Length') or 0)
+  progress = Progress(size, offset, quiet)
+  with response, open(part, 'ab') as f:
+    stream(response, f, digest, progress, url)
+  progress.finish()
+  return digest.hexdigest(), {key: part_meta[key] for key in ['etag', 'last_modified'] if key in part_meta}
+
+# copy a response body to f, hashing and counting it
+def stream(response, f, digest, progress, url):
+  try:
+    for chunk in response.iter_content(chunk_size):
+      f.write(chunk)
+      digest.update(chunk)
+      progress.add(len(chunk))
+  except requests.RequestException as e:
+    raise DownloadError(f'download of {url} interrupted - run again to resume: {e}')
+
+# split the file into ranges fetched at once - a hasher thread follows the
+# contiguous prefix that has been written so verification ends with the download
+def fetch_ranges(url, part, size, parallel, part_validators, quiet, timeout):
+  ranges = []
+  step = -(-size // parallel)
+  for start in range(0, size, step):
+    ranges.append({'start': start, 'end': min(size, start + step), 'written': 0, 'error': None})
+
+  with open(part, 'wb') as f:
+    f.truncate(size)
+  progress = Progress(size, quiet=quiet)
+  written = threading.Condition()
+  stop = threading.Event()
+
+  def fetch_range(r):
+    headers = {'Range': f'bytes={r["start"]}-{r["end"] - 1}'}
+    if part_validators:
+      headers['If-Range'] = part_validators.get('etag') or part_validators['last_modified']
+    try:
+      with requests.get(url, headers=headers, stream=True, timeout=timeout) as response, open(part, 'r+b') as f:
+        if response.status_code != 206:
+          raise DownloadError(f'range request for {url} returned {response.status_code}')
+        f.seek(r['start'])
+        for chunk in response.iter_content(chunk_size):
+          if stop.is_set():
+            return
+          f.write(chunk)
+          f.flush()
+          with written:
+            r['written'] += len(chunk)
+            written.notify_all()
+          progress.add(len(chunk))
+      if r['written'] != r['end'] - r['start']:
+        raise DownloadError(f'range {r["start"]}-{r["end"]} of {url} is short')
+    # any failure - a disk write too - is handed to the hashing loop, which would
+    # otherwise wait forever for a range whose thread has died
+    except Exception as e:
+      with written:
+        r['error'] = e
+        written.notify_all()
+
+  threads = [threading.Thread(target=fetch_range, args=(r,), daemon=True) for r in ranges]
+  for thread in threads:
+    thread.start()
+
+  # hash each range in order as far as it has been written
+  # unbuffered so no read-ahead picks up bytes a range has not written yet
+  # a failed range stops the others before the error is raised
+  digest = hashlib.sha256()
+  try:
+    with open(part, 'rb', buffering=0) as f:
+      for r in ranges:
+        hashed = 0
+        while hashed < r['end'] - r['start']:
+          with written:
+            while r['written'] == hashed and not any(other['error'] for other in ranges):
+              written.wait()
+            errors = [other['error'] for other in ranges if other['error']]
+            if errors:
+              raise DownloadError(f'unable to download {url}: {errors[0]}')
+            available = r['written']
+          f.seek(r['start'] + hashed)
+          while hashed < available:
+            chunk = f.read(min(chunk_size, available - hashed))
+            digest.update(chunk)
+            hashed += len(chunk)
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+  progress.finish()
+  return digest.hexdigest()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# content-addressed cache of customized images
+# every recipe layer is a qcow2 overlay on the layer before it, stored under the
+# sha256 of its parent's key and its own spec - so a changed layer rebuilds only
+# itself and the layers after it. the last layer is flattened into a standalone
+# image for import. the least recently used entries are evicted once the cache is
+# over its size limit, together with the layers built on them.
+
+import os, json, hashlib
+
+# devbox
+from devbox_cache import cache_dir
+
+# downloads and customized images
+images_dir = os.path.join(cache_dir, 'images')
+custom_dir = os.path.join(images_dir, 'custom')
+
+# flattened images and layer overlays
+image_ext = '.img'
+layer_ext = '.qcow2'
+
+# cache key for a parent digest or key and a spec - any json serialisable value
+def image_key(parent, spec):
+  return hashlib.sha256(json.dumps({'base': parent, 'recipe': spec}, sort_keys=True).encode()).hexdigest()
+
+# path of the image or layer stored under key
+def image_path(key, ext=image_ext):
+  return os.path.join(custom_dir, f'{key}{ext}')
+
+# path of a cached image or layer or None - a hit counts as a use for eviction
+def lookup(key, ext=image_ext):
+  path = image_path(key, ext)
+  if not os.path.isfile(path):
+    return None
+  os.utime(path)
+  return path
+
+# temporary path to build an image or layer in before it is stored
+def staging_path(key, ext=image_ext):
+  os.makedirs(custom_dir, exist_ok=True)
+  return os.path.join(custom_dir, f'{key}{ext}.tmp')
+
+# move a built image or layer into the cache and evict down to limit bytes - returns its path
+# info is kept next to it - a layer's info names its parent key
+def store(key, staged, info, limit, ext=image_ext):
+  path = image_path(key, ext)
+  with open(f'{path}.json', 'w') as f:
+    json.dump(info, f)
+  os.replace(staged, path)
+  evict(limit, keep=[key])
+  return path
+
+# (key, ext, size, last used) for every cached image and layer, oldest use first
+def entries():
+  result = []
+  try:
+    names = os.listdir(custom_dir)
+  except FileNotFoundError:
+    return result
+  for name in names:
+    key, ext = os.path.splitext(name)
+    if ext in [image_ext, layer_ext]:
+      stat = os.stat(os.path.join(custom_dir, name))
+      result.append((key, ext, stat.st_size, stat.st_mtime))
+  return sorted(result, key=lambda entry: entry[3])
+
+# parent key of a layer - None for images and first layers
+def parent_key(key, ext):
+  try:
+    with open(f'{image_path(key, ext)}.json') as f:
+      return json.load(f).get('parent')
+  except (OSError, ValueError):
+    return None
+
+# remove least recently used entries until the cache fits in limit bytes
+# removing a layer removes the layers built on it - entries in keep are never
+# removed. returns the evicted keys
+def evict(limit, keep=()):
+  cached = entries()
+  total = sum(size for _, _, size, _ in cached)
+  children = {}
+  for key, ext, _, _ in cached:
+    if ext == layer_ext:
+      children.setdefault(parent_key(key, ext), []).append(key)
+
+  evicted = []
+  def remove(key, ext):
+    nonlocal total
+    path = image_path(key, ext)
+    if not os.path.exists(path):
+      return
+    total -= os.path.getsize(path)
+    for leftover in [path, f'{path}.json']:
+      if os.path.exists(leftover):
+        os.remove(leftover)
+    evicted.append(key)
+    if ext == layer_ext:
+      for child in children.get(key, []):
+        remove(child, layer_ext)
+
+  protected = set(keep) | ancestors(keep)
+  for key, ext, _, _ in cached:
+    if total <= limit:
+      break
+    if key in protected:
+      continue
+    remove(key, ext)
+  return evicted
+
+# keys of every layer below the layers in keys
+def ancestors(keys):
+  result = set()
+  for key in keys:
+    parent = parent_key(key, layer_ext)
+    while parent and parent not in result:
+      result.add(parent)
+      parent = parent_key(parent, layer_ext)
+  return result
@@ -99,6 +99,18 @@ def init_devbox_ini():
   config.set('devbox', '; set to 1450 if using sdn ')
   config.set('devbox', 'network_mtu', '1500')
 
+  # state cache section
+  config.add_section('cache')
+
+  # cache ttls
+  config.set('cache', '; seconds cluster state is reused from ~/.cache/devbox between runs ( 0 disables ) ')
+  config.set('cache', '; list of vms - used to resolve hostnames for ssh / terminal / reboot / destroy')
+  config.set('cache', 'resources_ttl', '300')
+  config.set('cache', '; nodes, storage and bridges')
+  config.set('cache', 'discovery_ttl', '86400')
+  config.set('cache', '; template image name, size and description')
+  config.set('cache', 'image_ttl', '3600')
+
   # write config
   # file should not already exist...
   with open('devbox.ini', 'w') as cfile:
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+
+# --options passed on the command line eg --refresh
+# shared by devbox.py and the verb modules
+opts = {}
+
+# split --key[=value] options out of argv and return the positional args
+def parse_opts(argv):
+  args = []
+  for arg in argv:
+    if arg.startswith('--') and len(arg) > 2:
+      key, _, value = arg[2:].partition('=')
+      opts[key] = value or True
+    else:
+      args.append(arg)
+  return args
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# push readiness - a new devbox reports back instead of being polled
+# every clone gets a cloud-init vendor-data snippet that runs the readiness probes
+# on first boot and posts their output to an http listener in this process. the
+# clones of a run share one listener and are told apart by vmid and a token of their
+# own. clone() waits on an event - a vm that does not report within
+# [phonehome] timeout is probed through the guest agent as before.
+
+import json, secrets, threading, subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# devbox
+from devbox_config import *
+from devbox_probes import readiness_probes, probe_script, probe_results, check_results, probe_timeout
+
+# address of this host as seen from the devboxes - blank disables phone home
+phonehome_address = conf_opt('phonehome', 'address', '')
+
+# listener port - 0 takes a free one per run
+phonehome_port = conf_opt('phonehome', 'port', 0)
+
+# seconds a vm has to report before it is probed through the guest agent - the
+# probes' own deadline and a margin for the post, so probes that pass in time are
+# never run twice, and an unreachable listener costs less than the full agent wait
+phonehome_timeout = conf_opt('phonehome', 'timeout', probe_timeout + 20)
+
+# storage with snippets content the vendor-data is written to - it is read on the
+# node a vm starts on, so other nodes need it shared
+phonehome_storage = conf_opt('phonehome', 'storage', 'local')
+
+# where the probes are written in the guest
+guest_script = '/run/devbox-ready.sh'
+
+# vmid: callback of every vm that has not reported yet
+callbacks = {}
+lock = threading.Lock()
+server = None
+snippets = {}
+
+# one vm expected to report
+class Callback:
+
+  def __init__(self, vmid):
+    self.vmid = vmid
+    self.token = secrets.token_hex(16)
+    self.marker = secrets.token_hex(4)
+    self.event = threading.Event()
+    self.body = None
+    self.cicustom = None
+
+  # wait for the vm to report - probe results, or None if it did not report in time
+  # raises ProbeError if a probe did not pass
+  def wait(self, hostname, timeout):
+    self.event.wait(timeout)
+    with lock:
+      if callbacks.get(self.vmid) is self:
+        del callbacks[self.vmid]
+    if self.body is None:
+      return None
+    results = probe_results(self.body, self.marker, readiness_probes, probe_timeout)
+    check_results(results, hostname)
+    return results
+
+# POST /ready/<vmid> with the vm's token and its probe output
+class Handler(BaseHTTPRequestHandler):
+
+  def do_POST(self):
+    parts = self.path.strip('/').split('/')
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    with lock:
+      callback = callbacks.get(int(parts[1])) if len(parts) == 2 and parts[0] == 'ready' and parts[1].isdigit() else None
+    if not callback or not secrets.compare_digest(self.headers.get('X-Devbox-Token', ''), callback.token):
+      self.send_response(403)
+      self.end_headers()
+      return
+    callback.body = body.decode(errors='replace')
+    callback.event.set()
+    self.send_response(204)
+    self.end_headers()
+
+  # requests are not logged
+  def log_message(self, *args):
+    pass
+
+# port of the listener - started on first use
+def listener():
+  global server
+  with lock:
+    if not server:
+      server = ThreadingHTTPServer(('', phonehome_port), Handler)
+      server.daemon_threads = True
+      threading.Thread(target=server.serve_forever, name='devbox-phonehome', daemon=True).start()
+    return server.server_address[1]
+
+# {dir, shared} of the snippets storage - None if it cannot hold snippets
+def snippet_storage():
+  with lock:
+    if 'storage' not in snippets:
+      info = state.api(lambda: state.prox.storage(phonehome_storage).get())
+      usable = 'snippets' in info.get('content', '').split(',') and info.get('path')
+      snippets['storage'] = {'dir': os.path.join(info['path'], 'snippets'), 'shared': bool(info.get('shared'))} if usable else None
+      if not usable:
+        kmsg('phonehome_storage', f'{phonehome_storage} has no snippets directory - waiting on the guest agent', 'err')
+    return snippets['storage']
+
+# name of a vm's vendor-data snippet - kept for the life of the vm, cloud-init reads it on every start
+def snippet_name(vmid):
+  return f'devbox-{dev_id}-{vmid}.yaml'
+
+# write a file in the snippets directory - sudo is used when it is not writable
+def write_snippet(path, data):
+  try:
+    with open(path, 'w') as f:
+      f.write(data)
+  except PermissionError:
+    subprocess.run(['sudo', '-n', 'tee', path], input=data, text=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+# register a vm that will report once booted - None when phone home is off or the
+# vm's node cannot read the snippet, the caller then waits on the guest agent
+# the callback's cicustom is set on the vm's config
+def expect(vmid, vm_node):
+  if not phonehome_address:
+    return None
+  storage = snippet_storage()
+  if not storage or (not storage['shared'] and vm_node != node):
+    return None
+
+  # vendor-data is merged with the user-data proxmox generates - json is valid yaml
+  callback = Callback(vmid)
+  url = f'http://{phonehome_address}:{listener()}/ready/{vmid}'
+  post = f'sh {guest_script} | curl -s -m 10 --retry 10 --retry-connrefused -H "X-Devbox-Token: {callback.token}" --data-binary @- {url}'
+  vendor = {
+    'write_files': [{'path': guest_script, 'permissions': '0700', 'content': probe_script(readiness_probes, probe_timeout, callback.marker)}],
+    'runcmd': [['sh', '-c', post]],
+  }
+  try:
+    write_snippet(os.path.join(storage['dir'], snippet_name(vmid)), '#cloud-config\n' + json.dumps(vendor, indent=2) + '\n')
+  except (OSError, subprocess.CalledProcessError) as e:
+    kmsg('phonehome_snippet', f'unable to write the snippet of {vmid} - waiting on the guest agent: {e}', 'err')
+    return None
+  callback.cicustom = f'vendor={phonehome_storage}:snippets/{snippet_name(vmid)}'
+  with lock:
+    callbacks[vmid] = callback
+  return callback
+
+# remove the snippet of a destroyed vm - errors are ignored
+def remove_snippet(vmid):
+  if not phonehome_address:
+    return
+  storage = snippet_storage()
+  if not storage:
+    return
+  path = os.path.join(storage['dir'], snippet_name(vmid))
+  try:
+    os.remove(path)
+  except PermissionError:
+    subprocess.run(['sudo', '-n', 'rm', '-f', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  except OSError:
+    pass
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# node placement of new devboxes
+# online nodes are scored from one cluster/resources call by free memory, cpu load
+# and the devboxes already running there. a node is a candidate only if it has the
+# devbox storage and can reach the template's disk or a replica of it. each devbox
+# of a batch is placed in turn and counted against its node before the next one is placed.
+#
+#   spread   highest scoring node - devboxes go where there is most room
+#   pack     lowest scoring node that still fits - fills one node before the next
+#   pinned   always [proxmox] node, or --node=<node> for one run
+
+# devbox
+from devbox_config import *
+
+# weight of each part of a node's score - every part is between 0 and 1
+weights = {'memory': 0.5, 'cpu': 0.3, 'devboxes': 0.2}
+
+# score of a node - higher has more room
+def node_score(load):
+  return (
+    weights['memory'] * load['free_mem'] / max(load['maxmem'], 1)
+    + weights['cpu'] * (1 - min(load['cpu'], 1))
+    + weights['devboxes'] * (1 - load['devboxes'] / max_nodes))
+
+def spread(loads):
+  return max(loads, key=node_score)
+
+def pack(loads):
+  return min(loads, key=node_score)
+
+# policy name: function picking one of the nodes that fit a devbox
+policies = {'spread': spread, 'pack': pack}
+
+# node: load for every online node - from a cluster/resources listing if passed
+def node_loads(resources=None):
+  loads = {}
+  if resources is None:
+    resources = state.api(lambda: state.prox.cluster.resources.get())
+  for r in resources:
+    if r.get('type') == 'node' and r.get('status') == 'online':
+      loads[r['node']] = {
+        'node': r['node'],
+        'maxmem': r.get('maxmem', 0),
+        'free_mem': r.get('maxmem', 0) - r.get('mem', 0),
+        'cpu': r.get('cpu', 0),
+        'maxcpu': r.get('maxcpu', 1),
+        'devboxes': 0,
+        'storage': False,
+      }
+  for r in resources:
+    if r.get('node') not in loads:
+      continue
+    if r.get('type') == 'storage' and r.get('storage') == storage and r.get('status') == 'available':
+      loads[r['node']]['storage'] = True
+    if r.get('type') == 'qemu' and in_range(int(r.get('vmid'))) and r.get('status') == 'running':
+      loads[r['node']]['devboxes'] += 1
+  return loads
+
+# a linked clone needs the template's disk - on shared storage, on the node itself
+# or in a replica of the template on the node
+def reachable(load):
+  template = state.template
+  return load['storage'] and (state.storage_type == 'shared' or load['node'] == template['node'] or load['node'] in template['replicas'])
+
+# vmid: node for each new devbox
+def place(vmids):
+  kname = 'nodes_placement'
+  policy = opts.get('placement', placement)
+  pinned = opts.get('node')
+  if not vmids:
+    return {}
+  if pinned or policy == 'pinned':
+    target = pinned if isinstance(pinned, str) else node
+
+    # the template's own node and the nodes of its replicas hold its disk - any
+    # other node gets the same storage and template check as a scored placement
+    state.check_clone()
+    template = state.template
+    if template and target != template['node'] and target not in template['replicas']:
+      load = node_loads().get(target)
+      if not load or not reachable(load):
+        on = ', '.join([template['node']] + list(template['replicas']))
+        kmsg(kname, f'{target} is offline or cannot reach {storage} and the template on [{on}]', 'err')
+        exit(1)
+    return dict.fromkeys(vmids, target)
+  if policy not in policies:
+    kmsg(kname, f'unknown placement "{policy}" - expected {", ".join(list(policies) + ["pinned"])}', 'err')
+    exit(1)
+
+  state.check_clone()
+  loads = node_loads()
+  candidates = [load for load in loads.values() if reachable(load) and (not placement_nodes or load['node'] in placement_nodes)]
+  if not candidates:
+    on = ', '.join([state.template['node']] + list(state.template['replicas']))
+    kmsg(kname, f'no online node can reach {storage} and the template on [{on}]', 'err')
+    exit(1)
+
+  need = vm_ram * 1073741824
+  targets = {}
+  for vmid in vmids:
+    fitting = [load for load in candidates if load['free_mem'] >= need]
+    if not fitting:
+      free = ', '.join(f'{load["node"]} {load["free_mem"] // 1073741824}G' for load in candidates)
+      kmsg(kname, f'no node has {vm_ram}G free for {vmid} - {free}', 'err')
+      exit(1)
+    chosen = policies[policy](fitting)
+    chosen['free_mem'] -= need
+    chosen['devboxes'] += 1
+    targets[vmid] = chosen['node']
+  return targets
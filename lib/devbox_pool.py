@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# warm pool of pre-cloned, booted and agent-checked devboxes
+# pool vms sit in the devbox range under a reserved name - nodes create claims
+# one by renaming it, which takes seconds instead of a full clone and boot
+
+import re, fcntl, shlex
+
+# devbox
+from devbox_config import *
+from devbox_config import _config_dir
+from devbox_cache import cache_dir
+from devbox_proxmox import clone_many, prox_destroy, qaexec
+from devbox_agent import AgentError
+from devbox_placement import place
+
+# vmids of pool vms cloned from the current template or one of its replicas - pool
+# vms of an older generation are stale, they are never claimed and the next fill removes them
+def pool_current():
+  template = state.template
+  sources = {source_tag(vmid) for vmid in [template['vmid'], *template['replicas'].values()]} if template else set()
+  tags = {int(vm.get('vmid')): (vm.get('tags') or '').split(';') for vm in state.resources}
+  return [vmid for vmid, name in state.vmnames.items() if name == pool_name and sources & set(tags.get(vmid, []))]
+
+# vmids of pool vms ready to claim - current and running
+def pool_vms():
+  running = {int(vm.get('vmid')) for vm in state.resources if vm.get('status') == 'running'}
+  return [vmid for vmid in pool_current() if vmid in running]
+
+# claim a pool vm for hostname - returns a result like clone_many or None if none could be claimed
+def pool_claim(hostname):
+
+  # the new name is also written into /etc/hosts - only plain hostnames use the pool
+  if not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9-]*', hostname):
+    return None
+
+  for vmid in pool_vms():
+    started = time.monotonic()
+    vm_node = state.vms[vmid]
+    ip = f'{vmip(vmid)}/{network_mask}'
+
+    # rename - the config digest makes this fail if another create claimed the vm first
+    try:
+      vm_config = state.prox.nodes(vm_node).qemu(vmid).config.get()
+      if vm_config.get('name') != pool_name:
+        continue
+      state.tasks.wait(state.prox.nodes(vm_node).qemu(vmid).config.post(
+        name=hostname,
+        description=f'{vmid}:{hostname}:{ip}',
+        digest=vm_config['digest'],
+      ))
+    except Exception:
+      continue
+    state.vmnames[vmid] = hostname
+
+    # set the hostname inside the vm - /etc/hosts holds the name it booted with,
+    # pool_warming_name, so the guest's current hostname is the one replaced
+    try:
+      qaexec(vmid, f'sed -i "s/\\b$(hostname)\\b/{hostname}/g" /etc/hosts && hostnamectl set-hostname {shlex.quote(hostname)}')
+      error = ''
+    except AgentError as e:
+      error = str(e)
+    return {
+      'vmid': vmid,
+      'hostname': hostname,
+      'ip': ip,
+      'error': error,
+      'seconds': time.monotonic() - started,
+    }
+  return None
+
+# remove the pool vms of an older template - they would keep it from being collected
+def pool_drain():
+  state.refresh('resources')
+  current = pool_current()
+  for vmid, name in state.vmnames.items():
+    if name == pool_name and vmid not in current:
+      kmsg('pool_drain', f'removing pool vm {vmid} of an older template', 'sys')
+      prox_destroy(vmid)
+  state.refresh('resources')
+
+# clone pool vms until there are warm_pool of them - returns clone results
+# only one fill runs at a time, a second fill returns straight away
+def pool_fill():
+  kname = 'pool_fill'
+  os.makedirs(cache_dir, exist_ok=True)
+  with open(os.path.join(cache_dir, f'pool-fill-{dev_id}.lock'), 'w') as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      kmsg(kname, 'another fill is running', 'sys')
+      return []
+
+    # vms left warming by a fill that died are removed, and so are stale pool vms
+    state.refresh('resources')
+    for vmid, name in state.vmnames.items():
+      if name == pool_warming_name:
+        kmsg(kname, f'removing unfinished pool vm {vmid}', 'sys')
+        prox_destroy(vmid)
+    pool_drain()
+
+    # clone the missing vms
+    missing = warm_pool - len(pool_current())
+    if missing <= 0:
+      return []
+    kmsg(kname, f'cloning {missing} pool vms', 'sys')
+    vmids = next_ids(missing)
+    results = clone_many(dict.fromkeys(vmids, pool_warming_name), create_parallel, place(vmids))
+
+    # mark finished vms ready to claim
+    for result in results:
+      if not result['error']:
+        vm_node = state.vms.get(result['vmid'], node)
+        state.tasks.wait(state.prox.nodes(vm_node).qemu(result['vmid']).config.post(name=pool_name))
+    state.refresh('resources')
+    return results
+
+# start a detached pool fill so nodes create returns straight away
+def pool_refill_background():
+  os.makedirs(cache_dir, exist_ok=True)
+  with open(os.path.join(cache_dir, 'pool.log'), 'a') as log:
+    subprocess.Popen(
+      [sys.executable, os.path.join(_config_dir, 'devbox.py'), 'pool', 'fill'],
+      cwd=_config_dir,
+      stdin=subprocess.DEVNULL,
+      stdout=log,
+      stderr=log,
+      start_new_session=True,
+    )
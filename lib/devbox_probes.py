@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# readiness probes run in a new devbox before it counts as created
+# every probe is one line under [probes]/checks in devbox.ini. all probes run at once
+# in one shell script sent through the guest agent - each retries until it passes or
+# the shared deadline of [probes]/timeout seconds is reached, and reports its time.
+#
+#   tcp: 127.0.0.1:22          a tcp port accepts connections
+#   http: https://example.com   a url answers - any http status
+#   dns: example.com           a name resolves
+#   cloud-init                 cloud-init has finished
+#   command: test -f /ready    a shell command exits 0
+
+import shlex, secrets, urllib.parse
+
+# devbox
+from devbox_config import *
+from devbox_agent import AgentError
+
+# without [probes]/checks - ssh is up and the host the cloud image came from answers
+default_checks = f'''
+  tcp: 127.0.0.1:22
+  http: {urllib.parse.urlsplit(cloud_image_url)._replace(path='/', query='', fragment='').geturl()}
+'''
+
+probe_checks = conf_opt('probes', 'checks', default_checks)
+probe_timeout = conf_opt('probes', 'timeout', 60)
+
+# seconds between attempts of a failing probe
+probe_interval = 0.5
+
+# raised for a probe line that cannot be parsed, or by probes that did not pass
+class ProbeError(AgentError):
+  pass
+
+# one probe line to {line, cmd} - cmd is the shell check run in the guest
+def parse_probe(line):
+  kind, _, arg = line.partition(':')
+  kind, arg = kind.strip(), arg.strip()
+
+  if kind == 'tcp':
+    host, _, port = arg.rpartition(':')
+    if not host or not port.isdigit():
+      raise ProbeError(f'{line}: expected tcp: <host>:<port>')
+    cmd = f'timeout 2 bash -c {shlex.quote(f"exec 3<>/dev/tcp/{host}/{port}")}'
+  elif kind == 'http':
+    if not arg:
+      raise ProbeError(f'{line}: expected http: <url>')
+    cmd = f'curl -s -o /dev/null --connect-timeout 1 --max-time 2 {shlex.quote(arg)}'
+  elif kind == 'dns':
+    if not arg:
+      raise ProbeError(f'{line}: expected dns: <name>')
+    cmd = f'getent hosts {shlex.quote(arg)}'
+
+  # status 2 is done with recoverable errors
+  elif kind == 'cloud-init':
+    cmd = 'cloud-init status --wait; [ $? -ne 1 ]'
+  elif kind == 'command':
+    if not arg:
+      raise ProbeError(f'{line}: expected command: <shell command>')
+    cmd = arg
+  else:
+    raise ProbeError(f'{line}: unknown probe "{kind}" - expected tcp, http, dns, cloud-init or command')
+  return {'line': line.strip(), 'cmd': cmd}
+
+# configured probes - checked on load like the rest of devbox.ini
+try:
+  readiness_probes = [parse_probe(line) for line in probe_checks.splitlines() if line.strip() and not line.strip().startswith('#')]
+except ProbeError as e:
+  kmsg('probes_config', f'[probes]/checks {e}', 'err')
+  exit(1)
+
+# shell script running every probe at once - each prints @@<token>:<index>:<rc>:<ms>
+# when it passes or gives up at the deadline
+def probe_script(checks, timeout, token):
+  script = [
+    f'd=$(( $(date +%s) + {timeout} )); s=$(date +%s%N)',
+    f'r() {{ echo "@@{token}:$1:$2:$(( ($(date +%s%N) - s) / 1000000 ))"; }}',
+    'p() { while :; do',
+    '  l=$(( d - $(date +%s) )); [ $l -gt 0 ] || { r $1 1; return; }',
+    '  if timeout $l sh -c "$2" > /dev/null 2>&1; then r $1 0; return; fi',
+    f'  sleep {probe_interval}',
+    'done; }',
+  ]
+  script += [f'p {i} {shlex.quote(check["cmd"])} &' for i, check in enumerate(checks)]
+  script.append('wait')
+  return '\n'.join(script)
+
+# {line, ok, seconds} per probe from the script output - a probe that did not report failed
+def probe_results(out, token, checks, timeout):
+  results = [{'line': check['line'], 'ok': False, 'seconds': float(timeout)} for check in checks]
+  for line in out.splitlines():
+    parts = line.strip().split(':')
+    if len(parts) == 4 and parts[0] == f'@@{token}' and all(part.isdigit() for part in parts[1:]):
+      index, rc, ms = map(int, parts[1:])
+      if index < len(results):
+        results[index].update({'ok': rc == 0, 'seconds': ms / 1000})
+  return results
+
+# one line summary of probe results eg tcp: 127.0.0.1:22 0.4s
+def probe_summary(results):
+  return ', '.join(f'{result["line"]} {result["seconds"]:.1f}s{"" if result["ok"] else " failed"}' for result in results)
+
+# check probe results - raises ProbeError naming the probes that did not pass
+def check_results(results, hostname):
+  failed = [result for result in results if not result['ok']]
+  if failed:
+    raise ProbeError(f'{hostname} not ready after {probe_timeout}s: {probe_summary(failed)}')
+
+# run probes in a vm through its agent session - returns the results
+# raises ProbeError if one did not pass, AgentError if the agent cannot run them
+def readiness_check(session, hostname, checks=readiness_probes):
+  token = secrets.token_hex(4)
+  result = session.exec(probe_script(checks, probe_timeout, token), probe_timeout + 10)
+  results = probe_results(result.out, token, checks, probe_timeout)
+  check_results(results, hostname)
+  return results
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# start-up profiling - DEVBOX_PROFILE_STARTUP=1 reports where a command's time goes
+# every module import is timed, devbox.py marks its phases and the first proxmox
+# api request is timed. the report is printed to stderr when the process exits.
+
+import os, sys, time, atexit
+from importlib.abc import MetaPathFinder
+
+enabled = os.environ.get('DEVBOX_PROFILE_STARTUP') == '1'
+started = time.perf_counter()
+
+# (seconds since start, phase)
+marks = []
+
+# module: [self seconds, cumulative seconds, seconds since start]
+imports = {}
+
+# modules shown in the report
+report_limit = 15
+
+# modules being imported - time spent in nested imports is not self time
+stack = []
+
+# record a phase of start-up
+def mark(phase):
+  if enabled:
+    marks.append((time.perf_counter() - started, phase))
+
+# finds modules with the other finders and times their loader's exec_module
+class ImportTimer(MetaPathFinder):
+
+  def find_spec(self, name, path, target=None):
+    for finder in sys.meta_path:
+      if finder is self or not hasattr(finder, 'find_spec'):
+        continue
+      spec = finder.find_spec(name, path, target)
+      if spec is not None:
+        break
+    else:
+      return None
+
+    # builtin and frozen loaders are classes shared by every module - leave them alone
+    loader = spec.loader
+    if loader is None or isinstance(loader, type) or not hasattr(loader, 'exec_module'):
+      return spec
+    exec_module = loader.exec_module
+
+    def timed_exec_module(module):
+      begin = time.perf_counter()
+      stack.append(0.0)
+      try:
+        exec_module(module)
+      finally:
+        total = time.perf_counter() - begin
+        nested = stack.pop()
+        if stack:
+          stack[-1] += total
+        imports[name] = [total - nested, total, begin - started]
+    loader.exec_module = timed_exec_module
+    return spec
+
+# time the first request made through a proxmoxer api object
+def watch_api(prox):
+  if not enabled:
+    return
+  session = getattr(prox, '_store', {}).get('session')
+  if session is None:
+    return
+  request = session.request
+
+  def timed_request(*args, **kwargs):
+    begin = time.perf_counter()
+    try:
+      return request(*args, **kwargs)
+    finally:
+      session.request = request
+      marks.append((begin - started, f'first api call {args[0]} {args[1].split("/api2/json/")[-1]} ({(time.perf_counter() - begin) * 1000:.1f} ms)'))
+  session.request = timed_request
+
+# print the report
+def report():
+  out = sys.stderr
+  total = time.perf_counter() - started
+  print(f'\nstartup profile - {total * 1000:.1f} ms since devbox_profile was imported', file=out)
+  print(f'{"ms":>8}  phase', file=out)
+  for at, phase in sorted(marks):
+    print(f'{at * 1000:>8.1f}  {phase}', file=out)
+
+  # slowest imports - top level packages only, nested modules are in their cumulative time
+  top = {name: timing for name, timing in imports.items() if '.' not in name}
+  print(f'\n{"self ms":>8} {"cum ms":>8} {"at ms":>8}  import ({len(imports)} modules, {sum(t[0] for t in imports.values()) * 1000:.1f} ms)', file=out)
+  for name, (self_time, cumulative, at) in sorted(top.items(), key=lambda item: -item[1][1])[:report_limit]:
+    print(f'{self_time * 1000:>8.1f} {cumulative * 1000:>8.1f} {at * 1000:>8.1f}  {name}', file=out)
+
+if enabled:
+  sys.meta_path.insert(0, ImportTimer())
+  atexit.register(report)
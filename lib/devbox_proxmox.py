@@ -1,114 +1,87 @@
 #!/usr/bin/env python3
 
-import shlex
+from concurrent.futures import ThreadPoolExecutor
 
 # devbox
 from devbox_config import *
-
-# run a exec via qemu-agent
+from devbox_tasks import TaskError
+from devbox_agent import AgentSession, AgentError
+from devbox_reserve import release
+from devbox_probes import readiness_check, probe_summary
+from devbox_phonehome import expect, remove_snippet, phonehome_timeout
+from devbox_trace import span, traced, annotate, in_context
+
+# agent sessions by (node, vmid) - an agent that answered once is not pinged again
+agent_sessions = {}
+
+# guest agent session for a vm - node is looked up in the vm map
+def agent_session(vmid: int, node: str = node):
+  node = state.vms.get(vmid, node)
+  if (node, vmid) not in agent_sessions:
+    agent_sessions[(node, vmid)] = AgentSession(state.prox, node, vmid, agent_timeout)
+  return agent_sessions[(node, vmid)]
+
+# run a exec via qemu-agent - returns stdout, raises AgentError
+@traced('qaexec')
 def qaexec(vmid: int, cmd='uptime', node: str = node):
 
   # define kname
   kname = 'qaexec'
+  annotate(vmid=vmid)
 
-  # get node from vm map
-  try:
-    node = vms[vmid]
-  except KeyError:
-    pass
-
-  # qagent not yet running check
-  qagent_running = False
-
-  # max wait time
-  qagent_count = 1
-
-  # wait until qemu-agent responds
-  while not qagent_running:
-    try:
-      prox.nodes(node).qemu(vmid).agent.ping.post()
-      qagent_running = True
-
-    except Exception:
-      qagent_count += 1
-
-      # exit if longer than 30 seconds
-      if qagent_count >= 30:
-        vmname = vmnames.get(vmid, str(vmid))
-        kmsg(kname, f'agent not responding on {vmname} [{node}] cmd: {cmd}', 'err')
-        exit(1)
-
-      # sleep 1 second then try again
-      time.sleep(1)
-
-  # send command via qemu-agent exec (use sh -c for shell features)
-  try:
-    qa_exec = prox.nodes(node).qemu(vmid).agent.exec.post(
-      command=f'sh -c {shlex.quote(cmd)}',
-    )
-  except Exception as e:
-    kmsg(kname, f'{vmid}: problem running cmd: {cmd} - {e}', 'err')
-    exit(1)
-
-  # get pid
-  pid = qa_exec['pid']
-  pid_status = 0
-
-  # loop until command has finished
-  while pid_status != 1:
-    try:
-      pid_check = prox.nodes(node).qemu(vmid).agent('exec-status').get(pid=pid)
-    except Exception as e:
-      kmsg(kname, f'{vmid}: problem checking pid {pid}: {e}', 'err')
-      exit(1)
-
-    # will equal 1 when process is done
-    pid_status = pid_check['exited']
-    if not pid_status:
-      time.sleep(0.5)
+  # run and wait for the command
+  result = agent_session(vmid, node).exec(cmd)
 
   # check for exitcode 127 (command not found)
-  if int(pid_check['exitcode']) == 127:
-    kmsg(kname, f'{vmid}: exit code 127 (command not found): {cmd}', 'err')
-    exit(1)
+  if result.exitcode == 127:
+    raise AgentError(f'{vmid}: exit code 127 (command not found): {cmd}')
 
   # check for stderr output
-  if pid_check.get('err-data'):
-    kmsg('qaexec_stderr', f'CMD: {cmd}\n{pid_check["err-data"].strip()}', 'err')
+  if result.err:
+    kmsg(f'{kname}_stderr', f'CMD: {cmd}\n{result.err.strip()}', 'err')
 
     # if there is stdout alongside stderr, return it
-    if pid_check.get('out-data'):
-      return pid_check['out-data'].strip()
-    else:
-      exit(1)
+    if not result.out:
+      raise AgentError(f'{vmid}: no output and stderr from cmd: {cmd}')
 
   # return stdout if present
-  if pid_check.get('out-data'):
-    return pid_check['out-data'].strip()
+  if result.out:
+    return result.out.strip()
 
   return f'no output - {cmd}'
 
 # stop and destroy vm
+@traced('destroy')
 def prox_destroy(vmid: int):
 
   kname = 'destroy_devbox'
+  annotate(vmid=vmid)
 
-  # if destroying image
-  if vmid == dev_id:
-    prox_task(prox.nodes(node).qemu(dev_id).delete())
+  # templates have nothing to stop
+  templates = template_nodes()
+  if vmid == dev_id or vmid in templates:
+    prox_task(state.prox.nodes(templates.get(vmid, node)).qemu(vmid).delete())
     return
 
-  # power off and delete
+  # power off and delete on the node the vm is on
+  vm_node = state.vms.get(vmid, node)
   try:
-    prox_task(prox.nodes(node).qemu(vmid).status.stop.post(), node)
-    prox_task(prox.nodes(node).qemu(vmid).delete(), node)
-    kmsg(kname, vmnames[vmid])
+    prox_task(state.prox.nodes(vm_node).qemu(vmid).status.stop.post(), vm_node)
+    prox_task(state.prox.nodes(vm_node).qemu(vmid).delete(), vm_node)
+    remove_snippet(vmid)
+    kmsg(kname, state.vmnames[vmid])
   except Exception as e:
-    kmsg(kname, f'unable to destroy {node}/{vmid}: {e}', 'err')
+    kmsg(kname, f'unable to destroy {vm_node}/{vmid}: {e}', 'err')
     exit(1)
 
-# clone
-def clone(vmid: int, hostname: str):
+# clone - raises TaskError if a proxmox task fails, AgentError if the vm is not ready
+# template is the current generation unless a template being built is passed
+# target is the node the vm is placed on - the template's node if not passed
+@traced('clone')
+def clone(vmid: int, hostname: str, template: dict = None, target: str = None):
+
+  # lookups needed before cloning
+  state.check_clone(image=template is None)
 
   # map network info
   ip = vmip(vmid) + '/' + network_mask
@@ -116,75 +89,111 @@ def clone(vmid: int, hostname: str):
   # vm ram convert from G to MB
   memory = vm_ram * 1024
 
+  # template generation and the node the clone lands on - cloned from the
+  # replica on that node if there is one
+  template = template or state.template
+  vm_node = target or template['node']
+  source = template_copy(template, vm_node)
+  placed = {'target': vm_node} if vm_node != source['node'] else {}
+  annotate(vmid=vmid, hostname=hostname, node=vm_node)
+
   # hostname
-  kmsg('proxmox_clone', f'{hostname} {ip} {vm_cpu}c/{vm_ram}G ram {vm_disk}G disk')
+  kmsg('proxmox_clone', f'{hostname} {ip} {vm_cpu}c/{vm_ram}G ram {vm_disk}G disk [{vm_node}]')
 
-  # clone
-  prox_task(prox.nodes(node).qemu(dev_id).clone.post(newid=vmid))
+  # clone - the new vm holds the slot from here on
+  try:
+    with span('clone.task', source=source['vmid']):
+      state.tasks.wait(state.prox.nodes(source['node']).qemu(source['vmid']).clone.post(newid=vmid, **placed))
+  finally:
+    release(vmid)
+
+  # the vm reports its probes itself on first boot when phone home is set up
+  callback = expect(vmid, vm_node)
 
   # configure
-  prox_task(prox.nodes(node).qemu(vmid).config.post(
-    name=hostname,
-    onboot=1,
-    cores=vm_cpu,
-    memory=memory,
-    balloon='0',
-    boot='order=scsi0',
-    net0=f'model=virtio,bridge={network_bridge},mtu={network_mtu}',
-    ipconfig0=f'gw={network_gw},ip={ip}',
-    nameserver=network_dns,
-    description=f'{vmid}:{hostname}:{ip}',
-  ))
+  with span('clone.config'):
+    state.tasks.wait(state.prox.nodes(vm_node).qemu(vmid).config.post(
+      **({'cicustom': callback.cicustom} if callback else {}),
+      name=hostname,
+      onboot=1,
+      cores=vm_cpu,
+      memory=memory,
+      balloon='0',
+      boot='order=scsi0',
+      net0=f'model=virtio,bridge={state.bridge},mtu={network_mtu}',
+      ipconfig0=f'gw={network_gw},ip={ip}',
+      nameserver=network_dns,
+      description=f'{vmid}:{hostname}:{ip}',
+      tags=source_tag(source['vmid']),
+    ))
 
   # resize disk
-  prox_task(prox.nodes(node).qemu(vmid).resize.put(
-    disk='scsi0',
-    size=f'{vm_disk}G',
-  ))
+  with span('clone.resize'):
+    state.tasks.wait(state.prox.nodes(vm_node).qemu(vmid).resize.put(
+      disk='scsi0',
+      size=f'{vm_disk}G',
+    ))
 
   # power on
-  prox_task(prox.nodes(node).qemu(vmid).status.start.post())
-
-  # wait for qemu-agent and verify network access
-  internet_check(vmid)
-
-# proxmox task blocker - waits for an async task to complete
+  with span('clone.start'):
+    state.tasks.wait(state.prox.nodes(vm_node).qemu(vmid).status.start.post())
+
+  # wait for the vm to report, or for qemu-agent and the readiness probes
+  with span('clone.ready') as ready:
+    results = callback.wait(hostname, phonehome_timeout) if callback else None
+    ready['attrs']['via'] = 'phonehome' if results is not None else 'agent'
+    if results is None:
+      results = readiness_check(agent_session(vmid, vm_node), hostname)
+  kmsg('proxmox_ready', f'{hostname} {probe_summary(results)}')
+
+# clone several nodes concurrently - returns a result dict per node in the order passed
+# nodes is a dict of vmid: hostname with ids already reserved, targets vmid: node
+def clone_many(nodes: dict, parallel: int = 4, targets: dict = None):
+
+  # shared lookups and the task waiter are set up once before any worker starts
+  state.check_clone()
+  state.tasks
+
+  # run one clone pipeline and time it
+  def clone_one(vmid, hostname):
+    started = time.monotonic()
+    try:
+      clone(vmid, hostname, target=(targets or {}).get(vmid))
+      error = ''
+    except Exception as e:
+      error = str(e).splitlines()[0] if str(e) else type(e).__name__
+
+    # a lookup that fails reports itself and exits - that ends this node, not the batch
+    except SystemExit:
+      error = 'failed - see the error above'
+    return {
+      'vmid': vmid,
+      'hostname': hostname,
+      'ip': f'{vmip(vmid)}/{network_mask}',
+      'error': error,
+      'seconds': time.monotonic() - started,
+    }
+
+  with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+    futures = [pool.submit(in_context(clone_one), vmid, hostname) for vmid, hostname in nodes.items()]
+    return [future.result() for future in futures]
+
+# proxmox task blocker - waits for one or more async tasks to complete
+# node is kept for callers - the node is read from the upid
 def prox_task(task_id, node=node):
-
-  # poll until task is stopped
   try:
-    status = {"status": ""}
-    while status["status"] != "stopped":
-      status = prox.nodes(node).tasks(task_id).status.get()
-      if status["status"] != "stopped":
-        time.sleep(1)
-  except Exception as e:
-    kmsg('proxmox_task-status', f'unable to get task status for {task_id} on node {node}: {e}', 'err')
-    exit(1)
-
-  # if task not completed ok
-  if status["exitstatus"] != "OK":
-    log = task_log(task_id)
-    kmsg('proxmox_task-status', f'task exited with non-OK status ({status["exitstatus"]})\n{log}', 'err')
+    with span('task', upid=task_id):
+      state.tasks.wait(task_id)
+  except TaskError as e:
+    kmsg('proxmox_task-status', str(e), 'err')
     exit(1)
 
 # returns the task log as a string
 def task_log(task_id, node=node):
 
   try:
-    lines = [log['t'] for log in prox.nodes(node).tasks(task_id).log.get()]
+    lines = [log['t'] for log in state.prox.nodes(node).tasks(task_id).log.get()]
     return '\n'.join(lines)
   except Exception as e:
     kmsg('proxmox_task-log', f'failed to get log for task {task_id}: {e}', 'err')
     exit(1)
-
-# internet checker - verifies vm has outbound network access
-def internet_check(vmid):
-  internet_cmd = 'curl -s --retry 2 --retry-all-errors --connect-timeout 1 --max-time 2 www.google.com > /dev/null && echo ok || echo error'
-  result = qaexec(vmid, internet_cmd)
-
-  # if curl command fails
-  if result == 'error':
-    vmname = vmnames.get(vmid, str(vmid))
-    kmsg('prox_netcheck', f'{vmname} internet access check failed', 'err')
-    exit(1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# rebalancing running devboxes across nodes with live migration
+# node loads come from one cluster/resources call and are scored the way placement
+# scores them. the plan is built greedily - while the spread between the best and the
+# worst node score is over rebalance_threshold, the one devbox move off the worst node
+# that narrows the spread most is added. every devbox moves at most once, so the plan
+# stops as soon as no single move helps.
+
+from concurrent.futures import ThreadPoolExecutor
+
+# devbox
+from devbox_config import *
+from devbox_placement import node_loads, node_score
+
+# spread between the highest and lowest node score
+def score_spread(loads):
+  scores = [node_score(load) for load in loads.values()]
+  return max(scores) - min(scores) if scores else 0
+
+# move a devbox's load from one node to another - counted against both
+def shift(loads, vm, source, target):
+  for name, sign in [(source, -1), (target, 1)]:
+    load = loads[name]
+    load['free_mem'] -= sign * vm['mem']
+    load['cpu'] += sign * vm['cpu'] * vm['maxcpu'] / max(load['maxcpu'], 1)
+    load['devboxes'] += sign
+
+# [{vmid, hostname, source, target}] that bring the spread under threshold - loads are
+# node: load of the nodes devboxes may move between, vms the running devboxes on them
+def plan_moves(loads, vms, threshold=rebalance_threshold):
+  loads = {name: dict(load) for name, load in loads.items()}
+  moves = []
+  moved = set()
+  while len(loads) > 1 and score_spread(loads) > threshold:
+    spread = score_spread(loads)
+    source = min(loads, key=lambda name: node_score(loads[name]))
+
+    # the move off the worst node that leaves the smallest spread
+    best = None
+    for vm in vms:
+      if vm['node'] != source or vm['vmid'] in moved:
+        continue
+      for target, load in loads.items():
+        if target == source or load['free_mem'] < vm['maxmem']:
+          continue
+        shift(loads, vm, source, target)
+        after = score_spread(loads)
+        shift(loads, vm, target, source)
+        if after < spread and (not best or after < best[0]):
+          best = (after, vm, target)
+    if not best:
+      break
+    _, vm, target = best
+    shift(loads, vm, source, target)
+    moved.add(vm['vmid'])
+    moves.append({'vmid': vm['vmid'], 'hostname': vm['hostname'], 'source': source, 'target': target})
+  return moves, loads
+
+# (node: load, running devboxes) of the nodes devboxes may move between - online,
+# with the devbox storage and in placement_nodes when that is set
+def fleet():
+  resources = state.api(lambda: state.prox.cluster.resources.get())
+  loads = {name: load for name, load in node_loads(resources).items() if load['storage'] and (not placement_nodes or name in placement_nodes)}
+  vms = []
+  for r in resources:
+    if r.get('type') != 'qemu' or r.get('status') != 'running' or r.get('node') not in loads:
+      continue
+    vmid = int(r.get('vmid'))
+    if in_range(vmid) and vmid != dev_id and r.get('name') not in reserved_names:
+      vms.append({
+        'vmid': vmid,
+        'hostname': r.get('name', ''),
+        'node': r['node'],
+        'mem': r.get('mem', 0),
+        'maxmem': r.get('maxmem', 0),
+        'cpu': r.get('cpu', 0),
+        'maxcpu': r.get('maxcpu', 1),
+      })
+  return loads, vms
+
+# live migrate one devbox - with local storage its disk is copied along
+# raises TaskError if the migration fails
+def migrate(move):
+  params = {'target': move['target'], 'online': 1}
+  if state.storage_type == 'local':
+    params.update({'with-local-disks': 1, 'targetstorage': storage})
+  state.tasks.wait(state.prox.nodes(move['source']).qemu(move['vmid']).migrate.post(**params))
+
+# run the moves of a plan, parallel at a time - returns a result dict per move in order
+def migrate_many(moves, parallel=rebalance_parallel):
+
+  # shared lookups and the task waiter are set up once before any worker starts
+  state.storage_type
+  state.tasks
+
+  # run one migration and time it
+  def migrate_one(move):
+    started = time.monotonic()
+    try:
+      migrate(move)
+      error = ''
+    except Exception as e:
+      error = str(e).splitlines()[0] if str(e) else type(e).__name__
+    return {**move, 'error': error, 'seconds': time.monotonic() - started}
+
+  with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+    futures = [pool.submit(migrate_one, move) for move in moves]
+    return [future.result() for future in futures]
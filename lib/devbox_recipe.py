@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# image customization recipe
+# the template image is built as ordered layers, one virt-customize run each. a layer
+# is one line: packages / copy / run / command followed by its arguments. layers come
+# from [image]/layers in devbox.ini or from the file named by [image]/recipe.
+#
+#   packages: git build-essential     install packages
+#   copy: files/bashrc:/etc/skel/.bashrc   copy a local file or directory into the image
+#   run: scripts/setup.sh             run a local script inside the image
+#   command: timedatectl set-ntp true      run a shell command inside the image
+
+import os, hashlib
+
+# devbox
+from devbox_config import *
+from devbox_config import _config_dir
+
+# every template needs the guest agent - always the first layer
+agent_layer = 'packages: qemu-guest-agent'
+
+# raised for a layer that cannot be parsed or refers to a missing file
+class RecipeError(Exception):
+  pass
+
+# sha256 of a local file or of every file below a directory
+def path_sha256(path):
+  digest = hashlib.sha256()
+  if os.path.isdir(path):
+    for root, dirs, files in sorted(os.walk(path)):
+      dirs.sort()
+      for name in sorted(files):
+        digest.update(os.path.relpath(os.path.join(root, name), path).encode() + b'\0')
+        digest.update(path_sha256(os.path.join(root, name)).encode())
+    return digest.hexdigest()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1048576), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+# local path of a layer argument - relative to the directory of devbox.ini
+def local_path(layer, path):
+  full = os.path.join(_config_dir, os.path.expanduser(path))
+  if not os.path.exists(full):
+    raise RecipeError(f'{layer}: {path} does not exist')
+  return full
+
+# one recipe line to a layer - line, virt-customize args and spec it is cached under
+# the spec holds the digest of local files so editing a script rebuilds its layer
+def parse_layer(line):
+  kind, _, arg = line.partition(':')
+  kind, arg = kind.strip(), arg.strip()
+  if not arg:
+    raise RecipeError(f'{line}: expected <packages|copy|run|command>: <arguments>')
+  files = {}
+
+  if kind == 'packages':
+    args = ['--install', ','.join(arg.replace(',', ' ').split())]
+  elif kind == 'copy':
+    src, _, dest = arg.partition(':')
+    if not dest:
+      raise RecipeError(f'{line}: expected copy: <local path>:<image path>')
+    full = local_path(line, src.strip())
+    files[src.strip()] = path_sha256(full)
+
+    # a directory is copied into dest, a file is written to dest
+    if os.path.isdir(full):
+      args = ['--mkdir', dest.strip(), '--copy-in', f'{full}:{dest.strip()}']
+    else:
+      args = ['--upload', f'{full}:{dest.strip()}']
+  elif kind == 'run':
+    full = local_path(line, arg)
+    files[arg] = path_sha256(full)
+    args = ['--run', full]
+  elif kind == 'command':
+    args = ['--run-command', arg]
+  else:
+    raise RecipeError(f'{line}: unknown layer type "{kind}" - expected packages, copy, run or command')
+
+  return {'line': line, 'args': args, 'spec': {'layer': f'{kind}: {arg}', 'files': files}}
+
+# recipe lines from devbox.ini or the recipe file - blank lines and comments are skipped
+def recipe_lines():
+  recipe_file = conf_opt('image', 'recipe', '')
+  if recipe_file:
+    try:
+      with open(os.path.join(_config_dir, recipe_file)) as f:
+        lines = f.read().splitlines()
+    except OSError as e:
+      raise RecipeError(f'unable to read recipe {recipe_file}: {e}')
+  else:
+    lines = conf_opt('image', 'layers', '').splitlines()
+  return [line.strip() for line in lines if line.strip() and not line.strip().startswith(('#', ';'))]
+
+# ordered layers of the recipe - the guest agent layer first
+def recipe_layers():
+  lines = recipe_lines()
+  if agent_layer not in lines:
+    lines.insert(0, agent_layer)
+  return [parse_layer(line) for line in lines]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# cluster-wide reservation of devbox slots
+# a slot is reserved by creating the empty proxmox pool devbox-<dev_id>-<vmid>.
+# creating a pool that exists fails, so of several nodes create runs on any host
+# only one gets a slot - the others move on to the next free one. the pool comment
+# holds an expiry, so the reservations of a run that died lapse on their own.
+# a reservation is released once the vm exists and holds the slot itself.
+
+import socket, atexit
+
+# devbox
+from devbox_config import *
+
+reservation_prefix = f'devbox-{dev_id}-'
+
+# vmids reserved by this process
+held = set()
+
+# pool holding the reservation of a slot
+def reservation_pool(vmid):
+  return f'{reservation_prefix}{vmid}'
+
+# unix time a reservation lapses - read from its pool comment
+def reservation_expiry(comment):
+  for field in (comment or '').split():
+    if field.startswith('expires='):
+      try:
+        return float(field[8:])
+      except ValueError:
+        pass
+  return 0
+
+# vmid: expiry of every reservation in the devbox range
+def reservations():
+  result = {}
+  for pool in state.api(lambda: state.prox.pools.get()):
+    suffix = pool.get('poolid', '')[len(reservation_prefix):]
+    if pool.get('poolid', '').startswith(reservation_prefix) and suffix.isdigit():
+      result[int(suffix)] = reservation_expiry(pool.get('comment'))
+  return result
+
+# create the reservation pool of a slot - False if someone else holds it.
+# only a pool that exists means contention, any other failure ends the run
+def reserve(vmid, ttl):
+  comment = f'expires={time.time() + ttl:.0f} holder={socket.gethostname()}:{os.getpid()}'
+  try:
+    state.prox.pools.post(poolid=reservation_pool(vmid), comment=comment)
+  except Exception as e:
+    if 'already exists' in str(e):
+      return False
+    kmsg('reserve_slot', f'unable to reserve {vmid}: {e}', 'err')
+    exit(1)
+  held.add(vmid)
+  return True
+
+# reserve count free slots - the lowest first, or the highest with spare
+# fewer are returned if the devbox range runs out
+def reserve_slots(count, ttl=reservation_ttl, spare=False):
+
+  # the pools are listed before the vm list is fetched - a peer creates its vm before
+  # it drops its reservation, so a slot it took is seen in one or the other
+  live = reservations()
+  state.refresh('resources')
+
+  # lapsed reservations are removed, live ones count as used slots
+  now = time.time()
+  for vmid, expires in live.items():
+    if expires > now:
+      state.slots.take(vmid)
+    else:
+      try:
+        state.prox.pools(reservation_pool(vmid)).delete()
+      except Exception:
+        pass
+
+  # a slot taken between the pool list and the create is skipped
+  vmids = []
+  while len(vmids) < count:
+    vmid = state.slots.last_free() if spare else state.slots.first_free()
+    if vmid is None:
+      break
+    state.slots.take(vmid)
+    if reserve(vmid, ttl):
+      vmids.append(vmid)
+  return vmids
+
+# give a slot back - only reservations made by this process
+def release(vmid):
+  if vmid not in held:
+    return
+  held.discard(vmid)
+  try:
+    state.prox.pools(reservation_pool(vmid)).delete()
+  except Exception:
+    pass
+
+# reservations still held when the process exits are released
+@atexit.register
+def release_all():
+  for vmid in list(held):
+    release(vmid)
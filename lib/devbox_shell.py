@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+# interactive and local commands run against a node
+# kept free of api imports so the devboxd fast path can use them
+
+import os, subprocess
+
+# kmsg
+from devbox_kmsg import kmsg
+
+# serial console via qm terminal
+def node_terminal(vmid, user, password):
+  kmsg('node_terminal', f'u/p: {user} / {password}', 'sys')
+  subprocess.run(['sudo', 'qm', 'terminal', str(vmid)])
+
+# ssh session to the node
+def node_ssh(user, ip):
+  subprocess.run([
+    'ssh',
+    '-l', user, ip,
+    '-t',                                   # force TTY allocation
+    '-o', 'StrictHostKeyChecking=no',
+    '-o', 'ServerAliveInterval=15',         # detect dead connections
+    '-o', 'ServerAliveCountMax=3',
+    '-o', 'ExitOnForwardFailure=yes',
+  ], env={**os.environ, 'TERM': os.environ.get('TERM', 'xterm-256color')})
+
+# reboot without waiting
+def node_reboot(vmid):
+  subprocess.Popen(['sudo', 'qm', 'reboot', str(vmid)])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# vmid / ip slot index of the devbox range
+# every slot is one vmid and the ip derived from it, so one bitmap tracks both.
+# the bitmap is a python int with a set bit per used slot - the lowest free slot
+# is its lowest clear bit, found with word-level bit operations instead of a scan
+
+class SlotIndex:
+
+  # slots first .. first + size - 1 with the vmids in used taken
+  def __init__(self, first, size, used=()):
+    self.first = first
+    self.size = size
+    self.mask = (1 << size) - 1
+    self.bits = 0
+    for vmid in used:
+      self.take(vmid)
+
+  def __contains__(self, vmid):
+    return self.first <= vmid < self.first + self.size
+
+  # mark a slot used - vmids outside the index are ignored
+  def take(self, vmid):
+    if vmid in self:
+      self.bits |= 1 << (vmid - self.first)
+
+  # mark a slot free
+  def release(self, vmid):
+    if vmid in self:
+      self.bits &= ~(1 << (vmid - self.first))
+
+  def used(self, vmid):
+    return vmid in self and bool(self.bits >> (vmid - self.first) & 1)
+
+  # number of free slots
+  def free_count(self):
+    return self.size - bin(self.bits).count('1')
+
+  # lowest free slot or None
+  def first_free(self):
+    free = ~self.bits & self.mask
+    if not free:
+      return None
+    return self.first + (free & -free).bit_length() - 1
+
+  # highest free slot or None
+  def last_free(self):
+    free = ~self.bits & self.mask
+    if not free:
+      return None
+    return self.first + free.bit_length() - 1
+
+  # the count lowest free slots, first fit - they are marked used
+  # fewer are returned if the index runs out
+  def allocate(self, count):
+    vmids = []
+    while len(vmids) < count:
+      vmid = self.first_free()
+      if vmid is None:
+        break
+      self.take(vmid)
+      vmids.append(vmid)
+    return vmids
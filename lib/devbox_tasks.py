@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# multiplexed proxmox task waiter
+# one poller thread waits on every pending upid in the process - a single task
+# is checked with its status endpoint, several tasks on the same node share one
+# tasks listing per tick. polling starts fast and backs off as tasks age.
+
+import time, threading
+
+# raised when a task stops with a non-OK exit status or cannot be polled
+class TaskError(Exception):
+
+  def __init__(self, upid, exitstatus, log=''):
+    self.upid = upid
+    self.exitstatus = exitstatus
+    self.log = log
+    super().__init__(f'task exited with non-OK status ({exitstatus})\n{log}'.strip())
+
+# a submitted task - done is set once the task has stopped
+class Task:
+
+  def __init__(self, upid):
+    self.upid = upid
+    self.node = upid.split(':')[1]
+    self.started = time.monotonic()
+
+    # start time in the upid - used as the since filter for tasks listings
+    self.starttime = int(upid.split(':')[4], 16)
+    self.done = threading.Event()
+    self.exitstatus = None
+    self.error = None
+
+class TaskWaiter:
+
+  # poll interval is a fraction of the youngest pending task's age, within these bounds
+  min_interval = 0.1
+  max_interval = 2.0
+  age_factor = 0.2
+
+  # consecutive failed polls before pending tasks are failed
+  max_errors = 5
+
+  def __init__(self, prox):
+    self.prox = prox
+    self.pending = {}
+    self.lock = threading.Condition()
+    self.poller = None
+
+  # register a task and return its handle - the poller is started on demand
+  def submit(self, upid):
+    with self.lock:
+      task = self.pending.get(upid)
+      if not task:
+        task = self.pending[upid] = Task(upid)
+      if not (self.poller and self.poller.is_alive()):
+        self.poller = threading.Thread(target=self._poll, name='devbox-tasks', daemon=True)
+        self.poller.start()
+
+      # wake the poller so a new task is checked at the fast interval
+      self.lock.notify()
+    return task
+
+  # wait for one or more upids - raises TaskError for the first non-OK task
+  # apis that run synchronously return None instead of a upid, nothing to wait for
+  def wait(self, upids, timeout=None):
+    if isinstance(upids, str) or upids is None:
+      upids = [upids]
+    tasks = [self.submit(upid) for upid in upids if upid]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for task in tasks:
+      remaining = None if deadline is None else max(0, deadline - time.monotonic())
+      if not task.done.wait(remaining):
+        raise TaskError(task.upid, f'timed out after {timeout}s')
+      if task.error:
+        raise task.error
+    return [task.exitstatus for task in tasks]
+
+  # poller thread - runs until no tasks are pending
+  def _poll(self):
+    errors = 0
+    while True:
+      with self.lock:
+        if not self.pending:
+          self.poller = None
+          return
+        tasks = list(self.pending.values())
+        youngest = min(time.monotonic() - task.started for task in tasks)
+        interval = min(self.max_interval, max(self.min_interval, youngest * self.age_factor))
+        self.lock.wait(interval)
+        tasks = list(self.pending.values())
+
+      # one request per node per tick
+      try:
+        by_node = {}
+        for task in tasks:
+          by_node.setdefault(task.node, []).append(task)
+        for node, node_tasks in by_node.items():
+          self._check(node, node_tasks)
+        errors = 0
+      except Exception as e:
+        errors += 1
+        if errors >= self.max_errors:
+          self._fail(tasks, f'unable to get task status: {e}')
+
+  # check the tasks pending on a node
+  def _check(self, node, tasks):
+
+    # a single task - its status endpoint is one request and exact
+    if len(tasks) == 1:
+      status = self.prox.nodes(node).tasks(tasks[0].upid).status.get()
+      if status.get('status') == 'stopped':
+        self._finish(tasks[0], status.get('exitstatus'))
+      return
+
+    # several tasks - one listing of everything started since the oldest
+    listing = self.prox.nodes(node).tasks.get(
+      source='all',
+      since=min(task.starttime for task in tasks),
+      limit=1000,
+    )
+    listed = {entry.get('upid'): entry for entry in listing}
+    for task in tasks:
+      entry = listed.get(task.upid)
+
+      # not listed - fall back to the status endpoint
+      if entry is None:
+        status = self.prox.nodes(node).tasks(task.upid).status.get()
+        if status.get('status') == 'stopped':
+          self._finish(task, status.get('exitstatus'))
+
+      # finished tasks carry their exit status, running ones do not
+      elif entry.get('status') and entry.get('endtime'):
+        self._finish(task, entry.get('status'))
+
+  # record a stopped task and release its waiters
+  def _finish(self, task, exitstatus):
+    task.exitstatus = exitstatus
+    if exitstatus != 'OK':
+      try:
+        log = '\n'.join(line['t'] for line in self.prox.nodes(task.node).tasks(task.upid).log.get())
+      except Exception as e:
+        log = f'failed to get task log: {e}'
+      task.error = TaskError(task.upid, exitstatus, log)
+    with self.lock:
+      self.pending.pop(task.upid, None)
+    task.done.set()
+
+  # fail tasks that can no longer be polled
+  def _fail(self, tasks, reason):
+    for task in tasks:
+      task.error = TaskError(task.upid, reason)
+      with self.lock:
+        self.pending.pop(task.upid, None)
+      task.done.set()
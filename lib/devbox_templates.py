@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# template generations
+# every template is tagged with its generation and nodes are cloned from the highest
+# generation that is also tagged ready - so promoting a new template is one config
+# write. a new generation is built under its own vmid and test booted before it is
+# promoted, and older generations are removed once no devbox was cloned from them.
+# with local storage a generation is copied to other nodes as replicas, so linked
+# clones can be made on those nodes too.
+
+import re, fcntl
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# devbox
+from devbox_config import *
+from devbox_cache import cache_dir
+from devbox_proxmox import prox_task, clone
+from devbox_phonehome import remove_snippet
+
+# generations kept below the current one whether in use or not - a nodes create
+# that looked up the template just before a promotion still finds it
+keep_previous = 1
+
+# only one image build or update runs at a time
+@contextmanager
+def image_lock(kname):
+  os.makedirs(cache_dir, exist_ok=True)
+  with open(os.path.join(cache_dir, f'image-{dev_id}.lock'), 'w') as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      kmsg(kname, 'another image create or update is running', 'err')
+      exit(1)
+    yield
+
+# replicas made at a time - each reads the whole template disk on its node
+replicate_parallel = 4
+
+# vmid for a new generation or replica - outside the devbox range so nodes never take
+# it, and not one of taken, picked for copies that do not exist yet
+def template_vmid(taken=()):
+  vmid = int(state.api(lambda: state.prox.cluster.nextid.get()))
+  if not in_range(vmid) and vmid not in taken:
+    return vmid
+
+  # probe the ids after it - past the devbox range
+  vmid = range_end if in_range(vmid) else vmid + 1
+  while True:
+    if vmid not in taken:
+      try:
+        state.prox.cluster.nextid.get(vmid=vmid)
+        return vmid
+      except Exception:
+        pass
+    vmid += 1
+
+# generation number for a new template
+def next_generation():
+  return max(state.templates, default=0) + 1
+
+# tags of a generation - the ready tag is added when it is promoted
+def template_tags(generation, ready=False):
+  return ';'.join([template_tag, f'gen-{generation}'] + ([ready_tag] if ready else []))
+
+# make a generation the one nodes are cloned from
+def promote(vmid, generation, node=node):
+  prox_task(state.prox.nodes(node).qemu(vmid).config.post(tags=template_tags(generation, ready=True)))
+  state.refresh('resources', 'image')
+
+# stop and delete a vm that is being thrown away - errors are ignored
+def discard(vmid, node=node):
+  for request in [lambda: state.prox.nodes(node).qemu(vmid).status.stop.post(), lambda: state.prox.nodes(node).qemu(vmid).delete()]:
+    try:
+      state.tasks.wait(request())
+    except Exception:
+      pass
+  remove_snippet(vmid)
+  state.refresh('resources')
+
+# boot a linked clone of a new template the way nodes create would - raises
+# TaskError or AgentError if it does not come up with network access
+def validate(template):
+  state.refresh('resources')
+  vmid = spare_id()
+  kmsg('image_validate', f'test booting {vmid} from {template["vmid"]}')
+  try:
+    clone(vmid, validate_name, template)
+
+  # the clone lands on the template's node, which need not be the configured one
+  finally:
+    discard(vmid, template['node'])
+
+# copy template to target as a replica - a full clone on the template's node that is
+# migrated with its local disk while it is still a vm, then converted. the ready
+# tag is written last, so a replica is only cloned from once it is complete
+def replicate_to(template, vmid, target):
+  tnode = template['node']
+  tags = ';'.join([template_tag, f'gen-{template["generation"]}', replica_tag])
+  try:
+    state.tasks.wait(state.prox.nodes(tnode).qemu(template['vmid']).clone.post(
+      newid=vmid,
+      full=1,
+      storage=storage,
+      name='devboximg',
+    ))
+    state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).config.post(tags=tags))
+    state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).migrate.post(target=target, targetstorage=storage, **{'with-local-disks': 1}))
+    state.tasks.wait(state.prox.nodes(target).qemu(vmid).template.post())
+    state.tasks.wait(state.prox.nodes(target).qemu(vmid).config.post(tags=f'{tags};{ready_tag}'))
+
+  # the copy is removed from wherever it got to
+  except Exception:
+    for vm_node in [target, tnode]:
+      try:
+        state.tasks.wait(state.prox.nodes(vm_node).qemu(vmid).delete())
+      except Exception:
+        pass
+    raise
+
+# copy template to nodes in parallel - nodes holding it or a replica of it are skipped
+# returns node: vmid of the new replicas, failed nodes are reported and left out
+def replicate(template, nodes):
+  kname = 'image_replicate'
+  nodes = [target for target in nodes if target != template['node'] and target not in template['replicas']]
+  vmids = []
+  for _ in nodes:
+    vmids.append(template_vmid(vmids))
+  if not nodes:
+    kmsg(kname, f'gen-{template["generation"]} is on every node already')
+    return {}
+  kmsg(kname, f'gen-{template["generation"]} ({template["vmid"]}) > {", ".join(f"{vmid} [{target}]" for target, vmid in zip(nodes, vmids))}', 'sys')
+
+  # the task waiter is set up once before any worker starts
+  state.tasks
+  with ThreadPoolExecutor(max_workers=replicate_parallel) as pool:
+    futures = {target: (vmid, pool.submit(replicate_to, template, vmid, target)) for target, vmid in zip(nodes, vmids)}
+
+  replicas = {}
+  for target, (vmid, future) in futures.items():
+    try:
+      future.result()
+      replicas[target] = vmid
+      kmsg(kname, f'{vmid} [{target}] ready')
+    except Exception as e:
+      kmsg(kname, f'unable to replicate to [{target}]: {e}', 'err')
+  state.refresh('resources')
+  return replicas
+
+# template vmids the devboxes were cloned from - None if that cannot be told for one
+# of them, from its source tag or a base volume in its config
+def templates_in_use():
+  in_use = set()
+  template_ids = template_nodes()
+  tags = {int(vm.get('vmid')): (vm.get('tags') or '').split(';') for vm in state.resources}
+  for vmid, vm_node in state.vms.items():
+    if vmid in template_ids:
+      continue
+    sources = [int(tag[11:]) for tag in tags.get(vmid, []) if tag.startswith('devbox-src-') and tag[11:].isdigit()]
+    if not sources:
+      config = state.api(lambda: state.prox.nodes(vm_node).qemu(vmid).config.get())
+      sources = [int(base) for value in config.values() for base in re.findall(r':base-(\d+)-disk', str(value))]
+    if not sources:
+      return None
+    in_use.update(sources)
+  return in_use
+
+# remove generations older than the current one that no devbox was cloned from
+# unused replicas go first - a template only once none of its copies is in use.
+# proxmox refuses to delete a template that still has linked clones - that is reported and skipped
+def collect_garbage():
+  kname = 'image_gc'
+  state.refresh('resources')
+  current = state.template
+  if not current:
+    return
+  in_use = templates_in_use()
+  if in_use is None:
+    kmsg(kname, 'unable to tell which template every devbox was cloned from - keeping old generations', 'sys')
+    return
+
+  older = [generation for generation in state.templates if generation < current['generation']]
+  kept = sorted(generation for generation in older if state.templates[generation]['ready'])[-keep_previous:] if keep_previous else []
+  def remove(generation, vmid, vm_node):
+    try:
+      state.tasks.wait(state.prox.nodes(vm_node).qemu(vmid).delete())
+      kmsg(kname, f'removed gen-{generation} ({vmid}) [{vm_node}]')
+      return True
+    except Exception as e:
+      kmsg(kname, f'unable to remove gen-{generation} ({vmid}) [{vm_node}]: {e}', 'err')
+      return False
+
+  for generation in older:
+    template = state.templates[generation]
+    if generation in kept:
+      continue
+    removed = [remove(generation, vmid, replica_node) for replica_node, vmid in template['replicas'].items() if vmid not in in_use]
+    if template['vmid'] not in in_use and len(removed) == len(template['replicas']) and all(removed):
+      remove(generation, template['vmid'], template['node'])
+  state.refresh('resources')
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# timing spans for lifecycle operations
+# a span times one phase of a command - the clone task, the config write, the wait for
+# the guest. spans nest through a context variable, so the phases of a clone run in a
+# worker thread or an asyncio task stay under that clone. when the process exits the
+# spans are appended to a json lines trace file, summed up with --timings, and added
+# to a prometheus textfile histogram so create latency can be graphed across runs.
+
+import os, sys, json, math, time, fcntl, atexit, secrets, tempfile, threading, itertools, contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+# devbox
+from devbox_opts import opts
+
+# one trace per process
+trace_id = secrets.token_hex(8)
+
+# finished spans in the order they ended
+spans = []
+lock = threading.Lock()
+ids = itertools.count(1)
+
+# span the code running now belongs to
+current = contextvars.ContextVar('devbox_span', default=None)
+
+# histogram buckets of the textfile export in seconds
+buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+# time a phase - attrs are stored with the span, an exception is recorded and raised
+@contextmanager
+def span(name, **attrs):
+  parent = current.get()
+  record = {
+    'trace': trace_id,
+    'span': next(ids),
+    'parent': parent['span'] if parent else None,
+    'name': name,
+    'start': time.time(),
+    'attrs': attrs,
+  }
+  reset = current.set(record)
+  begin = time.perf_counter()
+  try:
+    yield record
+  except BaseException as e:
+    if not (isinstance(e, SystemExit) and not e.code):
+      record['error'] = f'{type(e).__name__}: {e}'.splitlines()[0]
+    raise
+  finally:
+    record['ms'] = round((time.perf_counter() - begin) * 1000, 3)
+    current.reset(reset)
+    with lock:
+      spans.append(record)
+
+# time every call of a function as a span
+def traced(name):
+  def decorate(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorate
+
+# add attributes to the span the code running now belongs to
+def annotate(**attrs):
+  record = current.get()
+  if record:
+    record['attrs'].update(attrs)
+
+# run a function in a worker thread under the span of the caller
+def in_context(function):
+  context = contextvars.copy_context()
+  return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+# nearest rank percentile of sorted values
+def percentile(values, p):
+  return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+# name: sorted durations in ms - names in the order they first started
+def durations():
+  by_name = {}
+  for record in sorted(spans, key=lambda r: r['start']):
+    by_name.setdefault(record['name'], []).append(record['ms'])
+  return {name: sorted(values) for name, values in by_name.items()}
+
+# --timings table
+def summary(out=sys.stderr):
+  print(f'\n{"span":<24} {"count":>5} {"total ms":>10} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9}', file=out)
+  for name, values in durations().items():
+    print(f'{name:<24} {len(values):>5} {sum(values):>10.1f} {percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f} {values[-1]:>9.1f}', file=out)
+
+# append every span to a json lines file
+def write_trace(path):
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path, 'a') as f:
+    for record in sorted(spans, key=lambda r: r['start']):
+      f.write(json.dumps(record) + '\n')
+
+# write a file atomically - a reader never sees half of it
+def replace_file(path, data):
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='.devbox-')
+  with os.fdopen(fd, 'w') as f:
+    f.write(data)
+  os.chmod(tmp, 0o644)
+  os.replace(tmp, path)
+
+# count this run's spans into name: {buckets, count, sum}
+def add_spans(histograms):
+  for name, values in durations().items():
+    histogram = histograms.setdefault(name, {'buckets': [0] * len(buckets), 'count': 0, 'sum': 0})
+    for ms in values:
+      seconds = ms / 1000
+      histogram['count'] += 1
+      histogram['sum'] += seconds
+      for i, bound in enumerate(buckets):
+        if seconds <= bound:
+          histogram['buckets'][i] += 1
+
+# add this run's spans to the histograms kept in state and rewrite the textfile
+# the textfile collector reads a snapshot, so the counts carry over from run to run
+def write_textfile(path, state_path, labels):
+  os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+  with open(f'{state_path}.lock', 'w') as state_lock:
+    fcntl.flock(state_lock, fcntl.LOCK_EX)
+    try:
+      with open(state_path) as f:
+        histograms = json.load(f)
+    except (OSError, ValueError):
+      histograms = {}
+    add_spans(histograms)
+    replace_file(state_path, json.dumps(histograms))
+
+  extra = ''.join(f',{key}="{value}"' for key, value in labels.items())
+  lines = [
+    '# HELP devbox_span_seconds Time spent in devbox lifecycle phases.',
+    '# TYPE devbox_span_seconds histogram',
+  ]
+  for name, histogram in sorted(histograms.items()):
+    for bound, count in zip(buckets, histogram['buckets']):
+      lines.append(f'devbox_span_seconds_bucket{{span="{name}"{extra},le="{bound}"}} {count}')
+    lines.append(f'devbox_span_seconds_bucket{{span="{name}"{extra},le="+Inf"}} {histogram["count"]}')
+    lines.append(f'devbox_span_seconds_sum{{span="{name}"{extra}}} {histogram["sum"]:.6f}')
+    lines.append(f'devbox_span_seconds_count{{span="{name}"{extra}}} {histogram["count"]}')
+  replace_file(path, '\n'.join(lines) + '\n')
+
+# export the spans of this run - [trace] settings are read once the command is done
+@atexit.register
+def export():
+  if not spans:
+    return
+  if opts.get('timings'):
+    summary()
+  if 'devbox_config' not in sys.modules:
+    return
+  from devbox_config import conf_opt, dev_id
+  from devbox_cache import cache_dir
+  from devbox_kmsg import kmsg
+
+  # --trace writes to the [trace] file, or to trace.jsonl in the cache if that is not set
+  trace_file = conf_opt('trace', 'file', '')
+  if opts.get('trace'):
+    trace_file = opts['trace'] if isinstance(opts['trace'], str) else trace_file or os.path.join(cache_dir, 'trace.jsonl')
+  textfile = conf_opt('trace', 'textfile', '')
+  try:
+    if trace_file:
+      write_trace(os.path.expanduser(trace_file))
+    if textfile:
+      write_textfile(os.path.expanduser(textfile), os.path.join(cache_dir, f'metrics-{dev_id}.json'), {'dev_id': dev_id})
+  except OSError as e:
+    kmsg('trace_export', f'unable to write timings: {e}', 'err')
@@ -1,95 +1,327 @@
 #!/usr/bin/env python3
 
 # functions
+import json, shlex
 from devbox_config import *
+from devbox_images import images_dir, layer_ext, image_key, lookup, staging_path, store
+from devbox_recipe import recipe_layers, RecipeError
+from devbox_trace import span, traced
 
 # proxmox functions
 from devbox_proxmox import prox_task, prox_destroy
+from devbox_reserve import release
+from devbox_templates import image_lock, template_vmid, next_generation, template_tags, promote, discard, validate, replicate, collect_garbage
 
-# define command
-cmd = sys.argv[2]
 kname = 'image_'
 
-# create image
-if cmd == 'create':
+# download the cloud image into the image cache - returns (path, sha256)
+# skipped when the cached copy is current upstream, --refresh downloads again
+@traced('image.download')
+def fetch_cloud_image(cloud_image):
+  from devbox_download import download, DownloadError
+  pristine = os.path.join(images_dir, cloud_image)
+  os.makedirs(images_dir, exist_ok=True)
+  if opts.get('refresh') and os.path.exists(f'{pristine}.json'):
+    os.remove(f'{pristine}.json')
+  try:
+    kmsg(f'{kname}download', f'{cloud_image_url}')
+    changed, sha256 = download(cloud_image_url, pristine, int(opts.get('parallel', download_parallel)), checksum_file)
+  except DownloadError as e:
+    kmsg(f'{kname}check', str(e), 'err')
+    exit(1)
+  kmsg(f'{kname}download', f'{"downloaded" if changed else "unchanged upstream"} sha256:{sha256}')
+  return pristine, sha256
+
+# disk format of a local image
+def image_format(path):
+  return json.loads(local_os_process(f'qemu-img info --output=json {shlex.quote(path)}').stdout)['format']
+
+# build the recipe layers on the downloaded image - returns the path of a flattened image
+# each layer is an overlay on the one before it, cached by its parent and its spec,
+# so only the first changed layer and the layers after it are customized again
+@traced('image.customize')
+def build_image(pristine, sha256):
+  try:
+    layers = recipe_layers()
+  except RecipeError as e:
+    kmsg(f'{kname}recipe', str(e), 'err')
+    exit(1)
+  limit = image_cache_size * 1073741824
+
+  # the flattened image is cached under the key of the last layer
+  keys = []
+  key = sha256
+  for layer in layers:
+    key = image_key(key, layer['spec'])
+    keys.append(key)
+  custom_image = None if opts.get('refresh') else lookup(key)
+  if custom_image:
+    for layer_key in keys:
+      lookup(layer_key, layer_ext)
+    kmsg(f'{kname}cache', f'reusing customized image {key[:12]}')
+    return custom_image
+
+  # layers - reused until the first one that changed
+  parent, parent_format, parent_key = pristine, image_format(pristine), None
+  for i, (layer, key) in enumerate(zip(layers, keys), 1):
+    path = None if opts.get('refresh') else lookup(key, layer_ext)
+    if path:
+      kmsg(f'{kname}layer', f'{i}/{len(layers)} cached {key[:12]} {layer["line"]}')
+    else:
+      kmsg(f'{kname}layer', f'{i}/{len(layers)} building {key[:12]} {layer["line"]}')
+      staged = staging_path(key, layer_ext)
+      local_os_process(f'qemu-img create -q -f qcow2 -F {parent_format} -b {shlex.quote(parent)} {shlex.quote(staged)}')
+      local_os_process(f'sudo virt-customize -q -a {shlex.quote(staged)} {shlex.join(layer["args"])}')
+      path = store(key, staged, {'parent': parent_key, 'layer': layer['line'], 'url': cloud_image_url, 'sha256': sha256}, limit, layer_ext)
+    parent, parent_format, parent_key = path, 'qcow2', key
+
+  # flatten the layers into one standalone image for import-from
+  staged = staging_path(key)
+  local_os_process(f'qemu-img convert -O qcow2 {shlex.quote(parent)} {shlex.quote(staged)}')
+  custom_image = store(key, staged, {'url': cloud_image_url, 'sha256': sha256, 'layers': [layer['line'] for layer in layers]}, limit)
+  kmsg(f'{kname}cache', f'stored customized image {key[:12]}')
+  return custom_image
+
+# create image - built under a new vmid so nodes keep cloning the current template
+# until the new one has been test booted and promoted
+def image_create():
+  from proxmoxer.core import ResourceException
+  from requests.exceptions import RequestException
 
   # get image name from url
   cloud_image = cloud_image_url.split('/')[-1]
-  kmsg(f'{kname}create', f'{cloud_image} {storage}/{dev_id}', 'sys')
+  with image_lock(f'{kname}create'):
+    kmsg(f'{kname}create', f'{cloud_image} {storage}', 'sys')
 
-  # check if image already exists and remove it
-  if os.path.isfile(cloud_image):
-    kmsg('image_check', f'{cloud_image} already exists - removing', 'sys')
+    # check node and storage before downloading
+    state.node
+    state.storage_type
+
+    # download and customize - both reused from the image cache when nothing changed
+    pristine, sha256 = fetch_cloud_image(cloud_image)
+    custom_image = build_image(pristine, sha256)
+
+    # define image desc
+    from datetime import datetime
+    img_ts = str(datetime.now())
+    image_desc = f'devbox {img_ts}'
+    generation = next_generation()
+    vmid = template_vmid()
+    kmsg(f'{kname}create', f'building gen-{generation} in {vmid}')
+
+    # a failed step removes the new vm - the current template is left as it was
     try:
-      os.remove(cloud_image)
-      if os.path.isfile(cloud_image):
-        kmsg(f'{kname}check', f'{cloud_image} still exists after removal', 'err')
-        exit(1)
-    except OSError as e:
-      kmsg(f'{kname}check', f'{cloud_image} cannot delete: {e}', 'err')
+
+      # create new template vm
+      prox_task(state.prox.nodes(node).qemu.post(
+        vmid=vmid,
+        cores=1,
+        memory=1024,
+        bios='ovmf',
+        efidisk0=f'{storage}:0',
+        machine='q35',
+        cpu='cputype=x86-64-v3',
+        scsihw='virtio-scsi-single',
+        name='devboximg',
+        ostype='l26',
+        scsi2=f'{storage}:cloudinit',
+        serial0='socket',
+        agent='enabled=true',
+        hotplug=0,
+        ciupgrade=0,
+        description=image_desc,
+        ciuser=cloudinituser,
+        cipassword=cloudinitpass,
+        sshkeys=cloudinitsshkey,
+        tags=template_tags(generation),
+      ))
+
+      # import disk from the image cache - requires full path for import-from
+      import_cmd = f'sudo qm set {vmid} --scsi0 {storage}:0,import-from={shlex.quote(custom_image)},iothread=true,aio=io_uring'
+      with span('image.import', vmid=vmid):
+        local_os_process(import_cmd)
+
+      # convert to template
+      with span('image.template', vmid=vmid):
+        prox_task(state.prox.nodes(node).qemu(vmid).template.post())
+        prox_task(state.prox.nodes(node).qemu(vmid).config.post(template=1))
+
+    # rejected and dropped api requests are not reported by prox_task
+    except (ResourceException, RequestException) as e:
+      kmsg(f'{kname}create', f'build failed - removing {vmid}: {e}', 'err')
+      discard(vmid)
       exit(1)
+    except SystemExit:
+      discard(vmid)
+      raise
+    kmsg(f'{kname}qm-import', 'done')
+    publish(vmid, generation)
 
-  # download cloud image
+# test boot a built template, make it the one nodes are cloned from and remove
+# the generations no devbox uses any more. the new generation is replicated to
+# the nodes that held a replica of the one it replaces
+def publish(vmid, generation, tnode=node):
+  from devbox_agent import AgentError
+  from devbox_tasks import TaskError
+  from proxmoxer.core import ResourceException
+  from requests.exceptions import RequestException
   try:
-    kmsg(f'{kname}wget', f'{cloud_image_url}')
-    wget.download(cloud_image_url)
-    print()
-  except Exception as e:
-    kmsg(f'{kname}check', f'unable to download {cloud_image_url}: {e}', 'err')
+    with span('image.validate', vmid=vmid, generation=generation):
+      validate({'vmid': vmid, 'node': tnode, 'generation': generation, 'replicas': {}})
+  except (TaskError, AgentError, ResourceException, RequestException) as e:
+    kmsg(f'{kname}validate', f'gen-{generation} failed to boot - removing {vmid}: {e}', 'err')
+    discard(vmid, tnode)
     exit(1)
 
-  # install qemu-guest-agent into the image
-  kmsg(f'{kname}virt-customize', 'configuring image')
-  virtc_cmd = f'sudo virt-customize -a {cloud_image} --install qemu-guest-agent'
-  local_os_process(virtc_cmd)
+  # a lookup of the test boot that failed has reported itself
+  except SystemExit:
+    discard(vmid, tnode)
+    raise
+  previous = state.template
+  promote(vmid, generation, tnode)
+  kmsg(f'{kname}publish', f'gen-{generation} ({vmid}) is current')
+  if previous and previous['replicas']:
+    replicate(state.template, list(previous['replicas']))
 
-  # define image desc
-  img_ts = str(datetime.now())
-  image_desc = f'devbox {img_ts}'
+  # pool vms of the old generation are replaced by clones of the new one
+  if warm_pool:
+    from devbox_pool import pool_drain
+    pool_drain()
+  collect_garbage()
+  if warm_pool:
+    from devbox_pool import pool_refill_background
+    pool_refill_background()
 
-  # destroy existing template if it exists
-  try:
-    prox_destroy(dev_id)
-  except Exception:
-    pass
-
-  # create new template vm
-  prox_task(prox.nodes(node).qemu.post(
-    vmid=dev_id,
-    cores=1,
-    memory=1024,
-    bios='ovmf',
-    efidisk0=f'{storage}:0',
-    machine='q35',
-    cpu='cputype=x86-64-v3',
-    scsihw='virtio-scsi-single',
-    name='devboximg',
-    ostype='l26',
-    scsi2=f'{storage}:cloudinit',
-    serial0='socket',
-    agent='enabled=true',
-    hotplug=0,
-    ciupgrade=0,
-    description=image_desc,
-    ciuser=cloudinituser,
-    cipassword=cloudinitpass,
-    sshkeys=cloudinitsshkey,
-  ))
-
-  # import disk - requires full path for import-from
-  import_cmd = f'sudo qm set {dev_id} --scsi0 {storage}:0,import-from={os.getcwd()}/{cloud_image},iothread=true,aio=io_uring && mv {cloud_image} {cloud_image}.patched'
-  local_os_process(import_cmd)
-
-  # convert to template
-  prox_task(prox.nodes(node).qemu(dev_id).template.post())
-  prox_task(prox.nodes(node).qemu(dev_id).config.post(template=1))
-  kmsg(f'{kname}qm-import', 'done')
-
-# image info
-if cmd == 'info':
-  image_info()
-
-# destroy image
-if cmd == 'destroy':
-  kmsg(f'{kname}destroy', f'{devbox_img()}/{cloud_image_desc}', 'sys')
-  prox_destroy(dev_id)
+# package upgrade run in the update vm - cloud-init finishes its first boot first
+update_cmds = [
+  'cloud-init status --wait > /dev/null || true',
+  'DEBIAN_FRONTEND=noninteractive apt-get -q update',
+  'DEBIAN_FRONTEND=noninteractive apt-get -q -y -o Dpkg::Options::=--force-confold dist-upgrade',
+  'DEBIAN_FRONTEND=noninteractive apt-get -q -y autoremove --purge && apt-get -q clean',
+]
+
+# reset per-vm state so clones of the new template boot like clones of a fresh image
+cleanup_cmds = [
+  'cloud-init clean --logs --seed',
+  'rm -f /etc/ssh/ssh_host_*',
+  'truncate -s 0 /etc/machine-id && rm -f /var/lib/dbus/machine-id',
+  'sync',
+]
+
+# seconds allowed for the upgrade
+update_timeout = 1800
+
+# update image - upgrade a full clone of the current template and promote it to a
+# new generation. the old template is kept for the linked clones made from it
+def image_update():
+  from devbox_agent import AgentSession, AgentError
+  from devbox_tasks import TaskError
+  from proxmoxer.core import ResourceException
+  from requests.exceptions import RequestException
+  from datetime import datetime
+  with image_lock(f'{kname}update'):
+    state.refresh('resources')
+    template = state.template
+    if not template:
+      kmsg(f'{kname}update', 'image not found - please run "devbox image create"', 'err')
+      exit(1)
+    tnode = template['node']
+    vmid = template_vmid()
+    generation = next_generation()
+
+    # the update vm borrows the address of a spare devbox slot - reserved for as long as the update may run
+    slot = spare_id(update_timeout + reservation_ttl)
+    ip = f'{vmip(slot)}/{network_mask}'
+    kmsg(f'{kname}update', f'gen-{template["generation"]} ({template["vmid"]}) > gen-{generation} ({vmid}) {ip}', 'sys')
+
+    try:
+
+      # full clone - the new template must not depend on the old one
+      state.tasks.wait(state.prox.nodes(tnode).qemu(template['vmid']).clone.post(
+        newid=vmid,
+        full=1,
+        storage=storage,
+        name='devboximg-update',
+      ))
+      state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).config.post(
+        tags=template_tags(generation),
+        net0=f'model=virtio,bridge={state.bridge},mtu={network_mtu}',
+        ipconfig0=f'gw={network_gw},ip={ip}',
+        nameserver=network_dns,
+      ))
+      state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).status.start.post())
+
+      # first boot runs cloud-init - allow it longer than a clone's agent wait
+      session = AgentSession(state.prox, tnode, vmid, agent_timeout * 4)
+      for label, cmds in [('upgrade', update_cmds), ('cleanup', cleanup_cmds)]:
+        kmsg(f'{kname}update', label)
+        for cmd, result in zip(cmds, session.exec_many(cmds, update_timeout)):
+          if result.exitcode != 0:
+            raise AgentError(f'{vmid}: exit code {result.exitcode}: {cmd}\n{result.err.strip()}')
+
+      # shut down, drop the network config and convert
+      state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).status.shutdown.post())
+      state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).config.post(
+        name='devboximg',
+        description=f'devbox {datetime.now()} update of gen-{template["generation"]}',
+        delete='net0,ipconfig0,nameserver',
+      ))
+      state.tasks.wait(state.prox.nodes(tnode).qemu(vmid).template.post())
+    # rejected and dropped api requests fail the update the same way as a task
+    except (TaskError, AgentError, ResourceException, RequestException) as e:
+      kmsg(f'{kname}update', f'update failed - removing {vmid}: {e}', 'err')
+      discard(vmid, tnode)
+      release(slot)
+      exit(1)
+    release(slot)
+    kmsg(f'{kname}update', 'done')
+    publish(vmid, generation, tnode)
+
+# replicate image - copy the current template to nodes, by default [devbox]
+# placement_nodes or every online node with the devbox storage
+def image_replicate(nodes):
+  from devbox_placement import node_loads
+  state.refresh('resources')
+  template = state.template
+  if not template:
+    kmsg(f'{kname}replicate', 'image not found - please run "devbox image create"', 'err')
+    exit(1)
+  if state.storage_type == 'shared':
+    kmsg(f'{kname}replicate', f'{storage} is shared - every node clones the template directly', 'sys')
+    return
+
+  # nodes passed must be online and have the storage
+  loads = node_loads()
+  nodes = nodes or placement_nodes or [load['node'] for load in loads.values() if load['storage']]
+  missing = [target for target in nodes if not loads.get(target, {}).get('storage')]
+  if missing:
+    kmsg(f'{kname}replicate', f'{", ".join(missing)}: not online or without {storage}', 'err')
+    exit(1)
+
+  with image_lock(f'{kname}replicate'):
+    replicas = replicate(template, nodes)
+  wanted = [target for target in nodes if target != template['node'] and target not in template['replicas']]
+  if len(replicas) < len(wanted):
+    exit(1)
+
+# destroy image - the current generation and its replicas, the one before it becomes current
+def image_destroy():
+  template = state.template
+  kmsg(f'{kname}destroy', f'gen-{template["generation"] if template else "?"} {state.devbox_image_name}/{state.cloud_image_desc}', 'sys')
+  for replica in template['replicas'].values():
+    prox_destroy(replica)
+  prox_destroy(template['vmid'])
+  state.refresh()
+
+# image <cmd> - called by devbox.py
+def run(cmd, args):
+  if cmd == 'create':
+    image_create()
+  if cmd == 'update':
+    image_update()
+  if cmd == 'replicate':
+    image_replicate(args)
+  if cmd == 'info':
+    image_info()
+  if cmd == 'destroy':
+    image_destroy()
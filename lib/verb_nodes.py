@@ -3,76 +3,190 @@
 # functions
 from devbox_config import *
 from devbox_proxmox import *
+from devbox_tasks import TaskError
+from devbox_agent import AgentError
+from devbox_pool import pool_claim, pool_refill_background
+from devbox_placement import place
+from devbox_shell import node_terminal, node_ssh, node_reboot
 
-# passed command
-cmd = sys.argv[2]
-
-# map arg if passed
-try:
-  hostname = sys.argv[3]
-except IndexError:
-  pass
-
-# define kname
-kname = 'nodes_' + cmd
-
-# all commands aside from create/info require a hostname - check them here
-if cmd not in ['create', 'info']:
-
-  # for each vmid in list of vms generated in devbox_config
-  for vmid in vms:
-
-    # if passed arg matches vmname
-    if hostname == vmnames[vmid]:
-      kmsg(kname, hostname)
-
-      # terminal
-      if cmd == 'terminal':
-        kmsg('node_terminal', f'u/p: {cloudinituser} / {cloudinitpass}', 'sys')
-        subprocess.run(['sudo', 'qm', 'terminal', str(vmid)])
-        exit(0)
-
-      # ssh command
-      if cmd == 'ssh':
-        subprocess.run([
-          'ssh',
-          '-l', cloudinituser, vmip(vmid),
-          '-t',                                   # force TTY allocation
-          '-o', 'StrictHostKeyChecking=no',
-          '-o', 'ServerAliveInterval=15',         # detect dead connections
-          '-o', 'ServerAliveCountMax=3',
-          '-o', 'ExitOnForwardFailure=yes',
-        ], env={**os.environ, 'TERM': os.environ.get('TERM', 'xterm-256color')})
-        exit(0)
-
-      # destroy vm
-      if cmd == 'destroy':
-        prox_destroy(vmid)
-        exit(0)
-
-      # reboot
-      if cmd == 'reboot':
-        subprocess.Popen(['sudo', 'qm', 'reboot', str(vmid)])
-        exit(0)
+# terminal / ssh / destroy / reboot on one node
+def node_cmd(cmd, hostname):
+  kname = 'nodes_' + cmd
 
-  # vm not found
-  kmsg(kname, f'{hostname} vm not found', 'err')
-
-# create utility node
-if cmd == 'create':
+  # destroy and reboot act on the vm - a cached vmid may since have been freed and
+  # reused by another devbox, so they resolve the hostname from a fresh vm list
+  if cmd in ['destroy', 'reboot']:
+    state.refresh('resources')
 
-  # work out next highest available id
-  node_id = int(max(vms) + 1)
+  # map hostname to vmid from cached state
+  vmid = hostname_vmid(hostname)
 
-  # check to see if already exists
-  if hostname not in vmnames.values():
-    node_id = int(max(vms) + 1)
-    kmsg(kname, f'creating node {node_id}/{hostname}', 'sys')
-    clone(node_id, hostname)
-  else:
+  # vm not found
+  if not vmid:
+    kmsg(kname, f'{hostname} vm not found', 'err')
+    exit(1)
+
+  kmsg(kname, hostname)
+
+  # terminal
+  if cmd == 'terminal':
+    node_terminal(vmid, cloudinituser, cloudinitpass)
+
+  # ssh command
+  if cmd == 'ssh':
+    node_ssh(cloudinituser, vmip(vmid))
+
+  # destroy vm
+  if cmd == 'destroy':
+    prox_destroy(vmid)
+    state.refresh('resources')
+
+  # reboot
+  if cmd == 'reboot':
+    node_reboot(vmid)
+
+# create utility nodes
+def nodes_create(hostnames):
+  kname = 'nodes_create'
+
+  # ids are allocated from a fresh vm list, never from cached state
+  state.refresh('resources')
+
+  # hostnames passed or generated from --count and --pattern eg --count=3 --pattern=dev{n}
+  hostnames = list(hostnames)
+  if opts.get('count'):
+    pattern = opts.get('pattern', 'devbox{n}')
+    if '{n}' not in pattern:
+      kmsg(kname, f'--pattern needs a {{n}} placeholder: {pattern}', 'err')
+      exit(1)
+    n = 1
+    while len(hostnames) < int(opts['count']):
+      if pattern.format(n=n) not in state.vmnames.values():
+        hostnames.append(pattern.format(n=n))
+      n += 1
+
+  # pool and validation names are reserved
+  for hostname in hostnames:
+    if hostname in reserved_names:
+      kmsg(kname, f'{hostname} is a reserved name', 'err')
+      exit(1)
+
+  # skip hostnames that already exist
+  existing = [h for h in hostnames if h in state.vmnames.values()]
+  for hostname in existing:
     kmsg(kname, f'node {hostname} already exists')
+  hostnames = [h for h in dict.fromkeys(hostnames) if h not in existing]
+  if not hostnames:
+    devbox_info()
+    return
+
+  # claim warm pool vms first - renaming a booted vm takes seconds rather than a clone
+  results = []
+  if warm_pool:
+    for hostname in list(hostnames):
+      result = pool_claim(hostname)
+      if not result:
+        break
+      kmsg(kname, f'claimed pool node {result["vmid"]}/{hostname}', 'sys')
+      results.append(result)
+      hostnames.remove(hostname)
+
+  # reserve the lowest free ids for every node left up front and place them on nodes
+  nodes = dict(zip(next_ids(len(hostnames)), hostnames)) if hostnames else {}
+  targets = place(list(nodes))
+
+  # single node
+  if len(nodes) == 1 and not results:
+    node_id, hostname = next(iter(nodes.items()))
+    kmsg(kname, f'creating node {node_id}/{hostname}', 'sys')
+    started = time.monotonic()
+    try:
+      clone(node_id, hostname, target=targets[node_id])
+      error = ''
+    except (TaskError, AgentError) as e:
+      kmsg('proxmox_clone', str(e), 'err')
+      error = str(e)
+    results.append({
+      'vmid': node_id,
+      'hostname': hostname,
+      'ip': f'{vmip(node_id)}/{network_mask}',
+      'error': error,
+      'seconds': time.monotonic() - started,
+    })
+
+  # batch - clone pipelines run concurrently
+  elif nodes:
+    parallel = int(opts.get('parallel', create_parallel))
+    kmsg(kname, f'creating {len(nodes)} nodes {min(nodes)}-{max(nodes)} ({parallel} at a time)', 'sys')
+
+    # --aio drives every pipeline from one asyncio event loop instead of threads
+    if opts.get('aio'):
+      import devbox_aio
+      results += devbox_aio.clone_many(nodes, parallel, targets)
+    else:
+      results += clone_many(nodes, parallel, targets)
+  state.refresh('resources')
+
+  # top the pool back up without making the caller wait
+  if warm_pool:
+    pool_refill_background()
+
+  # aggregated result table
+  if len(results) > 1:
+    print(f'{"vmid":<6} {"hostname":<20} {"ip":<18} {"time":>7}  status')
+    for result in results:
+      print(f'{result["vmid"]:<6} {result["hostname"]:<20} {result["ip"]:<18} {result["seconds"]:>6.1f}s  {result["error"] or "ok"}')
+  if any(result['error'] for result in results):
+    exit(1)
+
+# move running devboxes off busy nodes - prints the plan, --execute migrates
+def nodes_rebalance():
+  from devbox_rebalance import fleet, score_spread, plan_moves, migrate_many
+  from devbox_placement import node_score
+  kname = 'nodes_rebalance'
+  loads, vms = fleet()
+  spread = score_spread(loads)
+  moves, planned = plan_moves(loads, vms)
+  if not moves:
+    kmsg(kname, f'{len(vms)} devboxes on {len(loads)} nodes - score spread {spread:.2f}, nothing to move (threshold {rebalance_threshold})')
+    return
+
+  # node scores now and once the plan has run
+  kmsg(kname, f'score spread {spread:.2f} > {score_spread(planned):.2f} with {len(moves)} of {len(vms)} devboxes moved', 'sys')
+  for name in sorted(loads):
+    kmsg(kname, f'{name} {node_score(loads[name]):.2f} > {node_score(planned[name]):.2f}')
+  if not opts.get('execute'):
+    print(f'{"vmid":<6} {"hostname":<20} {"from":<12} to')
+    for move in moves:
+      print(f'{move["vmid"]:<6} {move["hostname"]:<20} {move["source"]:<12} {move["target"]}')
+    kmsg(kname, 'dry run - pass --execute to migrate')
+    return
+
+  # live migrations - parallel at a time
+  parallel = int(opts.get('parallel', rebalance_parallel))
+  results = migrate_many(moves, parallel)
+  state.refresh('resources')
+  print(f'{"vmid":<6} {"hostname":<20} {"from":<12} {"to":<12} {"time":>7}  status')
+  for result in results:
+    print(f'{result["vmid"]:<6} {result["hostname"]:<20} {result["source"]:<12} {result["target"]:<12} {result["seconds"]:>6.1f}s  {result["error"] or "ok"}')
+  if any(result['error'] for result in results):
+    exit(1)
+
+# nodes <cmd> [hostname ...] - called by devbox.py
+def run(cmd, args):
+
+  # create
+  if cmd == 'create':
+    nodes_create(args)
+
+  # info
+  elif cmd == 'info':
     devbox_info()
 
-# info
-if cmd == 'info':
-  devbox_info()
+  # rebalance
+  elif cmd == 'rebalance':
+    nodes_rebalance()
+
+  # all other commands take a hostname
+  else:
+    node_cmd(cmd, args[0])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+# functions
+from devbox_config import *
+from devbox_pool import *
+
+kname = 'pool_'
+
+# list pool vms
+def pool_info():
+  ready = pool_vms()
+  kmsg(f'{kname}info', f'{len(ready)}/{warm_pool} ready')
+  for vmid, name in state.vmnames.items():
+    if name in [pool_name, pool_warming_name]:
+      status = 'ready' if vmid in ready else 'warming'
+      kmsg(f'{vmid}_[{state.vms[vmid]}]-{name}', f'{vmip(vmid)}/{network_mask} {status}')
+
+# clone pool vms up to warm_pool
+def pool_fill_cmd():
+  if not warm_pool:
+    kmsg(f'{kname}fill', '[devbox]/warm_pool is 0 - pool disabled', 'sys')
+    return
+  results = pool_fill()
+  for result in results:
+    kmsg(f'{kname}fill', f'{result["vmid"]} {result["seconds"]:.1f}s {result["error"] or "ok"}')
+  if any(result['error'] for result in results):
+    exit(1)
+
+# destroy every pool vm
+def pool_drain():
+  state.refresh('resources')
+  for vmid, name in list(state.vmnames.items()):
+    if name in [pool_name, pool_warming_name]:
+      prox_destroy(vmid)
+  state.refresh('resources')
+
+# pool <cmd> - called by devbox.py
+def run(cmd, args):
+  if cmd == 'info':
+    pool_info()
+  if cmd == 'fill':
+    pool_fill_cmd()
+  if cmd == 'drain':
+    pool_drain()